@@ -1,47 +1,16 @@
-from embedding_gen import generate_embedding
+import chunking
+from embedding_gen import generate_embeddings
 from chunking import chunk_markdown, write_debug_log
 import psycopg2
+from bulk_writer import BulkChunkWriter
+from db_schema import ensure_schema
+from ingest_manifest import IngestManifest, FileJob, UNCHANGED
 import os
 import glob
 import tiktoken
-from transformers import AutoTokenizer, AutoModel
-import torch
 import traceback
 
 
-# Load the tokenizer and the base model (without classification head)
-tokenizer = AutoTokenizer.from_pretrained("yiyanghkust/finbert-tone")
-model = AutoModel.from_pretrained("yiyanghkust/finbert-tone")
-
-def save_embedding_to_db(embedding, chunk, company_name, doc_year, doc_type, fiscal_quarter):
-    try:
-        # Convert the numpy array to a list
-        embedding_list = embedding.tolist()[0]  # Flatten the array
-        # Create the SQL insert statement
-        insert_query = """
-        INSERT INTO embedding_chunks (embedding, company, year, document_type, fiscal_quarter)
-        VALUES (%s, %s, %s, %s, %s)
-        RETURNING id;
-        """
-
-        cursor.execute(insert_query, (embedding_list, company_name, str(doc_year), doc_type, fiscal_quarter))
-        embedding_id = cursor.fetchone()[0]  # Fetch the returned id
-        conn.commit()
-        
-        # Now insert the text into markdown_text with the same id
-        insert_text_query = """
-        INSERT INTO text_chunks (id, text, company, year, document_type, fiscal_quarter)
-        VALUES (%s, %s, %s, %s, %s, %s);
-        """
-
-        # Execute the query using the retrieved embedding_id
-        cursor.execute(insert_text_query, (embedding_id, chunk, company_name, str(doc_year), doc_type, fiscal_quarter))
-        conn.commit()
-    except Exception as error:
-        print(f"ERROR committing to the database: {error}")
-        print(f"chunk text: {chunk}")
-        write_debug_log(f"ERROR committing to the database: {error}")
-        write_debug_log(f"chunk text: {chunk}")
 # # Function to split text into chunks based on token size
 # def split_into_chunks(text, max_tokens=200):
 #     """Splits the input text into chunks of a specified token size."""
@@ -59,18 +28,17 @@ def process_markdown_file(file_path, company_name, doc_year, doc_type, fiscal_qu
         # print("Chunk #: ", end="")
         write_debug_log(f"Chunking {file}")
         chunks = chunk_markdown(content,512, verbose=False)
-        for i, chunk in enumerate(chunks):
-            if isinstance(chunk, tuple):
-                table, summary = chunk
-                embedding = generate_embedding(text=summary)
-                # print(f"{i}, ", end="")
-                # Store or process the embedding here
-                save_embedding_to_db(embedding, table, company_name, doc_year, doc_type, fiscal_quarter)
-            elif isinstance(chunk, str):
-                embedding = generate_embedding(text=chunk)
-                # print(f"{i}, ", end="")
-                # Store or process the embedding here
-                save_embedding_to_db(embedding, chunk, company_name, doc_year, doc_type, fiscal_quarter)
+        # Tables are embedded using their summary but stored as the raw table
+        texts = [chunk[1] if isinstance(chunk, tuple) else chunk for chunk in chunks]
+        stored_chunks = [chunk[0] if isinstance(chunk, tuple) else chunk for chunk in chunks]
+        # Embed the whole document in batches instead of one forward pass per chunk
+        embeddings = generate_embeddings(texts)
+        for i, chunk in enumerate(stored_chunks):
+            # print(f"{i}, ", end="")
+            # Store or process the embedding here
+            writer.add(embeddings[i], chunk, company_name, doc_year, doc_type, fiscal_quarter, source_file=file_path)
+        # Write whatever is still buffered for this document
+        writer.flush()
         print(end="\n\n")
 
 def read_markdown_files(base_dir):
@@ -92,6 +60,8 @@ base_dir = "../md_files"
 
 # set globals
 debug = False
+# Re-ingest the file even if the manifest says it is unchanged
+force_reingest = False
 
 # Connection parameters for pgvector
 host = "localhost"         # Hostname (since you've mapped the container port)
@@ -113,6 +83,8 @@ try:
 
     # Create a cursor to perform database operations
     cursor = conn.cursor()
+    # Chunks are buffered and loaded into both tables with COPY
+    writer = BulkChunkWriter(conn)
     
     file = "../md_files/Nvidia/2024/10Q_10K/10Q-Q3-2024.pdf.md"
     
@@ -131,59 +103,25 @@ try:
     print(doc_type)
     print(fiscal_quarter)
     
-    process_markdown_file(file, company, year, doc_type, fiscal_quarter)
-    
-    # Delete any duplicate chunks
-    cursor.execute("""DELETE FROM text_chunks
-                        WHERE id IN (
-                            SELECT id
-                            FROM (
-                                SELECT 
-                                    id,
-                                    ROW_NUMBER() OVER (
-                                        PARTITION BY text, company, year, document_type, fiscal_quarter 
-                                        ORDER BY id
-                                    ) AS row_num
-                                FROM text_chunks
-                            ) AS subquery
-                            WHERE row_num > 1
-                        );
-                    DELETE FROM embedding_chunks
-                        WHERE id NOT IN (SELECT id FROM text_chunks);
-                    DELETE FROM embedding_chunks
-                        WHERE id IN (
-                            SELECT id
-                            FROM (
-                                SELECT 
-                                    id,
-                                    ROW_NUMBER() OVER (
-                                        PARTITION BY embedding, company, year, document_type, fiscal_quarter 
-                                        ORDER BY id
-                                    ) AS row_num
-                                FROM embedding_chunks
-                            ) AS subquery
-                            WHERE row_num > 1
-                        );
-                    DELETE FROM text_chunks
-                        WHERE id NOT IN (SELECT id FROM embedding_chunks);
-                        """)
-    conn.commit()
+    # Create the chunk tables, the ingestion manifest and their indexes, migrating older databases (content hashes,
+    # generated text_vectors column) on the first run
+    ensure_schema(conn)
+    manifest = IngestManifest(conn, chunking.CHUNKER_VERSION)
+    (entry,), _ = manifest.plan([FileJob(file, company, year, doc_type, fiscal_quarter)], force=force_reingest)
+    if entry.status == UNCHANGED:
+        print(f"{file} is unchanged since it was last ingested, skipping")
+    else:
+        # Chunks that are already stored are skipped by their content hash, chunks from an older version of the file are
+        # only removed once the new version is written
+        process_markdown_file(file, company, year, doc_type, fiscal_quarter)
+        if file not in writer.quarantined_files:
+            print(f"Removed {manifest.remove_chunks(entry.job, keep_hashes=writer.pop_file_hashes(file))} stale chunks of {file}")
+            manifest.record(entry)
 
-    cursor.execute("""
-        UPDATE text_chunks
-        SET text_vectors = to_tsvector('english', text);
-    """)
-    conn.commit()
-    
-    cursor.execute("""
-        DROP INDEX IF EXISTS text_vectors_idx;
-        CREATE INDEX text_vectors_idx
-        ON text_chunks
-        USING gin(text_vectors);
-    """)
-    conn.commit()
-    
     print("\nFinished populating database")
+    print(writer.summary())
+    if chunking.summary_cache is not None:
+        print(chunking.summary_cache.summary())
     
 
 except Exception as error:
@@ -1,4 +1,5 @@
 import psycopg2
+from db_schema import migrate_text_vectors
 import traceback
 
 # set globals
@@ -38,23 +39,10 @@ try:
         raise Exception("Table 'text_chunks' does not exist. Create the table before proceeding.")
     else: print("text_chunks table does exist")
 
-    # Add the `text_vectors` column to store `tsvector`
-    cursor.execute("""
-        ALTER TABLE text_chunks
-        ADD COLUMN IF NOT EXISTS text_vectors tsvector;
-    """)
-    conn.commit()
-    print("Column `text_vectors` added or already exists.")
-
-    # Populate the `text_vectors` column using the `to_tsvector` function
-    cursor.execute("""
-        UPDATE text_chunks
-        SET text_vectors = to_tsvector('english', text);
-    """)
-    conn.commit()
-    print("Column `text_vectors` populated with tsvector data.")
-
-    # Index the `text_vectors` column
+    # Add `text_vectors` as a generated column so Postgres keeps it up to date on every insert, and index it.
+    # Older databases with a plain `text_vectors` column are converted once.
+    migrate_text_vectors(conn)
+    print("Column `text_vectors` is a generated column.")
     cursor.execute("""
         CREATE INDEX IF NOT EXISTS text_vectors_idx
         ON text_chunks
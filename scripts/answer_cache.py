@@ -0,0 +1,138 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from embedding_cache import normalize_query
+
+# In-memory cache of generated answers. An answer is only reused for the same question with the same context: the
+# key is the answer model, the normalized query and the ordered ids of the retrieved chunks (a different chunk or a
+# different order misses). Optionally a query whose embedding is close enough to a cached query with the same chunks
+# reuses that answer too. Entries expire after ttl_seconds so answers do not outlive a corpus or prompt change for long,
+# and the least recently used entry goes when the cache is full.
+#
+# llm.generation_step() uses it, see answer_cache in llm.py.
+
+# Default number of cached answers
+ANSWER_CACHE_SIZE = 512
+# Default lifetime of a cached answer
+ANSWER_TTL_SECONDS = 60 * 60
+
+
+def chunk_key(top_n):
+    """Ordered chunk ids of retrieval results, a hash of the text for chunks without an id."""
+    parts = []
+    for doc in top_n or []:
+        chunk_id = getattr(doc, "id", None)
+        if chunk_id is None:
+            text = doc[0] if isinstance(doc, tuple) else doc
+            chunk_id = "text:" + hashlib.sha1(str(text).encode("utf-8")).hexdigest()
+        parts.append(str(chunk_id))
+    return ",".join(parts)
+
+
+class AnswerCache:
+    """LRU cache with expiry for LLM answers keyed by query and retrieved chunks.
+
+    Args:
+        model_id (str): answer model, part of every key so different models never share answers
+        max_items (int, optional): most cached answers. Defaults to ANSWER_CACHE_SIZE.
+        ttl_seconds (float, optional): lifetime of an answer, None keeps answers until evicted. Defaults to ANSWER_TTL_SECONDS.
+        similarity_threshold (float, optional): cosine similarity above which a query with the same chunks counts as a
+            near duplicate of a cached one. Defaults to None (exact matches only).
+        embedder (callable, optional): query -> embedding, needed for the near-duplicate lookup. Defaults to None.
+    """
+
+    def __init__(self, model_id, max_items=ANSWER_CACHE_SIZE, ttl_seconds=ANSWER_TTL_SECONDS, similarity_threshold=None,
+                 embedder=None):
+        if similarity_threshold is not None and embedder is None:
+            raise ValueError("similarity_threshold needs an embedder")
+        self.model_id = model_id
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.embedder = embedder
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        # key -> (answer, chunk key, unit query embedding or None, expiry time)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, query, chunks):
+        return hashlib.sha1(f"{self.model_id}\0{normalize_query(query)}\0{chunks}".encode("utf-8")).hexdigest()
+
+    def _embed(self, query):
+        embedding = np.asarray(self.embedder(query), dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def _is_expired(self, entry, now):
+        return entry[3] is not None and entry[3] <= now
+
+    def get(self, query, top_n):
+        """Return the cached answer for query with the retrieved chunks top_n or None."""
+        chunks = chunk_key(top_n)
+        key = self._key(query, chunks)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry, now):
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry[0]
+            if self.similarity_threshold is None:
+                self.misses += 1
+                return None
+            candidates = [(k, e) for k, e in self._entries.items()
+                          if e[1] == chunks and e[2] is not None and not self._is_expired(e, now)]
+        if candidates:
+            # Embedding outside the lock, it may run the model
+            embedding = self._embed(query)
+            similarities = np.stack([e[2] for _, e in candidates]) @ embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.similarity_threshold:
+                with self._lock:
+                    best_key, best_entry = candidates[best]
+                    if best_key in self._entries:
+                        self._entries.move_to_end(best_key)
+                    self.similar_hits += 1
+                    return best_entry[0]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, query, top_n, answer):
+        """Cache the answer to query given the retrieved chunks top_n."""
+        chunks = chunk_key(top_n)
+        embedding = self._embed(query) if self.similarity_threshold is not None else None
+        expires = time.time() + self.ttl_seconds if self.ttl_seconds is not None else None
+        key = self._key(query, chunks)
+        with self._lock:
+            self._entries[key] = (answer, chunks, embedding, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.exact_hits + self.similar_hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.similar_hits) / lookups if lookups else 0.0,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "items": len(self._entries),
+        }
@@ -1,6 +1,6 @@
 import yfinance as yf
 from datetime import datetime, timedelta, date
-from llm import retrieval_step, generation_step
+from llm import retrieval_step, generation_step, answer_cache
 import re
 from funcs import write_debug_log
 import math
@@ -230,6 +230,8 @@ def generation_eval(companies, years, k, verbose = False):
         for c_name, c_count in company_counts.items():
             
             write_debug_log(f"{c_name}: {c_count['count_correct']}/{c_count['count_total']} - {c_count['count_correct']/c_count['count_total']}", log_file=debug_file, with_timestamp=False, print_message=True)
+        stats = answer_cache.stats()
+        write_debug_log(f"answer cache hit rate = {stats['hit_rate']:.2f} ({stats['exact_hits']} exact, {stats['similar_hits']} similar, {stats['misses']} misses)", log_file=debug_file, with_timestamp=False, print_message=True)
         write_debug_log("\n"*6, log_file=debug_file, with_timestamp=False, print_message=True)
         
         return count_correct, count_total, company_counts
@@ -0,0 +1,122 @@
+import argparse
+import time
+import numpy as np
+from db_pool import connection
+from db_schema import ensure_schema, chunk_flags_pending, bump_corpus_generation
+from chunk_flags import compute_chunk_flags, remove_doc
+
+# Computes the chunk quality flags (is_toc, chunk_kind, token_length, chunk_filtered, see chunk_flags.py) for rows
+# written before the writer stored them, or for every row with --all after the heuristics changed. Works in batches
+# of ids so it can be stopped and resumed, every batch commits on its own.
+#
+# Usage:
+#   python backfill_chunk_flags.py run
+#   python backfill_chunk_flags.py run --all --batch-size 2000
+#   python backfill_chunk_flags.py status
+
+BACKFILL_BATCH_SIZE = 1000
+
+_UPDATE_FLAGS_SQL = """
+    UPDATE text_chunks AS t
+    SET is_toc = f.is_toc, chunk_kind = f.chunk_kind, token_length = f.token_length, chunk_filtered = f.chunk_filtered
+    FROM unnest(%s::bigint[], %s::boolean[], %s::text[], %s::integer[], %s::boolean[])
+        AS f(id, is_toc, chunk_kind, token_length, chunk_filtered)
+    WHERE t.id = f.id;
+    UPDATE embedding_chunks AS e
+    SET chunk_filtered = f.chunk_filtered
+    FROM unnest(%s::bigint[], %s::boolean[]) AS f(id, chunk_filtered)
+    WHERE e.id = f.id;
+"""
+
+
+def backfill(conn, batch_size=BACKFILL_BATCH_SIZE, recompute=False, verbose=True):
+    """Store the quality flags of every chunk that has none (every chunk with recompute).
+
+    Args:
+        conn (psycopg2.connection): database connection, committed after every batch
+        batch_size (int, optional): chunks per batch. Defaults to BACKFILL_BATCH_SIZE.
+        recompute (bool, optional): also recompute chunks that already have flags. Defaults to False.
+        verbose (bool, optional): print progress. Defaults to True.
+
+    Returns:
+        int: number of chunks updated
+    """
+    start = time.perf_counter()
+    last_id = 0
+    updated = 0
+    pending_filter = "" if recompute else "chunk_filtered IS NULL AND"
+    while True:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT id, text FROM text_chunks WHERE {pending_filter} id > %s ORDER BY id LIMIT %s;",
+                           (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            ids = [row[0] for row in rows]
+            flags = compute_chunk_flags([row[1] for row in rows])
+            filtered = [flag.chunk_filtered for flag in flags]
+            cursor.execute(_UPDATE_FLAGS_SQL, (
+                ids, [flag.is_toc for flag in flags], [flag.chunk_kind for flag in flags],
+                [flag.token_length for flag in flags], filtered, ids, filtered,
+            ))
+            # NULL and false both keep a chunk, only newly filtered chunks (or a recompute) change retrieval results
+            if recompute or any(filtered):
+                bump_corpus_generation(cursor)
+        conn.commit()
+        last_id = ids[-1]
+        updated += len(rows)
+        if verbose:
+            print(f"{updated} chunks flagged ({updated / (time.perf_counter() - start):.0f}/s)", end="\r")
+    if verbose:
+        print(f"\nFlagged {updated} chunks in {time.perf_counter() - start:.1f}s")
+    return updated
+
+
+def status(conn, sample_size=100):
+    """Print the flag distribution and what chunk filtering used to cost per query in Python."""
+    with conn.cursor() as cursor:
+        pending = chunk_flags_pending(cursor)
+        cursor.execute("""
+            SELECT chunk_kind, count(*), count(*) FILTER (WHERE is_toc), count(*) FILTER (WHERE chunk_filtered),
+                avg(token_length)
+            FROM text_chunks
+            WHERE chunk_filtered IS NOT NULL
+            GROUP BY chunk_kind
+            ORDER BY chunk_kind;
+        """)
+        kinds = cursor.fetchall()
+        cursor.execute("SELECT text FROM text_chunks ORDER BY random() LIMIT %s;", (sample_size,))
+        sample = [row[0] or "" for row in cursor.fetchall()]
+    conn.rollback()
+
+    print(f"{pending} chunks without flags")
+    print(f"{'kind':<8}{'chunks':>10}{'toc':>8}{'filtered':>10}{'avg tokens':>12}")
+    for kind, count, toc, filtered, avg_tokens in kinds:
+        print(f"{kind:<8}{count:>10}{toc:>8}{filtered:>10}{float(avg_tokens or 0):>12.1f}")
+    if sample:
+        timings = []
+        for _ in range(5):
+            start = time.perf_counter()
+            for text in sample:
+                remove_doc(text)
+            timings.append((time.perf_counter() - start) * 1000)
+        print(f"remove_doc() over {len(sample)} candidates: {np.median(timings):.2f} ms per query "
+              f"(now a column check inside the candidate SQL)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute the chunk quality flags of existing rows")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="flag every chunk that has no flags yet")
+    run_parser.add_argument("--all", action="store_true", help="recompute the flags of every chunk")
+    run_parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE)
+    subparsers.add_parser("status", help="flag distribution and the per query cost of filtering in Python")
+    args = parser.parse_args()
+
+    with connection() as conn:
+        if args.command == "run":
+            # Adds the flag columns and indexes on databases that do not have them yet
+            ensure_schema(conn, verbose=False)
+            backfill(conn, args.batch_size, recompute=args.all)
+        else:
+            status(conn)
@@ -0,0 +1,428 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import time
+import numpy as np
+from db_pool import connection
+from pgvector_db_funcs import QUERY_STOPWORDS
+
+# In-process BM25 index over text_chunks, an alternative to the ts_rank full text branch of retrieve_n.
+#
+# Postings are stored per segment in CSR layout: the sorted term ids of the segment, an offsets array into the
+# postings, and the document (row in the segment) and term frequency of every posting, all NumPy arrays. New filings
+# are appended as new segments; removed chunks are only marked deleted until segments are merged. Scoring a query
+# touches only the postings of its terms, top-k is an argpartition over the matching documents.
+#
+# Documents and queries go through the same tokenizer, so QUERY_STOPWORDS (company names, years, quarters, which the
+# metadata filters already cover) and English stopwords are dropped on both sides.
+#
+# Usage:
+#   python bm25_index.py build                (or sync, which only adds new and drops removed chunks)
+#   python bm25_index.py sync
+#   python bm25_index.py compare --k 10       (latency and quality against Postgres full text search)
+#
+# retrieve_n(query, lexical_backend=BM25Index.load()) uses it.
+
+BM25_INDEX_DIR = "bm25_index"
+# Standard BM25 parameters
+K1 = 1.2
+B = 0.75
+# Merge every segment into one when there are more than this many, or when this share of the documents is deleted
+MAX_SEGMENTS = 8
+MAX_DELETED_FRACTION = 0.2
+SYNC_BATCH_SIZE = 5000
+METADATA_COLUMNS = ("company", "year", "fiscal_quarter")
+
+# Postgres' english configuration drops these as well
+ENGLISH_STOPWORDS = set("""a about above after again against all am an and any are as at be because been before being
+    below between both but by can did do does doing down during each few for from further had has have having he her
+    here hers herself him himself his how i if in into is it its itself just me more most my myself no nor not now of
+    off on once only or other our ours ourselves out over own same she should so some such than that the their theirs
+    them themselves then there these they this those through to too under until up very was we were what when where
+    which while who whom why will with you your yours yourself yourselves""".split())
+STOPWORDS = ENGLISH_STOPWORDS | set(QUERY_STOPWORDS)
+
+
+def tokenize(text):
+    """Lowercased word tokens without stopwords, plurals folded to their singular ("expenses" -> "expense")."""
+    tokens = []
+    for token in re.findall(r'\w+', text.lower()):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 4 and token.endswith("ies"):
+            token = token[:-3] + "y"
+        elif len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class _Segment:
+    """Immutable block of documents with CSR postings. Only the deleted flags change after creation."""
+
+    def __init__(self, doc_ids, doc_lengths, codes, term_ids, term_offsets, posting_docs, posting_tfs, deleted=None):
+        self.doc_ids = doc_ids
+        self.doc_lengths = doc_lengths
+        self.codes = codes
+        self.term_ids = term_ids
+        self.term_offsets = term_offsets
+        self.posting_docs = posting_docs
+        self.posting_tfs = posting_tfs
+        self.deleted = deleted if deleted is not None else np.zeros(len(doc_ids), dtype=bool)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    @classmethod
+    def from_postings(cls, doc_ids, doc_lengths, codes, terms, docs, tfs):
+        """Build the CSR layout from one (term, doc, tf) triple per posting."""
+        order = np.lexsort((docs, terms))
+        terms, docs, tfs = terms[order], docs[order], tfs[order]
+        term_ids, starts = np.unique(terms, return_index=True)
+        term_offsets = np.append(starts, len(terms)).astype(np.int64)
+        return cls(doc_ids, doc_lengths, codes, term_ids.astype(np.int32), term_offsets, docs.astype(np.int32),
+                   tfs.astype(np.float32))
+
+    def postings(self):
+        """Every posting as (term, doc, tf) arrays, the inverse of from_postings()."""
+        terms = np.repeat(self.term_ids, np.diff(self.term_offsets))
+        return terms, self.posting_docs, self.posting_tfs
+
+    def arrays(self):
+        return {
+            "doc_ids": self.doc_ids, "doc_lengths": self.doc_lengths, "term_ids": self.term_ids,
+            "term_offsets": self.term_offsets, "posting_docs": self.posting_docs, "posting_tfs": self.posting_tfs,
+            "deleted": self.deleted, **{f"code_{column}": self.codes[column] for column in METADATA_COLUMNS},
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        codes = {column: arrays[f"code_{column}"] for column in METADATA_COLUMNS}
+        return cls(arrays["doc_ids"], arrays["doc_lengths"], codes, arrays["term_ids"], arrays["term_offsets"],
+                   arrays["posting_docs"], arrays["posting_tfs"], arrays["deleted"].copy())
+
+
+class BM25Index:
+    """Appendable BM25 index over chunk texts with company / year / fiscal quarter filters.
+
+    Collection statistics (document count, document frequencies, average length) include deleted documents until the
+    next merge, like most segment based engines. Not thread safe for writes, searches may run concurrently.
+    """
+
+    def __init__(self):
+        self.vocabulary = {}
+        self.document_frequencies = np.zeros(0, dtype=np.int64)
+        self.num_docs = 0
+        self.total_length = 0
+        self.metadata_vocabularies = {column: {} for column in METADATA_COLUMNS}
+        self.segments = []
+
+    def __len__(self):
+        """Number of live documents."""
+        return sum(len(segment) - int(segment.deleted.sum()) for segment in self.segments)
+
+    def doc_ids(self):
+        """Ids of the live documents."""
+        if not self.segments:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([segment.doc_ids[~segment.deleted] for segment in self.segments])
+
+    def add_documents(self, ids, texts, companies, years, quarters):
+        """Index a batch of chunks as a new segment.
+
+        Args:
+            ids (list(int)): chunk ids
+            texts (list(str)): chunk texts
+            companies, years, quarters (list): filing metadata of every chunk
+        """
+        if len(ids) == 0:
+            return
+        terms, docs, tfs = [], [], []
+        doc_lengths = np.zeros(len(ids), dtype=np.int32)
+        for doc, text in enumerate(texts):
+            tokens = tokenize(text or "")
+            doc_lengths[doc] = len(tokens)
+            if not tokens:
+                continue
+            token_ids = np.fromiter((self.vocabulary.setdefault(token, len(self.vocabulary)) for token in tokens),
+                                    dtype=np.int64, count=len(tokens))
+            unique_terms, counts = np.unique(token_ids, return_counts=True)
+            terms.append(unique_terms)
+            docs.append(np.full(len(unique_terms), doc, dtype=np.int64))
+            tfs.append(counts)
+        terms = np.concatenate(terms) if terms else np.zeros(0, dtype=np.int64)
+        docs = np.concatenate(docs) if docs else np.zeros(0, dtype=np.int64)
+        tfs = np.concatenate(tfs) if tfs else np.zeros(0, dtype=np.int64)
+
+        codes = {}
+        for column, values in zip(METADATA_COLUMNS, (companies, years, quarters)):
+            vocabulary = self.metadata_vocabularies[column]
+            codes[column] = np.array([vocabulary.setdefault(str(value), len(vocabulary)) for value in values], dtype=np.int16)
+
+        self.segments.append(_Segment.from_postings(np.asarray(ids, dtype=np.int64), doc_lengths, codes, terms, docs, tfs))
+        if len(self.vocabulary) > len(self.document_frequencies):
+            self.document_frequencies = np.concatenate([
+                self.document_frequencies, np.zeros(len(self.vocabulary) - len(self.document_frequencies), dtype=np.int64)
+            ])
+        np.add.at(self.document_frequencies, terms, 1)
+        self.num_docs += len(ids)
+        self.total_length += int(doc_lengths.sum())
+        self._maybe_merge()
+
+    def remove(self, ids):
+        """Mark chunks as deleted, returns how many were found."""
+        ids = np.asarray(ids, dtype=np.int64)
+        removed = 0
+        for segment in self.segments:
+            hits = np.isin(segment.doc_ids, ids) & ~segment.deleted
+            segment.deleted |= hits
+            removed += int(hits.sum())
+        self._maybe_merge()
+        return removed
+
+    def _maybe_merge(self):
+        deleted = sum(int(segment.deleted.sum()) for segment in self.segments)
+        if len(self.segments) > MAX_SEGMENTS or (self.num_docs and deleted / self.num_docs > MAX_DELETED_FRACTION):
+            self.merge()
+
+    def merge(self):
+        """Merge every segment into one, dropping deleted documents and recomputing the collection statistics."""
+        doc_ids, doc_lengths, terms, docs, tfs = [], [], [], [], []
+        codes = {column: [] for column in METADATA_COLUMNS}
+        offset = 0
+        for segment in self.segments:
+            live = ~segment.deleted
+            # New row number of every live document, -1 for deleted ones
+            new_rows = np.full(len(segment), -1, dtype=np.int64)
+            new_rows[live] = offset + np.arange(int(live.sum()))
+            segment_terms, segment_docs, segment_tfs = segment.postings()
+            keep = live[segment_docs]
+            terms.append(segment_terms[keep])
+            docs.append(new_rows[segment_docs[keep]])
+            tfs.append(segment_tfs[keep])
+            doc_ids.append(segment.doc_ids[live])
+            doc_lengths.append(segment.doc_lengths[live])
+            for column in METADATA_COLUMNS:
+                codes[column].append(segment.codes[column][live])
+            offset += int(live.sum())
+        if offset == 0:
+            self.segments = []
+            self.document_frequencies[:] = 0
+            self.num_docs = 0
+            self.total_length = 0
+            return
+        merged = _Segment.from_postings(
+            np.concatenate(doc_ids), np.concatenate(doc_lengths),
+            {column: np.concatenate(values) for column, values in codes.items()},
+            np.concatenate(terms), np.concatenate(docs), np.concatenate(tfs),
+        )
+        self.segments = [merged]
+        self.document_frequencies = np.bincount(merged.postings()[0], minlength=len(self.vocabulary)).astype(np.int64)
+        self.num_docs = len(merged)
+        self.total_length = int(merged.doc_lengths.sum())
+
+    def _filter_mask(self, segment, company_filter, year_filter, quarters_filter):
+        mask = ~segment.deleted
+        for column, values in zip(METADATA_COLUMNS, (company_filter, year_filter, quarters_filter)):
+            if len(values) == 0:
+                continue
+            vocabulary = self.metadata_vocabularies[column]
+            mask &= np.isin(segment.codes[column], [vocabulary[str(value)] for value in values if str(value) in vocabulary])
+        return mask
+
+    def search(self, query, k=None, company_filter=(), year_filter=(), quarters_filter=(), candidate_ids=None):
+        """BM25 top-k of the documents matching at least one query term.
+
+        Args:
+            query (str): query text, tokenized like the documents
+            k (int, optional): number of documents to return. Defaults to None (every matching document).
+            company_filter, year_filter, quarters_filter (list, optional): same semantics as in retrieve_n
+            candidate_ids (np.ndarray, optional): only return these chunk ids (already filtered by a
+                MetadataBitmapIndex), the filters are ignored then. Defaults to None.
+
+        Returns:
+            ids np.ndarray: chunk ids, best first
+            scores np.ndarray: BM25 score of every returned document
+        """
+        term_ids = np.unique([self.vocabulary[token] for token in tokenize(query) if token in self.vocabulary]).astype(np.int32)
+        if len(term_ids) == 0 or self.num_docs == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        frequencies = self.document_frequencies[term_ids]
+        idf = np.log(1 + (self.num_docs - frequencies + 0.5) / (frequencies + 0.5))
+        average_length = max(self.total_length / self.num_docs, 1.0)
+
+        all_ids, all_scores = [], []
+        for segment in self.segments:
+            if len(segment.term_ids) == 0:
+                continue
+            scores = np.zeros(len(segment))
+            positions = np.minimum(np.searchsorted(segment.term_ids, term_ids), len(segment.term_ids) - 1)
+            for term, term_idf, position in zip(term_ids, idf, positions):
+                if segment.term_ids[position] != term:
+                    continue
+                start, end = segment.term_offsets[position], segment.term_offsets[position + 1]
+                docs = segment.posting_docs[start:end]
+                tfs = segment.posting_tfs[start:end]
+                norms = K1 * (1 - B + B * segment.doc_lengths[docs] / average_length)
+                # A document appears once in the postings of a term, so fancy index += is safe here
+                scores[docs] += term_idf * tfs * (K1 + 1) / (tfs + norms)
+            if candidate_ids is not None:
+                mask = ~segment.deleted & np.isin(segment.doc_ids, candidate_ids)
+            else:
+                mask = self._filter_mask(segment, company_filter, year_filter, quarters_filter)
+            matched = np.flatnonzero((scores > 0) & mask)
+            all_ids.append(segment.doc_ids[matched])
+            all_scores.append(scores[matched])
+
+        if not all_ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        ids = np.concatenate(all_ids)
+        scores = np.concatenate(all_scores)
+        if k is not None and k < len(scores):
+            if k <= 0:
+                return ids[:0], scores[:0]
+            best = np.argpartition(-scores, k - 1)[:k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return ids[best], scores[best]
+
+    def sync(self, conn, verbose=True):
+        """Bring the index up to date with text_chunks: index new chunks and delete removed ones.
+
+        Returns:
+            added int: number of indexed chunks
+            removed int: number of deleted chunks
+        """
+        start = time.perf_counter()
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT id FROM text_chunks;")
+            database_ids = np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+        indexed_ids = self.doc_ids()
+        removed = self.remove(np.setdiff1d(indexed_ids, database_ids)) if len(indexed_ids) else 0
+        new_ids = np.setdiff1d(database_ids, indexed_ids)
+        for batch_start in range(0, len(new_ids), SYNC_BATCH_SIZE):
+            batch = [int(chunk_id) for chunk_id in new_ids[batch_start:batch_start + SYNC_BATCH_SIZE]]
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT id, text, company, year, fiscal_quarter FROM text_chunks WHERE id = ANY(%s);", (batch,))
+                rows = cursor.fetchall()
+            if rows:
+                self.add_documents(*map(list, zip(*rows)))
+        conn.rollback()
+        if verbose:
+            print(f"BM25 index: {len(new_ids)} chunks added, {removed} removed, {len(self)} live in "
+                  f"{len(self.segments)} segments ({time.perf_counter() - start:.1f}s)")
+        return len(new_ids), removed
+
+    def save(self, path=BM25_INDEX_DIR):
+        """Write the index to a directory, replacing an older copy."""
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as meta_file:
+            json.dump({
+                "vocabulary": list(self.vocabulary),
+                "metadata_vocabularies": {column: list(values) for column, values in self.metadata_vocabularies.items()},
+                "num_docs": self.num_docs,
+                "total_length": self.total_length,
+                "segments": len(self.segments),
+            }, meta_file)
+        np.save(os.path.join(tmp_path, "document_frequencies.npy"), self.document_frequencies)
+        for number, segment in enumerate(self.segments):
+            np.savez(os.path.join(tmp_path, f"segment_{number}.npz"), **segment.arrays())
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=BM25_INDEX_DIR):
+        """Read an index written by save()."""
+        index = cls()
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+        index.vocabulary = {token: term for term, token in enumerate(meta["vocabulary"])}
+        index.metadata_vocabularies = {column: {value: code for code, value in enumerate(values)}
+                                       for column, values in meta["metadata_vocabularies"].items()}
+        index.num_docs = meta["num_docs"]
+        index.total_length = meta["total_length"]
+        index.document_frequencies = np.load(os.path.join(path, "document_frequencies.npy"))
+        for number in range(meta["segments"]):
+            with np.load(os.path.join(path, f"segment_{number}.npz")) as arrays:
+                index.segments.append(_Segment.from_arrays(arrays))
+        return index
+
+
+def ground_truth_hits(texts, entry):
+    """Number of ground truth chunks of an eval entry found in texts, matched like retrieval_eval.py."""
+    return sum(1 for ground_truth in entry["ground_truth"] if any(ground_truth["text"] in (text or "") for text in texts))
+
+
+def compare(index, k=10, file_path="eval_dataset.json"):
+    """Compare the lexical branch and hybrid retrieve_n with Postgres full text search and with the BM25 index."""
+    from db_pool import execute_prepared
+    from pgvector_db_funcs import (retrieve_n, filter_query, fetch_texts, FULL_TEXT_CANDIDATES_STATEMENT,
+                                   FULL_TEXT_CANDIDATES_PARAM_TYPES, FULL_TEXT_CANDIDATES_SQL)
+    from llm import extract_query_details
+
+    with open(file_path, 'r') as json_file:
+        data = json.load(json_file)
+
+    postgres_ms, bm25_ms, postgres_recall, bm25_recall = [], [], [], []
+    with connection() as conn:
+        cursor = conn.cursor()
+        for entry in data:
+            details = extract_query_details(entry["query"])
+            filters = ([str(c) for c in details["Companies"]], [str(y) for y in details["Years"]], [str(q) for q in details["Quarters"]])
+            filtered_query = filter_query(entry["query"])
+
+            start = time.perf_counter()
+            execute_prepared(cursor, FULL_TEXT_CANDIDATES_STATEMENT, FULL_TEXT_CANDIDATES_PARAM_TYPES, FULL_TEXT_CANDIDATES_SQL,
+                             (filtered_query, *filters, False, k))
+            postgres_rows = cursor.fetchall()
+            postgres_ms.append((time.perf_counter() - start) * 1000)
+
+            start = time.perf_counter()
+            ids, _ = index.search(filtered_query, k, *filters)
+            bm25_ms.append((time.perf_counter() - start) * 1000)
+
+            postgres_recall.append(ground_truth_hits([row[1] for row in postgres_rows], entry) / len(entry["ground_truth"]))
+            bm25_recall.append(ground_truth_hits(fetch_texts(cursor, ids).values(), entry) / len(entry["ground_truth"]))
+        cursor.close()
+
+    print(f"\nLexical branch alone, {len(data)} eval queries, top {k} with metadata filters")
+    print(f"{'backend':<24}{'mean ms':>10}{'p95 ms':>10}{'recall@k':>10}")
+    print(f"{'postgres ts_rank':<24}{np.mean(postgres_ms):>10.2f}{np.percentile(postgres_ms, 95):>10.2f}{np.mean(postgres_recall):>10.3f}")
+    print(f"{'bm25':<24}{np.mean(bm25_ms):>10.2f}{np.percentile(bm25_ms, 95):>10.2f}{np.mean(bm25_recall):>10.3f}")
+
+    print(f"\nHybrid retrieve_n (candidate_k=200), top 5")
+    print(f"{'lexical branch':<24}{'mean ms':>10}{'recall@5':>10}")
+    for name, backend in (("postgres ts_rank", None), ("bm25", index)):
+        latencies, recalls = [], []
+        for entry in data:
+            details = extract_query_details(entry["query"])
+            start = time.perf_counter()
+            chunks = retrieve_n(entry["query"], 5, details["Companies"], details["Years"], details["Quarters"],
+                                chunk_filter=False, candidate_k=200, lexical_backend=backend) or []
+            latencies.append((time.perf_counter() - start) * 1000)
+            recalls.append(ground_truth_hits([chunk[0] for chunk in chunks], entry) / len(entry["ground_truth"]))
+        print(f"{name:<24}{np.mean(latencies):>10.2f}{np.mean(recalls):>10.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="In-process BM25 index over text_chunks")
+    parser.add_argument("--path", default=BM25_INDEX_DIR, help="index directory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="index every chunk from scratch")
+    subparsers.add_parser("sync", help="add new chunks and drop removed ones")
+    compare_parser = subparsers.add_parser("compare", help="latency and recall against Postgres full text search")
+    compare_parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        compare(BM25Index.load(args.path), k=args.k)
+    else:
+        index = BM25Index() if args.command == "build" or not os.path.exists(args.path) else BM25Index.load(args.path)
+        with connection() as conn:
+            index.sync(conn)
+        index.save(args.path)
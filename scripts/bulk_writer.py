@@ -0,0 +1,327 @@
+import io
+import json
+import struct
+import threading
+import time
+import datetime
+import numpy as np
+import psycopg2
+from funcs import write_debug_log
+from db_schema import chunk_content_hash, bump_corpus_generation
+from chunk_flags import compute_chunk_flags
+
+# Number of buffered chunks that triggers a flush
+BULK_BATCH_SIZE = 256
+# Attempts for a batch that fails with a connection level error before it is split up
+MAX_RETRIES = 3
+# Chunks that could not be written even on their own are appended here so they can be replayed later
+QUARANTINE_FILE = "quarantined_chunks.jsonl"
+
+EMBEDDING_COLUMNS = ("id", "embedding", "company", "year", "document_type", "fiscal_quarter", "chunk_filtered")
+TEXT_COLUMNS = ("id", "text", "company", "year", "document_type", "fiscal_quarter", "content_hash", "source_file",
+                "is_toc", "chunk_kind", "token_length", "chunk_filtered")
+
+# Batches are copied into these session local tables first and then inserted, skipping chunks whose content hash
+# is already stored, so loading the same chunk twice is a no-op.
+_CREATE_STAGING_TABLES = """
+    CREATE TEMP TABLE IF NOT EXISTS embedding_chunks_staging (
+        id bigint, embedding vector(768), company TEXT, year VARCHAR(4), document_type VARCHAR(255), fiscal_quarter VARCHAR(2),
+        chunk_filtered BOOLEAN
+    ) ON COMMIT DELETE ROWS;
+    CREATE TEMP TABLE IF NOT EXISTS text_chunks_staging (
+        id bigint, text TEXT, company TEXT, year VARCHAR(4), document_type VARCHAR(255), fiscal_quarter VARCHAR(2),
+        content_hash TEXT, source_file TEXT, is_toc BOOLEAN, chunk_kind TEXT, token_length INTEGER, chunk_filtered BOOLEAN
+    ) ON COMMIT DELETE ROWS;
+"""
+_INSERT_FROM_STAGING = f"""
+    WITH inserted AS (
+        INSERT INTO text_chunks ({', '.join(TEXT_COLUMNS)})
+        SELECT {', '.join(TEXT_COLUMNS)} FROM text_chunks_staging
+        ON CONFLICT (content_hash) DO NOTHING
+        RETURNING id
+    )
+    INSERT INTO embedding_chunks ({', '.join(EMBEDDING_COLUMNS)})
+    SELECT {', '.join('staging.' + column for column in EMBEDDING_COLUMNS)}
+    FROM embedding_chunks_staging staging JOIN inserted USING (id);
+"""
+
+# Binary COPY framing, see https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_COPY_TRAILER = struct.pack("!h", -1)
+_NULL_FIELD = struct.pack("!i", -1)
+
+
+def _encode_bigint(value):
+    return struct.pack("!iq", 8, value)
+
+
+def _encode_int(value):
+    if value is None:
+        return _NULL_FIELD
+    return struct.pack("!ii", 4, value)
+
+
+def _encode_bool(value):
+    if value is None:
+        return _NULL_FIELD
+    return struct.pack("!i?", 1, bool(value))
+
+
+def _encode_text(value):
+    if value is None:
+        return _NULL_FIELD
+    data = str(value).encode("utf-8")
+    return struct.pack("!i", len(data)) + data
+
+
+def _encode_vector(values):
+    """pgvector binary format: int16 dimensions, int16 unused, then big endian float32 values."""
+    values = np.asarray(values, dtype=">f4").ravel()
+    data = struct.pack("!hh", values.shape[0], 0) + values.tobytes()
+    return struct.pack("!i", len(data)) + data
+
+
+def _copy_buffer(rows, encode_row):
+    buffer = io.BytesIO()
+    buffer.write(_COPY_HEADER)
+    for row in rows:
+        fields = encode_row(row)
+        buffer.write(struct.pack("!h", len(fields)))
+        buffer.write(b"".join(fields))
+    buffer.write(_COPY_TRAILER)
+    buffer.seek(0)
+    return buffer
+
+
+class BulkRow:
+    """One chunk waiting to be written to embedding_chunks and text_chunks."""
+
+    def __init__(self, embedding, chunk, company_name, doc_year, doc_type, fiscal_quarter, chunk_id=None, source_file=None):
+        self.id = chunk_id
+        self.embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        self.chunk = chunk
+        self.company_name = company_name
+        self.doc_year = str(doc_year)
+        self.doc_type = doc_type
+        self.fiscal_quarter = fiscal_quarter
+        self.source_file = source_file
+        self.content_hash = chunk_content_hash(chunk, company_name, self.doc_year, doc_type, fiscal_quarter)
+        # chunk_flags.ChunkFlags, set by the writer for a whole batch at once. None is written as NULL
+        self.flags = None
+
+    def flag(self, name):
+        return getattr(self.flags, name) if self.flags is not None else None
+
+    def embedding_fields(self):
+        return [_encode_bigint(self.id), _encode_vector(self.embedding), _encode_text(self.company_name),
+                _encode_text(self.doc_year), _encode_text(self.doc_type), _encode_text(self.fiscal_quarter),
+                _encode_bool(self.flag("chunk_filtered"))]
+
+    def text_fields(self):
+        return [_encode_bigint(self.id), _encode_text(self.chunk), _encode_text(self.company_name),
+                _encode_text(self.doc_year), _encode_text(self.doc_type), _encode_text(self.fiscal_quarter),
+                _encode_text(self.content_hash), _encode_text(self.source_file), _encode_bool(self.flag("is_toc")),
+                _encode_text(self.flag("chunk_kind")), _encode_int(self.flag("token_length")),
+                _encode_bool(self.flag("chunk_filtered"))]
+
+    def to_json(self, error):
+        return json.dumps({
+            "id": self.id,
+            "embedding": self.embedding.tolist(),
+            "chunk": self.chunk,
+            "company": self.company_name,
+            "year": self.doc_year,
+            "document_type": self.doc_type,
+            "fiscal_quarter": self.fiscal_quarter,
+            "source_file": self.source_file,
+            "error": str(error),
+            "quarantined_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        })
+
+
+class BulkChunkWriter:
+    """Buffers chunks and loads embedding_chunks and text_chunks together with binary COPY.
+
+    Every flush computes the quality flags of its chunks (chunk_flags.py), reserves a block of ids from the
+    embedding_chunks sequence in one round trip, copies both
+    tables into staging tables, inserts the chunks whose content hash is not stored yet and commits once. A batch that fails is retried on connection errors and otherwise split in half
+    until the offending chunks are isolated, those are appended to the quarantine file and the rest is kept.
+
+    Args:
+        conn (psycopg2.connection): open database connection, only used by this writer while it is active
+        batch_size (int, optional): number of buffered chunks that triggers a flush. Defaults to BULK_BATCH_SIZE.
+        max_retries (int, optional): attempts per batch on connection errors. Defaults to MAX_RETRIES.
+        quarantine_file (str, optional): JSON lines file that receives chunks that could not be written.
+    """
+
+    def __init__(self, conn, batch_size=BULK_BATCH_SIZE, max_retries=MAX_RETRIES, quarantine_file=QUARANTINE_FILE):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.quarantine_file = quarantine_file
+        self.rows_written = 0
+        self.batches_written = 0
+        self.retries = 0
+        self.quarantined = 0
+        self.duplicates = 0
+        # Files with at least one quarantined chunk, their manifest entry should not be updated
+        self.quarantined_files = set()
+        # source_file -> content hashes of the chunks added for it, the chunks of an older version of the file that
+        # are not among them are deleted once the new version is written (IngestManifest.remove_chunks)
+        self._file_hashes = {}
+        self._rows = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.flush()
+
+    def add(self, embedding, chunk, company_name, doc_year, doc_type, fiscal_quarter, source_file=None):
+        """Buffer one chunk, flushing when the buffer reaches batch_size."""
+        with self._lock:
+            row = BulkRow(embedding, chunk, company_name, doc_year, doc_type, fiscal_quarter, source_file=source_file)
+            self._rows.append(row)
+            if source_file is not None:
+                self._file_hashes.setdefault(source_file, set()).add(row.content_hash)
+            if len(self._rows) >= self.batch_size:
+                self._flush_locked()
+
+    def flush(self):
+        """Write every buffered chunk. Call at the end of each document."""
+        with self._lock:
+            self._flush_locked()
+
+    def discard(self):
+        """Drop the buffered chunks without writing them, e.g. after the document they belong to failed."""
+        with self._lock:
+            for row in self._rows:
+                self._file_hashes.pop(row.source_file, None)
+            self._rows = []
+            self._rollback()
+
+    def pop_file_hashes(self, source_file):
+        """Content hashes of every chunk added for source_file since the last call, forgets them."""
+        with self._lock:
+            return self._file_hashes.pop(source_file, set())
+
+    def _flush_locked(self):
+        rows, self._rows = self._rows, []
+        if rows:
+            self._write_rows(rows)
+
+    def _reserve_ids(self, cursor, rows):
+        missing = [row for row in rows if row.id is None]
+        if not missing:
+            return
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence('embedding_chunks', 'id')) FROM generate_series(1, %s);",
+            (len(missing),)
+        )
+        for row, (chunk_id,) in zip(missing, cursor.fetchall()):
+            row.id = chunk_id
+
+    def _copy_rows(self, rows):
+        """Load rows into both tables and return the number of chunks that were not already stored."""
+        with self.conn.cursor() as cursor:
+            cursor.execute(_CREATE_STAGING_TABLES)
+            self._reserve_ids(cursor, rows)
+            cursor.copy_expert(
+                f"COPY embedding_chunks_staging ({', '.join(EMBEDDING_COLUMNS)}) FROM STDIN WITH (FORMAT binary)",
+                _copy_buffer(rows, BulkRow.embedding_fields)
+            )
+            cursor.copy_expert(
+                f"COPY text_chunks_staging ({', '.join(TEXT_COLUMNS)}) FROM STDIN WITH (FORMAT binary)",
+                _copy_buffer(rows, BulkRow.text_fields)
+            )
+            cursor.execute(_INSERT_FROM_STAGING)
+            inserted = cursor.rowcount
+            # Batches of duplicates leave the corpus (and every cached retrieval result) as it was
+            if inserted:
+                bump_corpus_generation(cursor)
+        # Both tables land in the same transaction
+        self.conn.commit()
+        return inserted
+
+    def _rollback(self):
+        try:
+            self.conn.rollback()
+        except psycopg2.Error:
+            pass
+
+    def _compute_flags(self, rows):
+        missing = [row for row in rows if row.flags is None]
+        if not missing:
+            return
+        try:
+            for row, flags in zip(missing, compute_chunk_flags([row.chunk for row in missing])):
+                row.flags = flags
+        except Exception as flag_error:
+            # The chunks are still worth writing, backfill_chunk_flags.py picks up their NULL flags
+            write_debug_log(f"Could not compute chunk flags for {len(missing)} chunks: {flag_error}")
+
+    def _write_rows(self, rows):
+        self._compute_flags(rows)
+        error = None
+        for attempt in range(self.max_retries):
+            try:
+                inserted = self._copy_rows(rows)
+                self.rows_written += inserted
+                self.duplicates += len(rows) - inserted
+                self.batches_written += 1
+                return
+            except psycopg2.Error as copy_error:
+                error = copy_error
+                self._rollback()
+                # Only connection level problems are worth retrying as is, bad data fails the same way every time
+                if not isinstance(copy_error, (psycopg2.OperationalError, psycopg2.InterfaceError)) or self.conn.closed:
+                    break
+                self.retries += 1
+                time.sleep(0.5 * 2 ** attempt)
+
+        if len(rows) > 1:
+            # Split the batch so one bad chunk does not take the rest of the file with it
+            middle = len(rows) // 2
+            self._write_rows(rows[:middle])
+            self._write_rows(rows[middle:])
+        else:
+            self._quarantine(rows[0], error)
+
+    def _quarantine(self, row, error):
+        self.quarantined += 1
+        if row.source_file is not None:
+            self.quarantined_files.add(row.source_file)
+        print(f"ERROR committing to the database: {error}")
+        print(f"chunk text: {row.chunk}")
+        write_debug_log(f"ERROR committing to the database: {error}")
+        write_debug_log(f"chunk text: {row.chunk}")
+        with open(self.quarantine_file, "a") as file:
+            file.write(row.to_json(error) + "\n")
+
+    def replay_quarantine(self):
+        """Try to write every quarantined chunk again. Chunks that still fail are written back to the quarantine file.
+
+        Returns:
+            int: number of chunks written
+        """
+        try:
+            with open(self.quarantine_file, "r") as file:
+                entries = [json.loads(line) for line in file if line.strip()]
+        except FileNotFoundError:
+            return 0
+        # Start a fresh quarantine file, failing chunks are appended to it again by _quarantine()
+        open(self.quarantine_file, "w").close()
+        written_before = self.rows_written
+        with self._lock:
+            self._flush_locked()
+            rows = [BulkRow(entry["embedding"], entry["chunk"], entry["company"], entry["year"],
+                            entry["document_type"], entry["fiscal_quarter"], chunk_id=entry["id"],
+                            source_file=entry.get("source_file")) for entry in entries]
+            for start in range(0, len(rows), self.batch_size):
+                self._write_rows(rows[start:start + self.batch_size])
+        return self.rows_written - written_before
+
+    def summary(self):
+        return (f"{self.rows_written} chunks written in {self.batches_written} batches, "
+                f"{self.duplicates} duplicates skipped, {self.retries} retries, {self.quarantined} quarantined")
@@ -0,0 +1,104 @@
+import re
+from collections import namedtuple
+from model_registry import get_tokenizer
+
+# Quality flags of a chunk. They only depend on the chunk text, so they are computed once when the chunk is written
+# (bulk_writer.py) and stored next to it instead of being re-derived by retrieve_n() on every query:
+#   is_toc          the chunk is a table of contents (is_table_of_contents())
+#   chunk_kind      "table" for markdown tables, "prose" for everything else
+#   token_length    FinBERT tokens including special tokens, same count as chunking.num_tokens()
+#   chunk_filtered  remove_doc() says the chunk should never be retrieved with chunk_filter on
+#
+# backfill_chunk_flags.py computes them for rows written before the columns existed.
+
+TABLE = "table"
+PROSE = "prose"
+
+ChunkFlags = namedtuple("ChunkFlags", ["is_toc", "chunk_kind", "token_length", "chunk_filtered"])
+
+# Typical TOC keywords in the body of a table of contents
+_TOC_KEYWORDS = [
+    r'Financial Statements',
+    r'\bManagement’s Discussion\b',
+    r'Risk Factor',
+    r'\bControls and Procedures\b',
+    r'\bLegal Proceedings\b',
+    r'\bExhibits\b',
+    r'\bQuantitative and Qualitative Disclosures\b',
+    r'\bPart\s+[IVX]+',
+    r'\bSignatures\b',
+]
+
+def is_table_of_contents(table_text, debug = False):
+    """
+    Determine if a given markdown table represents a table of contents.
+
+    Parameters:
+        table_text (str): Markdown representation of a table.
+
+    Returns:
+        bool: True if it is a table of contents, False otherwise.
+    """
+    # Normalize whitespace
+    table_text = re.sub(r'\s+', ' ', table_text.strip())
+
+    # Check for Markdown table formatting or list-based structure
+    is_markdown_table = bool(re.search(r'\|.*?\|.*?\|', table_text))  # At least three columns
+    is_list_structure = bool(re.search(r'-\s+\*\*Item \d+[A-Z]?\.\*\*', table_text))  # Detect list-based items
+
+    # Check for key columns in the header
+    has_item_column = bool(re.search(r'\b(Item|Section)\b', table_text, re.IGNORECASE))
+
+    # Check for typical TOC keywords in the body
+    has_toc_keywords = any(re.search(keyword, table_text, re.IGNORECASE) for keyword in _TOC_KEYWORDS)
+
+    # Determine if the table is a TOC
+    return (is_markdown_table or is_list_structure) and has_item_column and has_toc_keywords
+
+
+def remove_doc(document_text, verbose = False, is_toc = None):
+    """Function to use various heuristics and regex establish whether to filter out chunks.
+
+    Args:
+        document_text (str): chunk to filter. Defaults to "".
+        verbose (bool, optional): Flag to print debugging and other print statements to command line. Defaults to False.
+        is_toc (bool, optional): is_table_of_contents() of the chunk if the caller already has it. Defaults to None.
+
+    Returns:
+        filter bool: True if doc should be removed, false if otherwise
+    """
+
+    is_TOC = is_toc if is_toc is not None else is_table_of_contents(document_text)
+
+    return is_TOC
+
+
+def chunk_kind(text):
+    """TABLE if most non-empty lines are markdown table rows, PROSE otherwise."""
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    table_lines = sum(1 for line in lines if line.startswith('|'))
+    return TABLE if lines and table_lines * 2 >= len(lines) else PROSE
+
+
+def compute_chunk_flags(texts, tokenizer=None):
+    """Quality flags of several chunks, tokenized in one batch.
+
+    Args:
+        texts (list(str)): chunk texts as stored in text_chunks
+        tokenizer (PreTrainedTokenizerFast, optional): tokenizer for token_length. Defaults to the shared FinBERT tokenizer.
+
+    Returns:
+        list(ChunkFlags): flags of every text
+    """
+    if not texts:
+        return []
+    if tokenizer is None:
+        tokenizer = get_tokenizer()
+    texts = [text or "" for text in texts]
+    # No truncation, long tables should report their real length
+    token_ids = tokenizer(texts, add_special_tokens=True, verbose=False)["input_ids"]
+    flags = []
+    for text, ids in zip(texts, token_ids):
+        is_toc = is_table_of_contents(text)
+        flags.append(ChunkFlags(is_toc, chunk_kind(text), len(ids), remove_doc(text, is_toc=is_toc)))
+    return flags
@@ -1,33 +1,73 @@
-from transformers import AutoTokenizer
 import ollama
+import asyncio
 import re
 from funcs import write_debug_log
 import math
+import threading
+from bisect import bisect_left
+from collections import namedtuple
+from summary_cache import TableSummaryCache
+from model_registry import get_tokenizer
 
 # Initialize the Ollama client
 client = ollama.Client()
 
-# Load the tokenizer and the base model (without classification head)
-tokenizer = AutoTokenizer.from_pretrained("yiyanghkust/finbert-tone")
+# The FinBERT tokenizer is loaded on first use and shared with embedding_gen, chunking.tokenizer still works
+def __getattr__(name):
+    if name == "tokenizer":
+        return get_tokenizer()
+    if name == "summary_cache":
+        return get_summary_cache()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Both in tokens
 MAX_CHUNK_LEN = 512
 MIN_CHUNK_LEN = 300
 DEBUG = False
 
-def summarize_table(table, section_buffer):
+# Recorded in the ingestion manifest for every file, bump it whenever a change here alters chunk boundaries so that
+# the next ingestion run re-chunks every filing
+CHUNKER_VERSION = "1"
+
+# Model used for table summaries. Bump SUMMARY_PROMPT_VERSION whenever the prompt below changes so that cached
+# summaries from the old prompt are no longer used.
+SUMMARY_MODEL = "llama3.2:1b"
+SUMMARY_PROMPT_VERSION = "1"
+
+# chunk_markdown() summarizes up to SUMMARY_CONCURRENCY tables at once. Every request gets SUMMARY_TIMEOUT seconds
+# and is retried SUMMARY_RETRIES times (with exponential backoff) before the error is raised.
+SUMMARY_CONCURRENCY = 4
+SUMMARY_TIMEOUT = 120.0
+SUMMARY_RETRIES = 2
+
+# Summaries are reused across ingestion runs. The cache file is opened by the first table that needs a summary,
+# set chunking.summary_cache = None to always call the LLM
+_summary_cache_lock = threading.Lock()
+
+def get_summary_cache():
+    """Shared table summary cache (chunking.summary_cache), opened on the first call. None if it was disabled."""
+    if "summary_cache" not in globals():
+        with _summary_cache_lock:
+            if "summary_cache" not in globals():
+                globals()["summary_cache"] = TableSummaryCache()
+    return globals()["summary_cache"]
+
+# Table whose summary has not been generated yet. Yielded by iter_markdown_chunks() when summarization is deferred
+# so that the caller can summarize it later with summarize_table(table, context).
+PendingTable = namedtuple("PendingTable", ["table", "context"])
+
+def build_summary_prompt(table, section_buffer):
     """
-    Uses Ollama3.1 to create a summary for a table 
+    Build the prompt used to summarize a table
 
     Args:
         table str: markdown representation of the table
         section_buffer list(str): list of previous lines from section table was taken from
 
     Returns:
-        strings list(str): list of strings
+        message str: prompt for the summary model
     """
-    
-    message = f"""Below you are given a table and preceding context from a 10Q/10K financial document. 
+    return f"""Below you are given a table and preceding context from a 10Q/10K financial document. 
     Both are in markdown format. Give a concise 1 to 3 sentence description of the table based on 
     the column names, row names, and preceding context in 200 or less words.
     Do not include any specifics about the values from the table.
@@ -47,12 +87,119 @@ def summarize_table(table, section_buffer):
     </table>
     
     """
+
+def summarize_table(table, section_buffer):
+    """
+    Uses Ollama3.1 to create a summary for a table. Summaries of tables seen in earlier runs come from summary_cache.
+
+    Args:
+        table str: markdown representation of the table
+        section_buffer list(str): list of previous lines from section table was taken from
+
+    Returns:
+        strings list(str): list of strings
+    """
+    
+    message = build_summary_prompt(table, section_buffer)
+
+    def generate():
+        response = ollama.chat(model=SUMMARY_MODEL, messages=[{'role': 'user', 'content': message,},])
+        log_table_summary(table, section_buffer, response["message"]["content"])
+        return response["message"]["content"]
+
+    summary_cache = get_summary_cache()
+    if summary_cache is None:
+        return generate()
+    return summary_cache.get_or_compute(message, SUMMARY_MODEL, SUMMARY_PROMPT_VERSION, generate)
+
+def log_table_summary(table, section_buffer, summary):
     write_debug_log(f"context: {' '.join(section_buffer)}\n\n\n",log_file="chunking_test_log.md", with_timestamp=False)
     write_debug_log(f"table: {table}\n\n\n",log_file="chunking_test_log.md", with_timestamp=False)
-    response = ollama.chat(model='llama3.2:1b', messages=[{'role': 'user', 'content': message,},])
-    write_debug_log(f"summary: {response['message']['content']}\n\n\n",log_file="chunking_test_log.md", with_timestamp=False)
+    write_debug_log(f"summary: {summary}\n\n\n",log_file="chunking_test_log.md", with_timestamp=False)
     write_debug_log(message="-"*128,log_file="chunking_test_log.md", with_timestamp=False)
-    return response["message"]["content"]
+
+async def summarize_table_async(client, semaphore, table, section_buffer, timeout=SUMMARY_TIMEOUT, retries=SUMMARY_RETRIES):
+    """
+    Asynchronous summarize_table(), at most as many requests as the semaphore allows are sent at once
+
+    Args:
+        client ollama.AsyncClient: client to send the request with
+        semaphore asyncio.Semaphore: limits the number of requests in flight
+        table str: markdown representation of the table
+        section_buffer list(str): list of previous lines from section table was taken from
+        timeout float: seconds one request may take before it is cancelled and retried
+        retries int: number of retries after the first attempt
+
+    Returns:
+        summary str: table summary
+    """
+    message = build_summary_prompt(table, section_buffer)
+    summary_cache = get_summary_cache()
+    if summary_cache is not None:
+        summary = summary_cache.get(message, SUMMARY_MODEL, SUMMARY_PROMPT_VERSION)
+        if summary is not None:
+            return summary
+
+    for attempt in range(retries + 1):
+        try:
+            async with semaphore:
+                response = await asyncio.wait_for(
+                    client.chat(model=SUMMARY_MODEL, messages=[{'role': 'user', 'content': message,},]),
+                    timeout=timeout
+                )
+            break
+        except Exception as error:
+            if attempt == retries:
+                raise
+            write_debug_log(f"Table summary attempt {attempt + 1} failed ({type(error).__name__}: {error}), retrying")
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+    summary = response["message"]["content"]
+    log_table_summary(table, section_buffer, summary)
+    if summary_cache is not None:
+        summary_cache.put(message, SUMMARY_MODEL, SUMMARY_PROMPT_VERSION, summary)
+    return summary
+
+async def summarize_tables_async(pending_tables, concurrency=SUMMARY_CONCURRENCY, timeout=SUMMARY_TIMEOUT, retries=SUMMARY_RETRIES):
+    """
+    Summarize a list of PendingTable concurrently
+
+    Args:
+        pending_tables list(PendingTable): tables to summarize
+        concurrency int: max number of requests in flight
+        timeout float: seconds one request may take
+        retries int: number of retries per table
+
+    Returns:
+        summaries list(str): summary of every table, in the order of pending_tables
+    """
+    client = ollama.AsyncClient()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    return await asyncio.gather(*[
+        summarize_table_async(client, semaphore, pending.table, pending.context, timeout=timeout, retries=retries)
+        for pending in pending_tables
+    ])
+
+def summarize_pending_tables(chunks, concurrency=SUMMARY_CONCURRENCY, timeout=SUMMARY_TIMEOUT, retries=SUMMARY_RETRIES):
+    """
+    Replace every PendingTable in chunks with its (table, summary) pair, keeping the order of the chunks
+
+    Args:
+        chunks list: output of iter_markdown_chunks(summarize_tables=False)
+        concurrency int: max number of summary requests in flight
+        timeout float: seconds one request may take
+        retries int: number of retries per table
+
+    Returns:
+        chunks list: the same list with all tables summarized
+    """
+    positions = [i for i, chunk in enumerate(chunks) if isinstance(chunk, PendingTable)]
+    if not positions:
+        return chunks
+    summaries = asyncio.run(summarize_tables_async([chunks[i] for i in positions], concurrency, timeout, retries))
+    for i, summary in zip(positions, summaries):
+        chunks[i] = (chunks[i].table, summary)
+    return chunks
 
 def check_nearest_punctuation(strlist, front = True):
     """
@@ -123,7 +270,50 @@ def split_section(text, num_chunks):
 
     return ret
 
-def verify_chunks(chunks_list, max_chunk_length):
+class SectionTokenCounter:
+    """
+    Token counts for the words of one section, computed with a single pass of the fast tokenizer
+
+    BERT tokenization never crosses whitespace, so the token count of any text made of whole words from the section
+    is the sum of the counts of its words plus the special tokens that encode() adds. This lets the chunker size
+    chunks by arithmetic instead of re-encoding them after every change.
+
+    Args:
+        text str: section text
+        my_tokenizer PreTrainedTokenizerFast: tokenizer to count tokens with
+    """
+
+    def __init__(self, text, my_tokenizer=None):
+        if my_tokenizer is None:
+            my_tokenizer = get_tokenizer()
+        self.tokenizer = my_tokenizer
+        self.special_tokens = my_tokenizer.num_special_tokens_to_add()
+        self.word_counts = {}
+        if my_tokenizer.is_fast:
+            offsets = my_tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+            token_starts = [start for start, end in offsets]
+            # Every token belongs to the whitespace separated word its first character falls into
+            for word in re.finditer(r'\S+', text):
+                count = bisect_left(token_starts, word.end()) - bisect_left(token_starts, word.start())
+                self.word_counts.setdefault(word.group(), count)
+
+    def word_tokens(self, text):
+        """Number of tokens in text without special tokens"""
+        total = 0
+        for word in text.split():
+            count = self.word_counts.get(word)
+            if count is None:
+                # Word that did not appear in the section (or slow tokenizer), count it on its own once
+                count = len(self.tokenizer.encode(word, add_special_tokens=False))
+                self.word_counts[word] = count
+            total += count
+        return total
+
+    def count(self, text):
+        """Same result as num_tokens(text, tokenizer)"""
+        return self.word_tokens(text) + self.special_tokens
+
+def verify_chunks(chunks_list, max_chunk_length, counter=None):
     """
     Take a list of chunks returned by split_section() and verify that they are valid sizes. If they are not, 
     perform manipulation to make the chunks fit the desired size. 
@@ -131,15 +321,19 @@ def verify_chunks(chunks_list, max_chunk_length):
     Args:
         chunks_list list(str): list of chunks in string format
         max_chunk_length int: max length of chunk that can be handled in terms of number of tokens
-        overlap float: float indicating how much of each chunk to overlap
+        counter SectionTokenCounter: token counter built from the section the chunks were split from
 
     Returns:
         chunks_list list(str): list of chunks in string format that have been verified and corrected
         bool: T/F statement that tells whether the returned chunks_list contains all valid chunks or not
     """
+    if counter is None:
+        counter = SectionTokenCounter(" ".join(chunks_list))
     
     for i in range(len(chunks_list)):
-        check_token_len = num_tokens(chunks_list[i], tokenizer)
+        check_token_len = counter.count(chunks_list[i])
+        # Running token count of chunk i, sentences only ever get added so their counts can be summed up
+        chunk_len = check_token_len
         # If under min token length, grab sentences from neighboring chunks to make chunk larger
         if(check_token_len < MIN_CHUNK_LEN):
             # If first chunk, grab sentence from next chunk
@@ -148,7 +342,8 @@ def verify_chunks(chunks_list, max_chunk_length):
                 # keep grabbing sentences until chunk is long enough
                 for sentence in sentences:
                     chunks_list[i] += " " + sentence
-                    if (num_tokens(chunks_list[i], tokenizer) > MIN_CHUNK_LEN):
+                    chunk_len += counter.word_tokens(sentence)
+                    if (chunk_len > MIN_CHUNK_LEN):
                         break
             # If Last chunk, grab from previous chunk
             elif(i >= len(chunks_list)-1):
@@ -156,7 +351,8 @@ def verify_chunks(chunks_list, max_chunk_length):
                 # keep grabbing sentences until chunk is long enough
                 for sentence in reversed(sentences):
                     chunks_list[i] = sentence + " " + chunks_list[i]
-                    if (num_tokens(chunks_list[i], tokenizer) > MIN_CHUNK_LEN):
+                    chunk_len += counter.word_tokens(sentence)
+                    if (chunk_len > MIN_CHUNK_LEN):
                         break
             # If chunk in the middle, take shortest sentence from either neighboring chunk
             else:  
@@ -165,13 +361,15 @@ def verify_chunks(chunks_list, max_chunk_length):
                 while(len(before_sentences) > 0 and len(after_sentences) > 0):
                     if(len(before_sentences[-1]) > len(after_sentences[0])):
                         chunks_list[i] += " " + after_sentences[0]
+                        chunk_len += counter.word_tokens(after_sentences[0])
                         after_sentences.pop(0)
-                        if (num_tokens(chunks_list[i], tokenizer) > MIN_CHUNK_LEN):
+                        if (chunk_len > MIN_CHUNK_LEN):
                             break
                     else:
                         chunks_list[i] = before_sentences[-1] + " " + chunks_list[i]
+                        chunk_len += counter.word_tokens(before_sentences[-1])
                         before_sentences.pop(-1)
-                        if (num_tokens(chunks_list[i], tokenizer) > MIN_CHUNK_LEN):
+                        if (chunk_len > MIN_CHUNK_LEN):
                             break
         # If chunk is too large, set flag so that c+1 chunking can happen
         if(check_token_len > max_chunk_length ):
@@ -192,7 +390,9 @@ def chunk_section(section_buffer, max_chunk_length, overlap=0.2):
     """
     # TODO: implement overlap
     text = " ".join(section_buffer)
-    token_len = num_tokens(text, tokenizer)
+    # The only tokenizer pass over this section, every other length is derived from it
+    counter = SectionTokenCounter(text)
+    token_len = counter.count(text)
     if (token_len > max_chunk_length):
         
         correct_chunking = True
@@ -202,7 +402,7 @@ def chunk_section(section_buffer, max_chunk_length, overlap=0.2):
         # try to chunk for c chunks
         ret_chunks = split_section(text, c)
         
-        ret_chunks, correct_chunking = verify_chunks(ret_chunks, max_chunk_length)
+        ret_chunks, correct_chunking = verify_chunks(ret_chunks, max_chunk_length, counter)
         
         if(not correct_chunking):
             # increment chunks by 1
@@ -210,7 +410,7 @@ def chunk_section(section_buffer, max_chunk_length, overlap=0.2):
             # try to chunk for c chunks
             ret_chunks = split_section(text, c)
             
-            ret_chunks, correct_chunking = verify_chunks(ret_chunks, max_chunk_length)
+            ret_chunks, correct_chunking = verify_chunks(ret_chunks, max_chunk_length, counter)
             if(not correct_chunking):
                 print("Need to implement a third case to split sentences so chunks dont overflow")
                 raise
@@ -325,20 +525,20 @@ def add_line(buffer, line):
     if (not line == None and line.strip()):
         buffer.append(line)
 
-def chunk_markdown(md_text, max_chunk_length, verbose=False):
+def iter_markdown_chunks(md_text, max_chunk_length, summarize_tables=True, verbose=False):
     """
-    Chunk the passed markdown text
+    Chunk the passed markdown text, yielding each chunk as soon as it is complete
 
     Args:
         md_text str: entire markdown text in string format
         max_chunk_length int: max length of chunk tht can be handled in terms of number of tokens
+        summarize_tables bool: whether to summarize tables inline. If False, tables are yielded as PendingTable
         verbose bool: whether to show additional output
 
-    Returns:
-        chunks list(str): full list of chunks from the md file
+    Yields:
+        chunk str | tuple(str, str) | PendingTable: text chunk, (table, summary) pair or table waiting for a summary
     """
     lines = iter(md_text.split('\n'))
-    chunks = []
     section_buffer = []
     
     if verbose:
@@ -383,22 +583,18 @@ def chunk_markdown(md_text, max_chunk_length, verbose=False):
             #     # If so, continue parsing to add the next section
             #     add_line(section_buffer, line)
             #     continue
-            # Check section length to prevent large chunk sizes
-            if(num_tokens(" ".join(section_buffer), tokenizer) > max_chunk_length):
-                # if so break into smaller chunks
-                chunks.extend(chunk_section(section_buffer, max_chunk_length))
-                section_buffer = []
-                add_line(section_buffer, line)
-            # If section length is in less than max length, add to chunks and continue
-            else: 
-                chunks.extend(chunk_section(section_buffer, max_chunk_length))
-                section_buffer = []
-                add_line(section_buffer, line)
+            # chunk_section() breaks sections that are too large into smaller chunks and keeps the rest whole
+            yield from chunk_section(section_buffer, max_chunk_length)
+            section_buffer = []
+            add_line(section_buffer, line)
             
          # if not check if line is a table
         elif is_table(line):
             table_chunk, line = handle_table(lines, line)
-            chunks.append((table_chunk, summarize_table(table_chunk, section_buffer)))
+            if summarize_tables:
+                yield (table_chunk, summarize_table(table_chunk, section_buffer))
+            else:
+                yield PendingTable(table_chunk, list(section_buffer))
             table_parsed = True
         # Otherwise, line must be a normal text line, so add it to the section bufer
         else:
@@ -408,8 +604,23 @@ def chunk_markdown(md_text, max_chunk_length, verbose=False):
 
     # Final flush for any remaining paragraph
     if section_buffer:
-        chunks.extend(chunk_section(section_buffer, max_chunk_length))
-    return chunks
+        yield from chunk_section(section_buffer, max_chunk_length)
+
+def chunk_markdown(md_text, max_chunk_length, verbose=False, summary_concurrency=SUMMARY_CONCURRENCY):
+    """
+    Chunk the passed markdown text. Tables are summarized concurrently once the whole text is chunked.
+
+    Args:
+        md_text str: entire markdown text in string format
+        max_chunk_length int: max length of chunk tht can be handled in terms of number of tokens
+        verbose bool: whether to show additional output
+        summary_concurrency int: max number of table summary requests in flight
+
+    Returns:
+        chunks list(str): full list of chunks from the md file
+    """
+    chunks = list(iter_markdown_chunks(md_text, max_chunk_length, summarize_tables=False, verbose=verbose))
+    return summarize_pending_tables(chunks, concurrency=summary_concurrency)
 
 
 # FOR TESTING PURPOSES
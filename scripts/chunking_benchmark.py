@@ -0,0 +1,112 @@
+import argparse
+import math
+import re
+import time
+import chunking
+from chunking import iter_markdown_chunks, split_section, num_tokens, tokenizer, MIN_CHUNK_LEN, MAX_CHUNK_LEN
+
+# Compare the chunker before and after the single tokenizer pass per section. The previous implementation
+# re-encoded every chunk after each sentence it moved, the current one sizes chunks from SectionTokenCounter.
+# Tables are not summarized so the timings only contain chunking work.
+#
+# Usage:
+#   python chunking_benchmark.py path/to/10K-2023.pdf.md --repeats 3
+
+
+def legacy_verify_chunks(chunks_list, max_chunk_length):
+    """verify_chunks() as it was before SectionTokenCounter, kept here as the baseline."""
+    for i in range(len(chunks_list)):
+        check_token_len = num_tokens(chunks_list[i], tokenizer)
+        if(check_token_len < MIN_CHUNK_LEN):
+            if(i == 0):
+                sentences = re.split(r'(?<=[.!?])\s+', chunks_list[i+1].strip())
+                for sentence in sentences:
+                    chunks_list[i] += " " + sentence
+                    if (num_tokens(chunks_list[i], tokenizer) > MIN_CHUNK_LEN):
+                        break
+            elif(i >= len(chunks_list)-1):
+                sentences = re.split(r'(?<=[.!?])\s+', chunks_list[i-1].strip())
+                for sentence in reversed(sentences):
+                    chunks_list[i] = sentence + " " + chunks_list[i]
+                    if (num_tokens(chunks_list[i], tokenizer) > MIN_CHUNK_LEN):
+                        break
+            else:
+                before_sentences = re.split(r'(?<=[.!?])\s+', chunks_list[i-1].strip())
+                after_sentences = re.split(r'(?<=[.!?])\s+', chunks_list[i+1].strip())
+                while(len(before_sentences) > 0 and len(after_sentences) > 0):
+                    if(len(before_sentences[-1]) > len(after_sentences[0])):
+                        chunks_list[i] += " " + after_sentences[0]
+                        after_sentences.pop(0)
+                        if (num_tokens(chunks_list[i], tokenizer) > MIN_CHUNK_LEN):
+                            break
+                    else:
+                        chunks_list[i] = before_sentences[-1] + " " + chunks_list[i]
+                        before_sentences.pop(-1)
+                        if (num_tokens(chunks_list[i], tokenizer) > MIN_CHUNK_LEN):
+                            break
+        if(check_token_len > max_chunk_length):
+            return chunks_list, False
+    return chunks_list, True
+
+
+def legacy_chunk_section(section_buffer, max_chunk_length, overlap=0.2):
+    """chunk_section() as it was before SectionTokenCounter, including the length check the caller used to do."""
+    text = " ".join(section_buffer)
+    # the section was encoded once in iter_markdown_chunks and once more here
+    num_tokens(text, tokenizer)
+    token_len = num_tokens(text, tokenizer)
+    if (token_len > max_chunk_length):
+        c = math.ceil(token_len / max_chunk_length)
+        ret_chunks, correct_chunking = legacy_verify_chunks(split_section(text, c), max_chunk_length)
+        if(not correct_chunking):
+            ret_chunks, correct_chunking = legacy_verify_chunks(split_section(text, c + 1), max_chunk_length)
+            if(not correct_chunking):
+                raise ValueError("Need to implement a third case to split sentences so chunks dont overflow")
+        return ret_chunks
+    else:
+        return [text]
+
+
+def chunk_texts(md_text, max_chunk_length):
+    # Tables come out as PendingTable placeholders, only compare their raw markdown
+    return [chunk if isinstance(chunk, str) else chunk.table
+            for chunk in iter_markdown_chunks(md_text, max_chunk_length, summarize_tables=False)]
+
+
+def best_time(fn, repeats):
+    best = float("inf")
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the legacy and the token arithmetic chunker on one filing")
+    parser.add_argument("md_file", help="markdown filing to chunk, e.g. a 10-K from md_files/")
+    parser.add_argument("--max-chunk-length", type=int, default=MAX_CHUNK_LEN)
+    parser.add_argument("--repeats", type=int, default=3, help="runs per measurement, the best one is reported")
+    args = parser.parse_args()
+
+    with open(args.md_file, 'r', encoding='utf-8') as file:
+        md_text = file.read()
+
+    current_chunk_section = chunking.chunk_section
+    chunking.chunk_section = legacy_chunk_section
+    try:
+        legacy_seconds, legacy_chunks = best_time(lambda: chunk_texts(md_text, args.max_chunk_length), args.repeats)
+    finally:
+        chunking.chunk_section = current_chunk_section
+    current_seconds, current_chunks = best_time(lambda: chunk_texts(md_text, args.max_chunk_length), args.repeats)
+
+    print(f"{args.md_file}: {len(md_text)} characters, {len(current_chunks)} chunks")
+    print(f"{'legacy':<10}{legacy_seconds * 1000:>10.1f} ms")
+    print(f"{'current':<10}{current_seconds * 1000:>10.1f} ms")
+    print(f"speedup {legacy_seconds / current_seconds:.1f}x, identical chunks: {legacy_chunks == current_chunks}")
+    if legacy_chunks != current_chunks:
+        for i, (old, new) in enumerate(zip(legacy_chunks, current_chunks)):
+            if old != new:
+                print(f"first difference at chunk {i}:\n  legacy:  {old[:200]}\n  current: {new[:200]}")
+                break
@@ -0,0 +1,125 @@
+import argparse
+import json
+import time
+import numpy as np
+from db_pool import connection, execute_prepared
+from db_schema import COMPACT_COLUMNS, ensure_compact_columns
+from pgvector_db_funcs import COMPACT_MODES, COMPACT_PARAM_TYPES, compact_search_sql
+from vector_index import apply_search_settings, build_index, index_status, timed_search, DEFAULT_EF_SEARCH
+
+# Compact vector storage for the vector branch of retrieve_n. embedding_chunks gets a normalized halfvec copy and a
+# binary quantized copy of every embedding (generated columns, so they are written together with the row), retrieval
+# ranks the compact codes first and reranks the best candidates on the full precision vectors.
+#
+# Usage:
+#   python compact_vectors.py migrate                     (adds the columns, rewrites embedding_chunks once)
+#   python compact_vectors.py migrate --index hnsw        (also builds an ANN index on each compact column)
+#   python compact_vectors.py report --k 10 --rerank-k 50,100,200
+#
+# retrieve_n(query, compact_mode="half") or compact_mode="binary" uses them.
+
+
+def storage_report(conn):
+    """Print the size of each vector column and of the indexes on embedding_chunks."""
+    columns = ["embedding", *COMPACT_COLUMNS]
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT count(*), {', '.join(f'coalesce(sum(pg_column_size({column})), 0)' for column in columns)},
+                pg_table_size('embedding_chunks')
+            FROM embedding_chunks;
+        """)
+        row = cursor.fetchone()
+    num_rows, column_bytes, table_bytes = row[0], row[1:-1], row[-1]
+    print(f"\nembedding_chunks: {num_rows} rows, table {table_bytes / 1024 ** 2:.1f} MB")
+    print(f"{'column':<20}{'MB':>10}{'bytes/row':>12}")
+    for column, size in zip(columns, column_bytes):
+        print(f"{column:<20}{size / 1024 ** 2:>10.1f}{size / num_rows if num_rows else 0:>12.0f}")
+    print(f"\n{'index':<45}{'size':>12}")
+    for name, definition, size in index_status(conn):
+        print(f"{name:<45}{size:>12}")
+
+
+def timed_compact_search(conn, mode, embedding_string, filters, k, rerank_k, ef_search=None):
+    """Run the compact first pass plus exact rerank and return (ids, milliseconds)."""
+    statement, sql = compact_search_sql(mode)
+    cursor = conn.cursor()
+    try:
+        apply_search_settings(cursor, ef_search=max(ef_search or DEFAULT_EF_SEARCH, rerank_k))
+        start = time.perf_counter()
+        execute_prepared(cursor, statement, COMPACT_PARAM_TYPES, sql, (embedding_string, *filters, False, rerank_k, k))
+        ids = [row[0] for row in cursor.fetchall()]
+        return ids, (time.perf_counter() - start) * 1000
+    finally:
+        cursor.close()
+        conn.rollback()
+
+
+def compact_report(k=10, rerank_values=(50, 100, 200), file_path="eval_dataset.json", use_filters=True):
+    """Compare exact full precision search with the compact modes on the eval dataset queries.
+
+    Prints the storage of every column and index, then mean / p95 latency and recall@k against the exact top k
+    (sequential scan on the full precision column, i.e. the current schema) for every mode and rerank_k.
+    """
+    from embedding_gen import generate_embedding
+    from llm import extract_query_details
+
+    with open(file_path, 'r') as json_file:
+        queries = [entry["query"] for entry in json.load(json_file)]
+
+    with connection() as conn:
+        storage_report(conn)
+
+        prepared = []
+        for query in queries:
+            embedding = generate_embedding(text=query)
+            embedding_string = '[' + ','.join(map(str, embedding[0])) + ']'
+            details = extract_query_details(query) if use_filters else {"Companies": [], "Years": [], "Quarters": []}
+            filters = ([str(c) for c in details["Companies"]], [str(y) for y in details["Years"]], [str(q) for q in details["Quarters"]])
+            exact_ids, exact_ms = timed_search(conn, embedding_string, filters, k, exact=True)
+            prepared.append((embedding_string, filters, exact_ids, exact_ms))
+
+        exact_latencies = np.array([entry[3] for entry in prepared])
+        print(f"\n{len(queries)} eval queries, k={k}")
+        print(f"{'search':<24}{'mean ms':>10}{'p95 ms':>10}{'recall@k':>10}")
+        print(f"{'exact full precision':<24}{exact_latencies.mean():>10.2f}{np.percentile(exact_latencies, 95):>10.2f}{1.0:>10.3f}")
+
+        for mode in COMPACT_MODES:
+            for rerank_k in rerank_values:
+                latencies = []
+                recalls = []
+                for embedding_string, filters, exact_ids, _ in prepared:
+                    ids, ms = timed_compact_search(conn, mode, embedding_string, filters, k, rerank_k)
+                    latencies.append(ms)
+                    if exact_ids:
+                        recalls.append(len(set(ids) & set(exact_ids)) / len(exact_ids))
+                name = f"{mode} rerank_k={rerank_k}"
+                print(f"{name:<24}{np.mean(latencies):>10.2f}{np.percentile(latencies, 95):>10.2f}{np.mean(recalls):>10.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact (halfvec / binary) embedding columns with exact rerank")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="add the compact columns to embedding_chunks")
+    migrate_parser.add_argument("--index", choices=["hnsw", "ivfflat"], default=None, help="also index the compact columns")
+
+    report_parser = subparsers.add_parser("report", help="storage, latency and recall@k of the compact modes on eval_dataset.json")
+    report_parser.add_argument("--k", type=int, default=10)
+    report_parser.add_argument("--rerank-k", default="50,100,200", help="comma separated rerank candidate counts")
+    report_parser.add_argument("--no-filters", action="store_true", help="ignore the company/year/quarter filters of the queries")
+
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        with connection() as conn:
+            ensure_compact_columns(conn)
+            if args.index:
+                for column in COMPACT_COLUMNS:
+                    build_index(conn, method=args.index, column=column)
+            storage_report(conn)
+    else:
+        compact_report(
+            k=args.k,
+            rerank_values=[int(value) for value in args.rerank_k.split(",")],
+            use_filters=not args.no_filters,
+        )
@@ -0,0 +1,142 @@
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import pool, extensions
+
+# Connection parameters for pgvector
+host = "localhost"         # Hostname (since you've mapped the container port)
+port = "5432"              # Port you mapped (5432)
+dbname = "vectordb"     # Name of your database
+user = "admin"           # Username you provided during setup
+password = "adminpass"   # Password you provided during setup
+
+# Pool sizing. Borrowers wait up to POOL_TIMEOUT seconds when all POOL_MAX_SIZE connections are in use.
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 10
+POOL_TIMEOUT = 30.0
+# Connections that have been idle for longer than this are checked with SELECT 1 before they are handed out
+HEALTH_CHECK_INTERVAL = 30.0
+
+_pool = None
+_pool_slots = None
+_pool_lock = threading.RLock()
+
+
+class PooledConnection(extensions.connection):
+    """psycopg2 connection that remembers which statements are prepared on it and when it was last used."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+        self.last_used = time.monotonic()
+
+
+def init_pool(min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, **connect_kwargs):
+    """Create (or recreate) the process wide connection pool.
+
+    Args:
+        min_size (int, optional): connections opened up front. Defaults to POOL_MIN_SIZE.
+        max_size (int, optional): max number of open connections. Defaults to POOL_MAX_SIZE.
+        **connect_kwargs: extra or overriding psycopg2.connect() arguments, e.g. options="-c search_path=bench"
+
+    Returns:
+        ThreadedConnectionPool: the new pool
+    """
+    global _pool, _pool_slots
+    params = dict(host=host, port=port, dbname=dbname, user=user, password=password)
+    params.update(connect_kwargs)
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+        _pool = pool.ThreadedConnectionPool(min_size, max_size, connection_factory=PooledConnection, **params)
+        _pool_slots = threading.BoundedSemaphore(max_size)
+    return _pool
+
+
+def get_pool():
+    """Return the process wide connection pool, creating it with the default settings on first use."""
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                init_pool()
+    return _pool
+
+
+def close_pool():
+    """Close every pooled connection. The next connection() call creates a new pool."""
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+        _pool = None
+        _pool_slots = None
+
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.last_used < HEALTH_CHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+@contextmanager
+def connection():
+    """Borrow a connection from the pool.
+
+    The transaction is committed when the block exits normally and rolled back otherwise. Broken connections
+    are discarded and replaced instead of being handed out.
+
+    Yields:
+        PooledConnection: healthy database connection
+    """
+    db_pool = get_pool()
+    slots = _pool_slots
+    # psycopg2 pools raise instead of blocking when exhausted, so wait for a free slot first
+    if not slots.acquire(timeout=POOL_TIMEOUT):
+        raise pool.PoolError(f"no database connection available after {POOL_TIMEOUT} seconds")
+    conn = None
+    try:
+        conn = db_pool.getconn()
+        for _ in range(db_pool.maxconn):
+            if _is_healthy(conn):
+                break
+            db_pool.putconn(conn, close=True)
+            conn = db_pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+    finally:
+        if conn is not None:
+            conn.last_used = time.monotonic()
+            db_pool.putconn(conn, close=bool(conn.closed))
+        slots.release()
+
+
+def execute_prepared(cursor, name, param_types, sql, params):
+    """Run a server-side prepared statement, preparing it on this connection the first time it is used.
+
+    Args:
+        cursor (cursor): cursor of a connection borrowed from connection()
+        name (str): statement name
+        param_types (list(str)): SQL type of every $n parameter
+        sql (str): statement body using $1, $2, ... placeholders
+        params (tuple): values for the parameters
+    """
+    conn = cursor.connection
+    if name not in conn.prepared_statements:
+        cursor.execute(f"PREPARE {name} ({', '.join(param_types)}) AS {sql}")
+        conn.prepared_statements.add(name)
+    placeholders = ", ".join(["%s"] * len(params))
+    cursor.execute(f"EXECUTE {name} ({placeholders})", params)
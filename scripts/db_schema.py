@@ -0,0 +1,269 @@
+import hashlib
+import time
+
+# Schema of the chunk tables, shared by every script that writes to them. ensure_schema() creates missing tables
+# and columns and migrates databases created before chunks had a content hash.
+
+# Separator between the fields that make up a content hash, must match CONTENT_HASH_SQL
+_HASH_SEPARATOR = "\x1f"
+
+# text_vectors is computed by Postgres whenever a row is written, so the GIN index is updated in place
+TEXT_VECTORS_SQL = "to_tsvector('english', coalesce(text, ''))"
+
+# SQL version of chunk_content_hash() used to backfill existing rows
+CONTENT_HASH_SQL = """
+    encode(sha256(convert_to(concat_ws(E'\\x1f', text, company, year, document_type, fiscal_quarter), 'UTF8')), 'hex')
+"""
+
+
+def chunk_content_hash(chunk, company_name, doc_year, doc_type, fiscal_quarter):
+    """sha256 identifying a chunk, two chunks with the same text and filing metadata are duplicates.
+
+    Args:
+        chunk (str): text stored in text_chunks
+        company_name (str): company
+        doc_year (str): year
+        doc_type (str): document type (10K, 10Q)
+        fiscal_quarter (str): fiscal quarter
+
+    Returns:
+        str: hex digest
+    """
+    # concat_ws skips NULLs, so None values are skipped here as well
+    fields = [str(field) for field in (chunk, company_name, doc_year, doc_type, fiscal_quarter) if field is not None]
+    return hashlib.sha256(_HASH_SEPARATOR.join(fields).encode("utf-8")).hexdigest()
+
+
+# Quality flags computed once per chunk when it is written (see chunk_flags.py). NULL means not computed yet,
+# backfill_chunk_flags.py fills those in. embedding_chunks carries its own copy of chunk_filtered so the vector
+# branch can filter without joining text_chunks.
+CHUNK_FLAG_COLUMNS = {
+    "is_toc": "BOOLEAN",
+    "chunk_kind": "TEXT",
+    "token_length": "INTEGER",
+    "chunk_filtered": "BOOLEAN",
+}
+
+
+def chunk_flags_pending(cursor):
+    """Number of text_chunks rows whose quality flags were not computed yet."""
+    cursor.execute("SELECT count(*) FROM text_chunks WHERE chunk_filtered IS NULL;")
+    return cursor.fetchone()[0]
+
+
+def bump_corpus_generation(cursor):
+    """Count a change of the chunk tables, part of the caller's transaction so readers see both at once.
+
+    Cached retrieval results (retrieval_cache.py) belong to one generation and are not reused after a bump.
+    """
+    cursor.execute("UPDATE corpus_generation SET generation = generation + 1, changed_at = now();")
+
+
+def corpus_generation(cursor):
+    """Current generation of the chunk tables."""
+    cursor.execute("SELECT generation FROM corpus_generation;")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def corpus_state(cursor):
+    """Snapshot marker of the chunk tables for indexes built outside Postgres (mmap_index.py, metadata_bitmap.py).
+
+    An index built at one state is stale once corpus_state() returns a different one. Databases from before the
+    generation counter fall back to the row count and largest id of embedding_chunks.
+    """
+    cursor.execute("SELECT to_regclass('corpus_generation') IS NOT NULL;")
+    if cursor.fetchone()[0]:
+        return {"generation": int(corpus_generation(cursor))}
+    cursor.execute("SELECT count(*), coalesce(max(id), 0) FROM embedding_chunks;")
+    count, max_id = cursor.fetchone()
+    return {"rows": int(count), "max_id": int(max_id)}
+
+
+def _index_exists(cursor, name):
+    # Only look at the current schema, the benchmarks keep their own copy of the tables in another one
+    cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s AND schemaname = current_schema();", (name,))
+    return cursor.fetchone() is not None
+
+
+def _deduplicate_legacy_rows(cursor):
+    """The dedup pass ingestion used to run after every load. Only needed once before the unique index exists."""
+    cursor.execute("""
+        DELETE FROM text_chunks
+            WHERE id IN (
+                SELECT id
+                FROM (
+                    SELECT
+                        id,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY text, company, year, document_type, fiscal_quarter
+                            ORDER BY id
+                        ) AS row_num
+                    FROM text_chunks
+                ) AS subquery
+                WHERE row_num > 1
+            );
+        DELETE FROM embedding_chunks
+            WHERE id NOT IN (SELECT id FROM text_chunks);
+        DELETE FROM text_chunks
+            WHERE id NOT IN (SELECT id FROM embedding_chunks);
+    """)
+
+
+def text_vectors_generated(cursor):
+    """True if text_chunks.text_vectors is a generated column, False if it is a plain column (or missing)."""
+    cursor.execute("""
+        SELECT attgenerated FROM pg_attribute
+        WHERE attrelid = to_regclass('text_chunks') AND attname = 'text_vectors' AND NOT attisdropped;
+    """)
+    row = cursor.fetchone()
+    return row is not None and row[0] == 's'
+
+
+def migrate_text_vectors(conn, verbose=True):
+    """Turn text_chunks.text_vectors into a stored generated column and build its GIN index.
+
+    Existing columns cannot be altered into generated ones, so the plain column (and the index on it) is dropped
+    and re-added. This rewrites the table once, afterwards every insert maintains text_vectors by itself.
+
+    Args:
+        conn (psycopg2.connection): database connection, committed on success
+        verbose (bool, optional): print progress. Defaults to True.
+    """
+    start = time.perf_counter()
+    with conn.cursor() as cursor:
+        if text_vectors_generated(cursor):
+            return
+        if verbose:
+            print("Migrating text_chunks.text_vectors to a generated column (runs once)")
+        cursor.execute(f"""
+            ALTER TABLE text_chunks
+                DROP COLUMN IF EXISTS text_vectors,
+                ADD COLUMN text_vectors tsvector GENERATED ALWAYS AS ({TEXT_VECTORS_SQL}) STORED;
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS text_vectors_idx ON text_chunks USING gin(text_vectors);")
+    conn.commit()
+    if verbose:
+        print(f"Migration finished in {time.perf_counter() - start:.1f}s")
+
+
+# Compact copies of the embedding for the first pass of compact retrieval (pgvector 0.7+). Both are derived from
+# the full precision column whenever a row is written: a normalized half precision vector (half the size, inner
+# product ranks like cosine) and a 768 bit sign code (1/32 of the size, compared by hamming distance).
+COMPACT_COLUMNS = {
+    "embedding_half": "halfvec(768) GENERATED ALWAYS AS (l2_normalize(embedding)::halfvec(768)) STORED",
+    "embedding_bits": "bit(768) GENERATED ALWAYS AS (binary_quantize(embedding)::bit(768)) STORED",
+}
+COMPACT_MIN_PGVECTOR = (0, 7)
+
+
+def compact_columns_exist(cursor):
+    """True if embedding_chunks has every column of COMPACT_COLUMNS."""
+    cursor.execute("""
+        SELECT count(*) FROM pg_attribute
+        WHERE attrelid = to_regclass('embedding_chunks') AND attname = ANY(%s) AND NOT attisdropped;
+    """, (list(COMPACT_COLUMNS),))
+    return cursor.fetchone()[0] == len(COMPACT_COLUMNS)
+
+
+def ensure_compact_columns(conn, verbose=True):
+    """Add the compact embedding columns to embedding_chunks if they are missing.
+
+    Adding a stored generated column rewrites the table once, after that new rows get their compact codes on insert.
+    Not part of ensure_schema() because it needs pgvector 0.7 and only pays off when compact retrieval is used.
+
+    Args:
+        conn (psycopg2.connection): database connection, committed on success
+        verbose (bool, optional): print progress. Defaults to True.
+    """
+    with conn.cursor() as cursor:
+        if compact_columns_exist(cursor):
+            return
+        cursor.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector';")
+        row = cursor.fetchone()
+        version = tuple(int(part) for part in row[0].split(".")[:2]) if row else (0, 0)
+        if version < COMPACT_MIN_PGVECTOR:
+            raise RuntimeError(f"Compact vectors need pgvector {'.'.join(map(str, COMPACT_MIN_PGVECTOR))} or newer, "
+                               f"found {row[0] if row else 'none'} (ALTER EXTENSION vector UPDATE)")
+        start = time.perf_counter()
+        if verbose:
+            print("Adding compact embedding columns to embedding_chunks (rewrites the table once)")
+        cursor.execute("ALTER TABLE embedding_chunks " + ", ".join(
+            f"ADD COLUMN IF NOT EXISTS {column} {definition}" for column, definition in COMPACT_COLUMNS.items()) + ";")
+    conn.commit()
+    if verbose:
+        print(f"Compact columns added in {time.perf_counter() - start:.1f}s")
+
+
+def ensure_schema(conn, verbose=True):
+    """Create the chunk tables, the ingestion manifest and their indexes if they do not exist.
+
+    Databases created before content hashes existed are migrated on the first call: duplicates are removed
+    with the old dedup query, every row gets its content_hash and the unique index is built.
+
+    Args:
+        conn (psycopg2.connection): database connection, committed on success
+        verbose (bool, optional): print migration progress. Defaults to True.
+    """
+    cursor = conn.cursor()
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS embedding_chunks (id bigserial PRIMARY KEY, embedding vector(768), company TEXT, year VARCHAR(4), document_type VARCHAR(255), fiscal_quarter VARCHAR(2));
+        CREATE TABLE IF NOT EXISTS text_chunks (id bigint PRIMARY KEY, text TEXT, company TEXT, year VARCHAR(4), document_type VARCHAR(255), fiscal_quarter VARCHAR(2), text_vectors tsvector GENERATED ALWAYS AS ({TEXT_VECTORS_SQL}) STORED);
+        ALTER TABLE text_chunks ADD COLUMN IF NOT EXISTS content_hash TEXT;
+        ALTER TABLE text_chunks ADD COLUMN IF NOT EXISTS source_file TEXT;
+        CREATE INDEX IF NOT EXISTS text_chunks_source_file_idx ON text_chunks (source_file);
+    """)
+    cursor.execute("ALTER TABLE text_chunks " + ", ".join(
+        f"ADD COLUMN IF NOT EXISTS {column} {column_type}" for column, column_type in CHUNK_FLAG_COLUMNS.items()) + ";")
+    cursor.execute("""
+        ALTER TABLE embedding_chunks ADD COLUMN IF NOT EXISTS chunk_filtered BOOLEAN;
+        CREATE INDEX IF NOT EXISTS text_chunks_kind_length_idx ON text_chunks (chunk_kind, token_length);
+        CREATE INDEX IF NOT EXISTS text_chunks_toc_idx ON text_chunks (id) WHERE is_toc;
+        -- Only rows the backfill still has to visit, empty once every chunk has its flags
+        CREATE INDEX IF NOT EXISTS text_chunks_flags_pending_idx ON text_chunks (id) WHERE chunk_filtered IS NULL;
+    """)
+    # One row per ingested markdown file, see ingest_manifest.py
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ingest_manifest (
+            file_path TEXT PRIMARY KEY,
+            file_hash TEXT NOT NULL,
+            mtime DOUBLE PRECISION NOT NULL,
+            chunker_version TEXT NOT NULL,
+            ingested_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+    # Single row counter of changes to the chunk tables, see bump_corpus_generation()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS corpus_generation (
+            id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+            generation BIGINT NOT NULL DEFAULT 0,
+            changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        INSERT INTO corpus_generation (id) VALUES (true) ON CONFLICT DO NOTHING;
+    """)
+    conn.commit()
+
+    if not text_vectors_generated(cursor):
+        migrate_text_vectors(conn, verbose=verbose)
+    cursor.execute("CREATE INDEX IF NOT EXISTS text_vectors_idx ON text_chunks USING gin(text_vectors);")
+    conn.commit()
+
+    if not _index_exists(cursor, "text_chunks_content_hash_idx"):
+        start = time.perf_counter()
+        if verbose:
+            print("Migrating text_chunks to content hashes (runs once)")
+        _deduplicate_legacy_rows(cursor)
+        cursor.execute(f"UPDATE text_chunks SET content_hash = {CONTENT_HASH_SQL} WHERE content_hash IS NULL;")
+        cursor.execute("CREATE UNIQUE INDEX text_chunks_content_hash_idx ON text_chunks (content_hash);")
+        bump_corpus_generation(cursor)
+        conn.commit()
+        if verbose:
+            print(f"Migration finished in {time.perf_counter() - start:.1f}s")
+
+    pending = chunk_flags_pending(cursor)
+    if pending and verbose:
+        print(f"{pending} chunks have no quality flags yet and are not filtered by chunk_filter, "
+              f"run python backfill_chunk_flags.py run")
+    cursor.close()
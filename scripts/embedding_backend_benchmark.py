@@ -0,0 +1,62 @@
+import argparse
+import time
+import numpy as np
+from embedding_gen import generate_embeddings
+from embedding_benchmark import load_eval_texts, load_markdown_texts
+from model_registry import BACKENDS, warm_up
+
+# Compares the embedding backends (full precision torch, dynamic int8, ONNX Runtime) on sample chunks.
+# Parity is the cosine similarity between each backend's embedding and the torch embedding of the same text,
+# latency is measured one text at a time (batch size 1, like a query) and throughput in batches of 32 (ingestion).
+#
+# Usage:
+#   python embedding_backend_benchmark.py
+#   python embedding_backend_benchmark.py --backends torch,int8 --md-file ../md_files/Apple/2024/10Q_10K/10Q-Q3-2024.pdf.md
+
+
+def cosine_rows(a, b):
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return np.sum(a * b, axis=1)
+
+
+def single_text_latencies(texts, backend):
+    latencies = []
+    for text in texts:
+        start = time.perf_counter()
+        generate_embeddings([text], batch_size=1, backend=backend)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies)
+
+
+def batched_throughput(texts, backend, batch_size):
+    start = time.perf_counter()
+    embeddings = generate_embeddings(texts, batch_size=batch_size, backend=backend)
+    return len(texts) / (time.perf_counter() - start), embeddings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parity and speed of the embedding backends")
+    parser.add_argument("--backends", default=",".join(BACKENDS), help="comma separated backends, torch is the parity reference")
+    parser.add_argument("--md-file", default=None, help="markdown filing to chunk and embed (defaults to eval dataset chunks)")
+    parser.add_argument("--num-texts", type=int, default=256, help="number of texts to embed")
+    parser.add_argument("--latency-texts", type=int, default=64, help="number of texts embedded one at a time")
+    args = parser.parse_args()
+
+    texts = load_markdown_texts(args.md_file) if args.md_file else load_eval_texts()
+    texts = (texts * (args.num_texts // len(texts) + 1))[:args.num_texts]
+    # torch runs first wherever it was listed, the cosine columns compare every backend against it
+    backends = ["torch"] + [backend for backend in args.backends.split(",") if backend != "torch"]
+
+    reference = None
+    print(f"{'backend':<10}{'load s':>8}{'bs=1 mean ms':>14}{'bs=1 p95 ms':>13}{'bs=32 texts/s':>15}"
+          f"{'mean cos':>10}{'min cos':>10}")
+    for backend in backends:
+        load_seconds = warm_up(backend=backend)
+        latencies = single_text_latencies(texts[:args.latency_texts], backend)
+        throughput, embeddings = batched_throughput(texts, backend, 32)
+        if reference is None:
+            reference = embeddings
+        cosine = cosine_rows(reference, embeddings)
+        print(f"{backend:<10}{load_seconds:>8.1f}{latencies.mean():>14.1f}{np.percentile(latencies, 95):>13.1f}"
+              f"{throughput:>15.1f}{cosine.mean():>10.4f}{cosine.min():>10.4f}")
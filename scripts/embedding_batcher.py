@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+from embedding_gen import generate_embedding, generate_embeddings
+
+# Request coalescing in front of the embedding model. Concurrent callers each submit one query; a scheduler thread
+# collects queries until max_batch_size are waiting or the oldest one waited max_wait_ms, runs one batched forward
+# pass and resolves every caller's future with its own row. Under load FinBERT then runs a few large batches instead
+# of many batch size 1 passes fighting over the same cores; a lone query only waits max_wait_ms extra.
+#
+# Usage:
+#   python embedding_batcher.py --concurrency 1,4,16,64 --requests 256 --max-batch-size 16 --max-wait-ms 5
+#
+# retrieve_n(query, embedder=EmbeddingBatcher()) and serve.py use it.
+
+MAX_BATCH_SIZE = 16
+MAX_WAIT_MS = 5.0
+
+_STOP = object()
+
+
+class EmbeddingBatcher:
+    """Coalesces concurrent single-text embedding requests into batched forward passes.
+
+    Thread safe. Calling the batcher with a text returns the same (1, hidden_size) array as generate_embedding().
+
+    Args:
+        max_batch_size (int, optional): most texts per forward pass. Defaults to MAX_BATCH_SIZE.
+        max_wait_ms (float, optional): how long the first text of a batch waits for company. Defaults to MAX_WAIT_MS.
+        embed_batch (callable, optional): texts -> (len(texts), hidden_size) array. Defaults to generate_embeddings().
+        backend (str, optional): embedding backend of the default embed_batch. Defaults to embedding_gen's backend.
+    """
+
+    def __init__(self, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, embed_batch=None, backend=None):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.embed_batch = embed_batch or (lambda texts: generate_embeddings(texts, batch_size=len(texts), backend=backend))
+        self.batches = 0
+        self.requests = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                    self._thread.start()
+
+    def submit(self, text):
+        """Queue a text, returns a concurrent.futures.Future of its (1, hidden_size) embedding."""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def embed(self, text, timeout=None):
+        """Embedding of one text, blocks until its batch ran."""
+        return self.submit(text).result(timeout)
+
+    def __call__(self, text):
+        return self.embed(text)
+
+    async def embed_async(self, text):
+        """Embedding of one text without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(text))
+
+    def close(self):
+        """Finish the queued texts and stop the scheduler thread."""
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+        }
+
+    def _collect(self, first):
+        """Gather a batch starting with first, returns (batch, stop)."""
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch, stop = self._collect(item)
+            # Skip callers that cancelled while waiting
+            batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                embeddings = self.embed_batch([text for text, _ in batch])
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            self.batches += 1
+            self.requests += len(batch)
+            for row, (_, future) in enumerate(batch):
+                future.set_result(embeddings[row:row + 1])
+
+
+def run_load(embed, texts, concurrency):
+    """Embed texts from concurrency client threads, returns (latencies in ms, seconds, embeddings)."""
+    latencies = np.empty(len(texts))
+    embeddings = [None] * len(texts)
+
+    def one(i):
+        start = time.perf_counter()
+        embeddings[i] = embed(texts[i])
+        latencies[i] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(len(texts))))
+    return latencies, time.perf_counter() - start, np.vstack(embeddings)
+
+
+if __name__ == "__main__":
+    from model_registry import warm_up
+
+    parser = argparse.ArgumentParser(description="Latency and throughput of batched vs unbatched query embeddings")
+    parser.add_argument("--concurrency", default="1,4,16,64", help="comma separated numbers of concurrent callers")
+    parser.add_argument("--requests", type=int, default=256, help="queries per concurrency level")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS)
+    args = parser.parse_args()
+
+    # Queries are short, use the eval queries rather than chunks
+    with open("eval_dataset.json", "r") as json_file:
+        queries = [entry["query"] for entry in json.load(json_file)]
+    texts = (queries * (args.requests // len(queries) + 1))[:args.requests]
+    warm_up()
+
+    print(f"max_batch_size={args.max_batch_size}, max_wait_ms={args.max_wait_ms}, {args.requests} queries per level")
+    print(f"{'concurrency':>12}{'mode':>11}{'p50 ms':>9}{'p99 ms':>9}{'queries/s':>11}{'batch':>7}{'max cos diff':>14}")
+    for concurrency in [int(value) for value in args.concurrency.split(",")]:
+        latencies, seconds, reference = run_load(lambda text: generate_embedding(text=text), texts, concurrency)
+        print(f"{concurrency:>12}{'unbatched':>11}{np.percentile(latencies, 50):>9.1f}{np.percentile(latencies, 99):>9.1f}"
+              f"{len(texts) / seconds:>11.1f}{1:>7.1f}{0.0:>14.2e}")
+
+        batcher = EmbeddingBatcher(args.max_batch_size, args.max_wait_ms)
+        latencies, seconds, embeddings = run_load(batcher, texts, concurrency)
+        batcher.close()
+        cosine = np.sum(reference * embeddings, axis=1) / (np.linalg.norm(reference, axis=1) * np.linalg.norm(embeddings, axis=1))
+        print(f"{concurrency:>12}{'batched':>11}{np.percentile(latencies, 50):>9.1f}{np.percentile(latencies, 99):>9.1f}"
+              f"{len(texts) / seconds:>11.1f}{batcher.stats()['mean_batch_size']:>7.1f}{1 - cosine.min():>14.2e}")
@@ -0,0 +1,67 @@
+import argparse
+import json
+import time
+import numpy as np
+from chunking import chunk_markdown
+from embedding_gen import generate_embedding, generate_embeddings
+
+# Benchmark comparing the per-chunk embedding path used by the ingestion scripts
+# with the batched generate_embeddings() path.
+#
+# Usage:
+#   python embedding_benchmark.py                                  (uses eval_dataset.json ground truth chunks)
+#   python embedding_benchmark.py --md-file ../md_files/Apple/2024/10Q_10K/10Q-Q3-2024.pdf.md
+
+
+def load_eval_texts(file_path="eval_dataset.json"):
+    """Collect every ground truth chunk from the eval dataset to use as sample texts."""
+    with open(file_path, 'r') as json_file:
+        data = json.load(json_file)
+    return [ground_truth["text"] for entry in data for ground_truth in entry["ground_truth"]]
+
+
+def load_markdown_texts(file_path):
+    """Chunk a markdown filing the same way the ingestion scripts do and return the texts that get embedded."""
+    with open(file_path, 'r', encoding='utf-8') as file:
+        content = file.read()
+    chunks = chunk_markdown(content, 512, verbose=False)
+    return [chunk[1] if isinstance(chunk, tuple) else chunk for chunk in chunks]
+
+
+def time_per_chunk(texts):
+    start = time.perf_counter()
+    embeddings = np.vstack([generate_embedding(text=text) for text in texts])
+    return time.perf_counter() - start, embeddings
+
+
+def time_batched(texts, batch_size):
+    start = time.perf_counter()
+    embeddings = generate_embeddings(texts, batch_size=batch_size)
+    return time.perf_counter() - start, embeddings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-chunk and batched embedding throughput")
+    parser.add_argument("--md-file", default=None, help="markdown filing to chunk and embed (defaults to eval dataset chunks)")
+    parser.add_argument("--num-texts", type=int, default=256, help="number of texts to embed")
+    parser.add_argument("--batch-sizes", default="8,16,32,64", help="comma separated batch sizes to try")
+    args = parser.parse_args()
+
+    texts = load_markdown_texts(args.md_file) if args.md_file else load_eval_texts()
+    # Repeat the sample so every run embeds the same number of texts
+    texts = (texts * (args.num_texts // len(texts) + 1))[:args.num_texts]
+
+    # Warm up the model so the first measurement is not penalized
+    generate_embeddings(texts[:8])
+
+    baseline_seconds, baseline = time_per_chunk(texts)
+    print(f"{'path':<20}{'seconds':>10}{'chunks/sec':>14}{'speedup':>10}{'max cos diff':>16}")
+    print(f"{'per-chunk':<20}{baseline_seconds:>10.2f}{len(texts) / baseline_seconds:>14.1f}{1.0:>10.2f}{0.0:>16.2e}")
+
+    baseline_norm = baseline / np.linalg.norm(baseline, axis=1, keepdims=True)
+    for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+        seconds, embeddings = time_batched(texts, batch_size)
+        # Padding with an attention mask should not change the embeddings beyond float noise
+        cosine = np.sum(baseline_norm * (embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)), axis=1)
+        print(f"{f'batched (bs={batch_size})':<20}{seconds:>10.2f}{len(texts) / seconds:>14.1f}"
+              f"{baseline_seconds / seconds:>10.2f}{np.max(1 - cosine):>16.2e}")
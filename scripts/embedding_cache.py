@@ -0,0 +1,154 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+# Default sizes of the two cache tiers (number of query embeddings)
+MEMORY_CACHE_SIZE = 1024
+DISK_CACHE_SIZE = 100000
+
+
+def normalize_query(query):
+    """Lowercase and collapse whitespace so trivially different spellings of a question share one entry."""
+    return " ".join(query.lower().split())
+
+
+class QueryEmbeddingCache:
+    """Two tier cache for query embeddings keyed by normalized query text and model id.
+
+    The first tier is an in-memory LRU. The optional second tier is a SQLite file that survives restarts, entries
+    found there are promoted back into memory. Both tiers evict their least recently used entries when full.
+
+    Args:
+        model_id (str or callable): embedding model identifier, part of every key so different models never share
+            entries. A callable is asked on every lookup, e.g. embedding_gen.embedding_model_id so a backend switch
+            takes effect right away.
+        max_items (int, optional): size of the in-memory tier. Defaults to MEMORY_CACHE_SIZE.
+        disk_path (str, optional): SQLite file for the on-disk tier. Defaults to None (memory only).
+        max_disk_items (int, optional): size of the on-disk tier. Defaults to DISK_CACHE_SIZE.
+    """
+
+    def __init__(self, model_id, max_items=MEMORY_CACHE_SIZE, disk_path=None, max_disk_items=DISK_CACHE_SIZE):
+        self.model_id = model_id
+        self.max_items = max_items
+        self.max_disk_items = max_disk_items
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+        self._disk_items = 0
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute("""
+                CREATE TABLE IF NOT EXISTS query_embeddings (
+                    key TEXT PRIMARY KEY, model_id TEXT, query TEXT, dim INTEGER, embedding BLOB, last_used REAL
+                );
+            """)
+            self._disk.execute("CREATE INDEX IF NOT EXISTS query_embeddings_last_used_idx ON query_embeddings (last_used);")
+            self._disk.commit()
+            self._disk_items = self._disk.execute("SELECT count(*) FROM query_embeddings;").fetchone()[0]
+
+    def current_model_id(self):
+        return self.model_id() if callable(self.model_id) else self.model_id
+
+    def _key(self, query, model_id):
+        return hashlib.sha1(f"{model_id}\0{normalize_query(query)}".encode("utf-8")).hexdigest()
+
+    def get(self, query, model_id=None):
+        """Return the cached embedding for query or None."""
+        key = self._key(query, model_id or self.current_model_id())
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return embedding
+            if self._disk is not None:
+                row = self._disk.execute("SELECT dim, embedding FROM query_embeddings WHERE key = ?;", (key,)).fetchone()
+                if row is not None:
+                    dim, blob = row
+                    embedding = np.frombuffer(blob, dtype=np.float32).reshape(-1, dim)
+                    self._disk.execute("UPDATE query_embeddings SET last_used = ? WHERE key = ?;", (time.time(), key))
+                    self._disk.commit()
+                    self._put_memory(key, embedding)
+                    self.disk_hits += 1
+                    return embedding
+            self.misses += 1
+            return None
+
+    def put(self, query, embedding, model_id=None):
+        """Store the embedding of query in every tier."""
+        model_id = model_id or self.current_model_id()
+        key = self._key(query, model_id)
+        # Read-only copy so callers cannot modify cached entries
+        embedding = np.array(embedding, dtype=np.float32, copy=True)
+        embedding.setflags(write=False)
+        with self._lock:
+            self._put_memory(key, embedding)
+            if self._disk is not None:
+                cursor = self._disk.execute(
+                    "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?, ?, ?, ?);",
+                    (key, model_id, normalize_query(query), embedding.shape[-1], embedding.tobytes(), time.time())
+                )
+                self._disk_items += 1 if cursor.rowcount else 0
+                if self._disk_items > self.max_disk_items:
+                    self._evict_disk()
+                self._disk.commit()
+
+    def get_or_compute(self, query, compute):
+        """Return the cached embedding of query, computing and caching it with compute(query) on a miss."""
+        # One model id for the lookup and the store, the backend may change while compute runs
+        model_id = self.current_model_id()
+        embedding = self.get(query, model_id)
+        if embedding is None:
+            embedding = compute(query)
+            self.put(query, embedding, model_id)
+        return embedding
+
+    def _put_memory(self, key, embedding):
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def _evict_disk(self):
+        # Drop the least recently used 10% in one statement instead of one row per insert
+        self._disk_items = self._disk.execute("SELECT count(*) FROM query_embeddings;").fetchone()[0]
+        excess = self._disk_items - self.max_disk_items
+        if excess <= 0:
+            return
+        excess += self.max_disk_items // 10
+        self._disk.execute("""
+            DELETE FROM query_embeddings WHERE key IN (
+                SELECT key FROM query_embeddings ORDER BY last_used LIMIT ?
+            );
+        """, (excess,))
+        self.evictions += excess
+        self._disk_items = max(0, self._disk_items - excess)
+
+    def clear(self):
+        """Remove every entry from both tiers."""
+        with self._lock:
+            self._memory.clear()
+            if self._disk is not None:
+                self._disk.execute("DELETE FROM query_embeddings;")
+                self._disk.commit()
+                self._disk_items = 0
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "memory_items": len(self._memory),
+            "disk_items": self._disk_items,
+        }
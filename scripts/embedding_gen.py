@@ -1,14 +1,44 @@
-from transformers import AutoTokenizer, AutoModel
 from funcs import write_debug_log
-import torch
+from model_registry import MODEL_NAME, BACKENDS, DEFAULT_BACKEND, get_tokenizer, get_model
+import numpy as np
+import os
 
-# Load the tokenizer and the base model (without classification head)
-tokenizer = AutoTokenizer.from_pretrained("yiyanghkust/finbert-tone")
-model = AutoModel.from_pretrained("yiyanghkust/finbert-tone")
+# Inference backend used when no model is passed in: "torch" (default), "int8" or "onnx", see model_registry.
+# Can be picked per process with the EMBEDDING_BACKEND environment variable or set_embedding_backend().
+embedding_backend = os.environ.get("EMBEDDING_BACKEND", DEFAULT_BACKEND)
+
+# The tokenizer and the base model (without classification head) are loaded on first use by model_registry.
+# embedding_gen.tokenizer and embedding_gen.model still work and return the shared instances.
+def __getattr__(name):
+    if name == "tokenizer":
+        return get_tokenizer()
+    if name == "model":
+        return get_model(backend=embedding_backend)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def set_embedding_backend(backend):
+    """Switch the backend used by generate_embedding() and generate_embeddings()."""
+    global embedding_backend
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend {backend}, use one of {', '.join(BACKENDS)}")
+    embedding_backend = backend
+
+def embedding_model_id(backend=None):
+    """Identifier of the model and backend producing the embeddings, used to key embedding caches."""
+    backend = backend or embedding_backend
+    # Plain model name for the default backend so existing cache entries stay valid
+    return MODEL_NAME if backend == DEFAULT_BACKEND else f"{MODEL_NAME}:{backend}"
 
 MAX_CHUNK_SIZE = 512
+# Number of texts sent through the model in one forward pass by generate_embeddings()
+EMBEDDING_BATCH_SIZE = 32
 
-def generate_embedding(tokenizer=tokenizer, model=model, text="", max_chunk_size=MAX_CHUNK_SIZE):
+def generate_embedding(tokenizer=None, model=None, text="", max_chunk_size=MAX_CHUNK_SIZE, backend=None):
+    import torch
+    if tokenizer is None:
+        tokenizer = get_tokenizer()
+    if model is None:
+        model = get_model(backend=backend or embedding_backend)
     # Tokenize the input text and return PyTorch tensors
     encoded_input = tokenizer(text, max_length=512, truncation=True, padding=False, return_tensors='pt')
 
@@ -31,6 +61,51 @@ def generate_embedding(tokenizer=tokenizer, model=model, text="", max_chunk_size
     
     return cls_embedding_np
 
+def generate_embeddings(texts, tokenizer=None, model=None, batch_size=EMBEDDING_BATCH_SIZE, max_chunk_size=MAX_CHUNK_SIZE, backend=None):
+    """Embed many texts at once using batched forward passes.
+
+    Texts are tokenized once, sorted by token length and cut into batches of neighbouring lengths so that
+    each batch only pads up to its own longest member. Results are written back in the original order.
+
+    Args:
+        texts (iterable(str)): list or iterator of texts to embed.
+        tokenizer (PreTrainedTokenizer, optional): tokenizer matching the model. Defaults to the FinBERT tokenizer.
+        model (PreTrainedModel, optional): model used to create the embeddings. Defaults to FinBERT.
+        batch_size (int, optional): number of texts per forward pass. Defaults to EMBEDDING_BATCH_SIZE.
+        max_chunk_size (int, optional): max number of tokens per text, longer texts are truncated. Defaults to MAX_CHUNK_SIZE.
+        backend (str, optional): inference backend when no model is passed. Defaults to embedding_backend.
+
+    Returns:
+        embeddings np.ndarray: contiguous float32 matrix of shape (len(texts), hidden_size) holding the [CLS] embeddings
+    """
+    import torch
+    if tokenizer is None:
+        tokenizer = get_tokenizer()
+    if model is None:
+        model = get_model(backend=backend or embedding_backend)
+    texts = list(texts)
+    embeddings = np.empty((len(texts), model.config.hidden_size), dtype=np.float32)
+    if not texts:
+        return embeddings
+
+    # Tokenize everything once without padding so the lengths can be used for bucketing
+    encoded = tokenizer(texts, max_length=max_chunk_size, truncation=True, padding=False)
+    lengths = np.array([len(input_ids) for input_ids in encoded["input_ids"]])
+    order = np.argsort(lengths, kind="stable")
+
+    for start in range(0, len(order), max(1, batch_size)):
+        batch_idx = order[start:start + batch_size]
+        # Only pad up to the longest text in this bucket
+        batch = tokenizer.pad(
+            {key: [encoded[key][i] for i in batch_idx] for key in encoded.keys()},
+            padding=True,
+            return_tensors='pt'
+        )
+        with torch.no_grad():
+            outputs = model(**batch)
+        embeddings[batch_idx] = outputs.last_hidden_state[:, 0, :].cpu().numpy()
+
+    return embeddings
 
 # # Example text to convert into embeddings
 # text = """# Apple Inc.
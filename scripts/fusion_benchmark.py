@@ -0,0 +1,78 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import MinMaxScaler
+from pgvector_db_funcs import fuse_scores, CHUNK_FILTER_CANDIDATES
+
+# Micro-benchmark of the score fusion step of retrieve_n: the previous pandas implementation (outer merge,
+# MinMaxScaler, row wise apply, full sort) against the NumPy fuse_scores() with argpartition.
+#
+# Usage:
+#   python fusion_benchmark.py --sizes 10000,1000000
+
+
+def legacy_fusion(vector_ids, vector_scores, text_ids, text_scores, top):
+    """The fusion code retrieve_n used before fuse_scores(), kept here as the baseline."""
+    semantic_df = pd.DataFrame({'id': vector_ids, 'cosine_similarity': vector_scores})
+    text_df = pd.DataFrame({'id': text_ids, 'text': "", 'full_text_score': text_scores})
+    scoring_df = pd.merge(semantic_df, text_df, on='id', how='outer').fillna(-1)
+    scaler = MinMaxScaler()
+    scoring_df[['cosine_similarity', 'full_text_score']] = scaler.fit_transform(
+        scoring_df[['cosine_similarity', 'full_text_score']]
+    )
+    scoring_df['missing_cosine'] = scoring_df['cosine_similarity'] == -1
+    scoring_df['missing_text'] = scoring_df['full_text_score'] == -1
+    scoring_df['score'] = scoring_df.apply(
+        lambda row: row['cosine_similarity'] if row['missing_text'] else
+                    row['full_text_score'] if row['missing_cosine'] else
+                    0.80 * row['cosine_similarity'] + 0.2 * row['full_text_score'],
+        axis=1
+    )
+    scoring_df = scoring_df.sort_values('score', ascending=False)
+    return scoring_df.head(top)
+
+
+def synthetic_candidates(size, rng):
+    """Both branches score every chunk, like the full scan mode of retrieve_n."""
+    ids = np.arange(1, size + 1, dtype=np.int64)
+    vector_ids = rng.permutation(ids)
+    text_ids = rng.permutation(ids)
+    vector_scores = rng.uniform(-0.2, 0.9, size)
+    # Most chunks do not match the full text query at all
+    text_scores = np.where(rng.random(size) < 0.05, rng.exponential(0.1, size), 0.0)
+    return vector_ids, vector_scores, text_ids, text_scores
+
+
+def best_time(fn, repeats):
+    best = float("inf")
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare pandas and NumPy score fusion")
+    parser.add_argument("--sizes", default="10000,1000000", help="comma separated candidate counts")
+    parser.add_argument("--repeats", type=int, default=3, help="runs per measurement, the best one is reported")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'candidates':>12}{'pandas ms':>12}{'numpy ms':>12}{'speedup':>10}{'same top ids':>14}")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        vector_ids, vector_scores, text_ids, text_scores = synthetic_candidates(size, rng)
+        # The row wise apply is slow enough that one run is plenty for large inputs
+        legacy_seconds, legacy = best_time(
+            lambda: legacy_fusion(vector_ids, vector_scores, text_ids, text_scores, CHUNK_FILTER_CANDIDATES),
+            1 if size > 100000 else args.repeats
+        )
+        numpy_seconds, (ids, scores, _, _) = best_time(
+            lambda: fuse_scores(vector_ids, vector_scores, text_ids, text_scores, CHUNK_FILTER_CANDIDATES),
+            args.repeats
+        )
+        same = np.array_equal(np.sort(legacy['id'].to_numpy()), np.sort(ids))
+        print(f"{size:>12}{legacy_seconds * 1000:>12.1f}{numpy_seconds * 1000:>12.1f}"
+              f"{legacy_seconds / numpy_seconds:>10.1f}{str(same):>14}")
@@ -0,0 +1,160 @@
+import glob
+import hashlib
+import os
+from db_schema import bump_corpus_generation
+
+# Finds the markdown filings on disk and tracks which of them are in the database, so ingestion only processes new
+# and changed filings.
+# A file is unchanged when its mtime is the recorded one, or when its contents hash to the recorded hash, and it was
+# chunked with the current chunker version.
+
+NEW = "new"
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+
+
+class FileJob:
+    """A markdown filing waiting to be chunked."""
+
+    def __init__(self, file_path, company_name, doc_year, doc_type, fiscal_quarter):
+        self.file_path = file_path
+        self.company_name = company_name
+        self.doc_year = doc_year
+        self.doc_type = doc_type
+        self.fiscal_quarter = fiscal_quarter
+
+
+def find_markdown_files(base_dir):
+    """Recursively finds markdown files in all subdirectories and yields a FileJob for each one."""
+    for subdir, dirs, files in os.walk(base_dir):
+        for file in glob.glob(os.path.join(subdir, "*.md")):
+            file_parts = file.split('/')
+            company = file_parts[2]
+            year = file_parts[3]
+            name_info = file_parts[5].split('-')
+            doc_type = name_info[0]
+            fiscal_quarter = name_info[1]
+            # print(f"company: {company} year: {year} file type: {doc_type}")
+            yield FileJob(file, company, year, doc_type, fiscal_quarter)
+
+
+def file_hash(file_path, block_size=1 << 20):
+    """sha256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ManifestEntry:
+    """A file found on disk together with its state relative to the manifest."""
+
+    def __init__(self, job, status, file_hash=None, mtime=None):
+        self.job = job
+        self.status = status
+        self.file_hash = file_hash
+        self.mtime = mtime
+
+
+class IngestManifest:
+    """Reads and updates the ingest_manifest table (created by db_schema.ensure_schema).
+
+    Args:
+        conn (psycopg2.connection): database connection
+        chunker_version (str): chunking.CHUNKER_VERSION, files chunked with another version are re-ingested
+    """
+
+    def __init__(self, conn, chunker_version):
+        self.conn = conn
+        self.chunker_version = str(chunker_version)
+
+    def load(self):
+        """Return {file_path: (file_hash, mtime, chunker_version)} for every ingested file."""
+        with self.conn.cursor() as cursor:
+            cursor.execute("SELECT file_path, file_hash, mtime, chunker_version FROM ingest_manifest;")
+            return {row[0]: row[1:] for row in cursor.fetchall()}
+
+    def plan(self, jobs, force=False):
+        """Compare the files on disk with the manifest.
+
+        Args:
+            jobs (iterable(FileJob)): every markdown file on disk
+            force (bool, optional): treat every file as changed. Defaults to False.
+
+        Returns:
+            entries list(ManifestEntry): one entry per job
+            removed list(str): manifest paths that no longer exist on disk
+        """
+        recorded = self.load()
+        entries = []
+        for job in jobs:
+            mtime = os.path.getmtime(job.file_path)
+            previous = recorded.pop(job.file_path, None)
+            if previous is None:
+                entries.append(ManifestEntry(job, NEW, file_hash(job.file_path), mtime))
+                continue
+            previous_hash, previous_mtime, previous_version = previous
+            if not force and previous_version == self.chunker_version and previous_mtime == mtime:
+                entries.append(ManifestEntry(job, UNCHANGED, previous_hash, mtime))
+                continue
+            current_hash = file_hash(job.file_path)
+            if not force and previous_version == self.chunker_version and previous_hash == current_hash:
+                # Touched but not modified, only the mtime needs updating
+                entries.append(ManifestEntry(job, UNCHANGED, current_hash, mtime))
+                self.record(entries[-1])
+            else:
+                entries.append(ManifestEntry(job, CHANGED, current_hash, mtime))
+        return entries, list(recorded)
+
+    def remove_chunks(self, job, keep_hashes=()):
+        """Delete the chunks of a file from both tables, returns the number of deleted chunks.
+
+        Call it after the new version of the file was written, with the content hashes of its chunks in keep_hashes
+        (BulkChunkWriter.pop_file_hashes()): only the chunks of older versions go, so retrieval never sees the filing
+        without chunks. Rows loaded before source_file was tracked are matched by their filing metadata instead.
+        """
+        with self.conn.cursor() as cursor:
+            cursor.execute("""
+                WITH removed AS (
+                    DELETE FROM text_chunks
+                    WHERE (source_file = %s
+                        OR (source_file IS NULL AND company = %s AND year = %s AND document_type = %s AND fiscal_quarter = %s))
+                        AND content_hash <> ALL(%s::text[])
+                    RETURNING id
+                )
+                DELETE FROM embedding_chunks WHERE id IN (SELECT id FROM removed);
+            """, (job.file_path, job.company_name, str(job.doc_year), job.doc_type, job.fiscal_quarter, list(keep_hashes)))
+            removed = cursor.rowcount
+            if removed:
+                bump_corpus_generation(cursor)
+        self.conn.commit()
+        return removed
+
+    def forget(self, file_path):
+        """Remove a file that was deleted from disk: its chunks and its manifest entry."""
+        with self.conn.cursor() as cursor:
+            cursor.execute("""
+                WITH removed AS (
+                    DELETE FROM text_chunks WHERE source_file = %s RETURNING id
+                )
+                DELETE FROM embedding_chunks WHERE id IN (SELECT id FROM removed);
+            """, (file_path,))
+            removed = cursor.rowcount
+            if removed:
+                bump_corpus_generation(cursor)
+            cursor.execute("DELETE FROM ingest_manifest WHERE file_path = %s;", (file_path,))
+        self.conn.commit()
+        return removed
+
+    def record(self, entry):
+        """Mark a file as ingested with its current hash and mtime."""
+        with self.conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO ingest_manifest (file_path, file_hash, mtime, chunker_version, ingested_at)
+                VALUES (%s, %s, %s, %s, now())
+                ON CONFLICT (file_path) DO UPDATE
+                SET file_hash = EXCLUDED.file_hash, mtime = EXCLUDED.mtime,
+                    chunker_version = EXCLUDED.chunker_version, ingested_at = EXCLUDED.ingested_at;
+            """, (entry.job.file_path, entry.file_hash, entry.mtime, self.chunker_version))
+        self.conn.commit()
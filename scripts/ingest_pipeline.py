@@ -0,0 +1,272 @@
+import queue
+import threading
+import time
+import traceback
+from chunking import iter_markdown_chunks, summarize_table, PendingTable
+from embedding_gen import generate_embeddings, EMBEDDING_BATCH_SIZE
+from funcs import write_debug_log
+from ingest_manifest import FileJob
+
+# Default number of worker threads per stage. Summarization is bound by the LLM server so it gets more workers,
+# the embedding stage batches chunks together instead.
+DEFAULT_STAGE_WORKERS = {
+    "chunk": 1,
+    "summarize": 2,
+    "embed": 1,
+    "write": 1,
+}
+# Max number of items waiting in front of each stage. A full queue blocks the upstream stage (backpressure).
+DEFAULT_QUEUE_SIZE = 64
+
+# Sentinel telling a worker that no more items will arrive
+_DONE = object()
+
+
+class ChunkItem:
+    """A single chunk travelling through the pipeline.
+
+    Args:
+        job (FileJob): filing the chunk was taken from
+        chunk (str): text stored in the database (the raw table for table chunks)
+        embed_text (str): text that gets embedded. None until a table has been summarized
+        context (list(str)): preceding section lines, only set for tables waiting for a summary
+    """
+
+    def __init__(self, job, chunk, embed_text=None, context=None):
+        self.job = job
+        self.chunk = chunk
+        self.embed_text = embed_text
+        self.context = context
+        self.embedding = None
+
+
+class StageStats:
+    """Counters collected by every stage of the pipeline."""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items_in = 0
+        self.items_out = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.started = None
+        self.finished = None
+        self.queue_samples = 0
+        self.queue_depth_sum = 0
+        self.queue_depth_max = 0
+        self._lock = threading.Lock()
+
+    def record(self, items_in, items_out, busy_seconds, blocked_seconds, queue_depth, error=False):
+        with self._lock:
+            self.items_in += items_in
+            self.items_out += items_out
+            self.busy_seconds += busy_seconds
+            self.blocked_seconds += blocked_seconds
+            self.errors += int(error)
+            self.queue_samples += 1
+            self.queue_depth_sum += queue_depth
+            self.queue_depth_max = max(self.queue_depth_max, queue_depth)
+
+    @property
+    def wall_seconds(self):
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+    @property
+    def avg_queue_depth(self):
+        return self.queue_depth_sum / self.queue_samples if self.queue_samples else 0.0
+
+
+class Stage:
+    """A pool of worker threads reading from one bounded queue and writing into the next stage.
+
+    Args:
+        name (str): stage name used in the stats report
+        fn (callable): called with one item (or a list of items when batch_size > 1) and returns an iterable of output items
+        workers (int): number of worker threads
+        queue_size (int): max number of items waiting in front of this stage
+        batch_size (int): max number of queued items handed to fn at once
+    """
+
+    def __init__(self, name, fn, workers=1, queue_size=DEFAULT_QUEUE_SIZE, batch_size=1):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats = StageStats(name, self.workers)
+        # Items whose fn call raised, see IngestionPipeline.failed_files()
+        self.failed_items = []
+        self.next_stage = None
+        self._threads = []
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.stats.started = time.perf_counter()
+        self._running = self.workers
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, item):
+        # Blocks while the queue is full so fast producers wait for slow consumers
+        self.queue.put(item)
+
+    def close(self):
+        for _ in range(self.workers):
+            self.queue.put(_DONE)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _next_batch(self):
+        """Block for one item, then grab whatever else is already queued up to batch_size."""
+        first = self.queue.get()
+        if first is _DONE:
+            return None
+        batch = [first]
+        while len(batch) < self.batch_size:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _DONE:
+                # Put the sentinel back so the loop exits after this batch
+                self.queue.put(_DONE)
+                break
+            batch.append(item)
+        return batch
+
+    def _work(self):
+        while True:
+            queue_depth = self.queue.qsize()
+            batch = self._next_batch()
+            if batch is None:
+                break
+            start = time.perf_counter()
+            produced = 0
+            blocked = 0.0
+            error = False
+            try:
+                # Outputs are passed on as soon as fn yields them so downstream stages can start early
+                for output in self.fn(batch if self.batch_size > 1 else batch[0]) or []:
+                    produced += 1
+                    if self.next_stage is not None:
+                        put_start = time.perf_counter()
+                        self.next_stage.put(output)
+                        blocked += time.perf_counter() - put_start
+            except Exception as error_msg:
+                error = True
+                tb = traceback.format_exc()
+                print(f"ERROR in {self.name} stage: {error_msg}")
+                write_debug_log(f"ERROR in {self.name} stage: {error_msg}\n{tb}")
+                with self._lock:
+                    self.failed_items.extend(batch)
+            busy = time.perf_counter() - start - blocked
+            self.stats.record(len(batch), produced, busy, blocked, queue_depth, error=error)
+
+        # The last worker to finish shuts down the downstream stage
+        with self._lock:
+            self._running -= 1
+            last_worker = self._running == 0
+        if last_worker:
+            self.stats.finished = time.perf_counter()
+            if self.next_stage is not None:
+                self.next_stage.close()
+
+
+class IngestionPipeline:
+    """Chunk -> summarize -> embed -> write pipeline where every stage runs concurrently.
+
+    Args:
+        write_fn (callable): called as write_fn(item) with a ChunkItem that has its embedding set
+        workers (dict, optional): worker count per stage name. Missing stages use DEFAULT_STAGE_WORKERS
+        queue_size (int, optional): max queue length in front of every stage. Defaults to DEFAULT_QUEUE_SIZE.
+        embed_batch_size (int, optional): max number of chunks per embedding forward pass. Defaults to EMBEDDING_BATCH_SIZE.
+        max_chunk_length (int, optional): max chunk length in tokens. Defaults to 512.
+    """
+
+    def __init__(self, write_fn, workers=None, queue_size=DEFAULT_QUEUE_SIZE, embed_batch_size=EMBEDDING_BATCH_SIZE, max_chunk_length=512):
+        self.write_fn = write_fn
+        self.max_chunk_length = max_chunk_length
+        workers = {**DEFAULT_STAGE_WORKERS, **(workers or {})}
+        self.stages = [
+            Stage("chunk", self._chunk, workers["chunk"], queue_size),
+            Stage("summarize", self._summarize, workers["summarize"], queue_size),
+            Stage("embed", self._embed, workers["embed"], queue_size, batch_size=embed_batch_size),
+            Stage("write", self._write, workers["write"], queue_size),
+        ]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next_stage = next_stage
+
+    def _chunk(self, job):
+        print(f"Reading {job.file_path}")
+        write_debug_log(f"Chunking {job.file_path}")
+        with open(job.file_path, 'r', encoding='utf-8') as file:
+            content = file.read()
+        # Tables are handed to the summarize stage instead of blocking the chunker on the LLM
+        for chunk in iter_markdown_chunks(content, self.max_chunk_length, summarize_tables=False):
+            if isinstance(chunk, PendingTable):
+                yield ChunkItem(job, chunk.table, context=chunk.context)
+            else:
+                yield ChunkItem(job, chunk, embed_text=chunk)
+
+    def _summarize(self, item):
+        if item.embed_text is None:
+            item.embed_text = summarize_table(item.chunk, item.context)
+            item.context = None
+        return [item]
+
+    def _embed(self, items):
+        embeddings = generate_embeddings([item.embed_text for item in items])
+        for item, embedding in zip(items, embeddings):
+            item.embedding = embedding
+        return items
+
+    def _write(self, item):
+        self.write_fn(item)
+        return [item]
+
+    def run(self, jobs):
+        """Feed every FileJob through the pipeline and wait for the last chunk to be written.
+
+        Args:
+            jobs (iterable(FileJob)): filings to ingest
+
+        Returns:
+            stats list(StageStats): stats for every stage in pipeline order
+        """
+        for stage in self.stages:
+            stage.start()
+        for job in jobs:
+            self.stages[0].put(job)
+        self.stages[0].close()
+        for stage in self.stages:
+            stage.join()
+        return [stage.stats for stage in self.stages]
+
+    def failed_files(self):
+        """Paths of the files that lost at least one chunk to an error during the last run."""
+        failed = set()
+        for stage in self.stages:
+            for item in stage.failed_items:
+                job = item if isinstance(item, FileJob) else item.job
+                failed.add(job.file_path)
+        return failed
+
+
+def print_stage_stats(stats):
+    """Print throughput and queue depth for every stage of a finished pipeline run."""
+    print(f"\n{'stage':<12}{'workers':>8}{'in':>8}{'out':>8}{'errors':>8}{'busy s':>10}{'blocked s':>11}{'wall s':>10}"
+          f"{'items/s':>10}{'avg queue':>11}{'max queue':>11}")
+    for stage in stats:
+        throughput = stage.items_in / stage.wall_seconds if stage.wall_seconds else 0.0
+        print(f"{stage.name:<12}{stage.workers:>8}{stage.items_in:>8}{stage.items_out:>8}{stage.errors:>8}"
+              f"{stage.busy_seconds:>10.2f}{stage.blocked_seconds:>11.2f}{stage.wall_seconds:>10.2f}{throughput:>10.2f}"
+              f"{stage.avg_queue_depth:>11.1f}{stage.queue_depth_max:>11}")
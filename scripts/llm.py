@@ -3,23 +3,61 @@ warnings.filterwarnings("ignore", category=FutureWarning)
 
 import ollama
 import json
-import psycopg2
 import ast
 import re
+import threading
 from pgvector_db_funcs import retrieve_n
-
-# Connection parameters for pgvector
-host = "localhost"         # Hostname (since you've mapped the container port)
-port = "5432"              # Port you mapped (5432)
-dbname = "vectordb"     # Name of your database
-user = "admin"           # Username you provided during setup
-password = "adminpass"   # Password you provided during setup
+from db_pool import get_pool, close_pool
+from embedding_cache import QueryEmbeddingCache
+from embedding_gen import embedding_model_id, generate_embedding
+from answer_cache import AnswerCache
+from retrieval_cache import RetrievalCache
+from model_registry import warm_up
 
 # Initialize the Ollama client
 client = ollama.Client()
 
 retrieved_files_path = "retrieved_documents.md"
 
+# Model that answers the user's questions
+answer_model = 'llama3.1'
+
+# Repeated questions (and every eval rerun) reuse the query embedding instead of running FinBERT again.
+# Set the path to None to keep the cache in memory only. The cache (and its SQLite file) is only created once a query
+# needs it, importing llm does not touch the disk.
+query_embedding_cache_path = "query_embedding_cache.sqlite"
+_query_embedding_cache = None
+_query_embedding_cache_lock = threading.Lock()
+
+def get_query_embedding_cache():
+    """Shared query embedding cache, created on the first call."""
+    global _query_embedding_cache
+    if _query_embedding_cache is None:
+        with _query_embedding_cache_lock:
+            if _query_embedding_cache is None:
+                _query_embedding_cache = QueryEmbeddingCache(embedding_model_id, disk_path=query_embedding_cache_path)
+    return _query_embedding_cache
+
+# llm.query_embedding_cache still works
+def __getattr__(name):
+    if name == "query_embedding_cache":
+        return get_query_embedding_cache()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Results of retrieval_step are reused until ingestion changes the corpus (see retrieval_cache.py), so eval reruns and
+# repeated questions skip retrieval entirely
+retrieval_cache = RetrievalCache()
+
+# The same question with the same retrieved chunks replays the earlier answer instead of calling the model again.
+# Set the threshold (cosine similarity of the query embeddings, e.g. 0.98) to also reuse answers of near-duplicate
+# questions with the same chunks.
+answer_cache_ttl_seconds = 60 * 60
+answer_similarity_threshold = None
+answer_cache = AnswerCache(
+    answer_model, ttl_seconds=answer_cache_ttl_seconds, similarity_threshold=answer_similarity_threshold,
+    embedder=lambda query: get_query_embedding_cache().get_or_compute(query, lambda text: generate_embedding(text=text))
+)
+
 system_prompt = """You are an AI assistant tasked with answering financial questions. Your task is to answer simple questions about a company based on the <context> element of the query.
     Here is an example query in the same format queries will be asked:
     
@@ -100,7 +138,7 @@ def extract_query_details(query):
         'Quarters': [q.upper() for q in matched_quarters]
     }
 
-def retrieval_step(message = "", n = 5, hybrid_search = True, chunk_filtering = False, debug = False, verbose = False):
+def retrieval_step(message = "", n = 5, hybrid_search = True, chunk_filtering = False, debug = False, verbose = False, retrieval_options = None):
     """Function to perform the retrieval step of the RAG pipeline. 
 
     Args:
@@ -109,6 +147,7 @@ def retrieval_step(message = "", n = 5, hybrid_search = True, chunk_filtering =
         hybrid_search (bool, optional): Flag to enable or disable hybrid search. Defaults to False.
         debug (bool, optional): Flag to print debugging and other print statements to command line. Defaults to False.
         verbose (bool, optional): Flag to print verbose options of retrieve_n(). Defaults to False.
+        retrieval_options (dict, optional): extra keyword arguments for retrieve_n(), e.g. {"candidate_k": 200, "ef_search": 100}. Defaults to None.
 
     Returns:
         ret list(str): top n chunks in list format
@@ -195,20 +234,20 @@ def retrieval_step(message = "", n = 5, hybrid_search = True, chunk_filtering =
         print(quarters_list)
     
     # Perform Retrieval and get top n chunks
-    return retrieve_n(message, n, companies_list, years_list, quarters_list, hybrid_search=hybrid_search, chunk_filter=chunk_filtering, verbose = verbose)
+    options = {"embedding_cache": get_query_embedding_cache(), "result_cache": retrieval_cache, **(retrieval_options or {})}
+    return retrieve_n(message, n, companies_list, years_list, quarters_list, hybrid_search=hybrid_search, chunk_filter=chunk_filtering, verbose = verbose,
+                      **options)
 
-def generation_step(message = "", top_n = None, eval = False, debug = False):
-    """Function to perform the generation step of the RAG pipeline. 
+def build_conversation(message, top_n):
+    """Build the chat messages that ask the model to answer message using the retrieved chunks.
 
     Args:
-        message (str): message for the LLM to answer. Defaults to "".
-        top_n (list): List of chunks returned by the retrieval step. 
-        debug (bool, optional): Flag to print debugging and other print statements to command line. Defaults to False.
+        message (str): user query
+        top_n (list): chunks returned by the retrieval step
 
     Returns:
-        None
+        conversation list(dict): system prompt and the user message with the injected context
     """
-    
     # Build context
     context = ""
     for i, doc in enumerate(top_n):
@@ -225,24 +264,57 @@ def generation_step(message = "", top_n = None, eval = False, debug = False):
                     
                     '''
     
-    conversation = [
+    return [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": injected_query},
     ]
 
+def generation_step(message = "", top_n = None, eval = False, debug = False, use_cache = True):
+    """Function to perform the generation step of the RAG pipeline. 
+
+    Args:
+        message (str): message for the LLM to answer. Defaults to "".
+        top_n (list): List of chunks returned by the retrieval step. 
+        debug (bool, optional): Flag to print debugging and other print statements to command line. Defaults to False.
+        use_cache (bool, optional): Flag to replay cached answers and cache new ones, see answer_cache. Defaults to True.
+
+    Returns:
+        answer (str): the answer if eval is True, otherwise None (the answer is printed)
+    """
+    
+    cached = answer_cache.get(message, top_n) if use_cache else None
+    if cached is not None:
+        if debug: print(f"Answer cache hit, {answer_cache.stats()}")
+        if eval:
+            return cached
+        print("System: ", end='')
+        print(cached, end='')
+        print("\n")
+        return None
+
+    conversation = build_conversation(message, top_n)
+
     # Send the chat to the model with streaming enabled
     if eval:
-        response = client.chat(model='llama3.1', messages=conversation, stream=False)
-        return response.get('message', None).get('content', None)
+        response = client.chat(model=answer_model, messages=conversation, stream=False)
+        answer = response.get('message', None).get('content', None)
+        if use_cache and answer:
+            answer_cache.put(message, top_n, answer)
+        return answer
     else:
-        response_stream = client.chat(model='llama3.1', messages=conversation, stream=True)
+        response_stream = client.chat(model=answer_model, messages=conversation, stream=True)
         print("System: ", end='')
         # Print each chunk of content as it is received
+        parts = []
         for chunk in response_stream:
             content = chunk.get('message', {}).get('content', '')
             print(content, end='')
+            parts.append(content)
         # Ensure the print ends with a new line
         print("\n")
+        # Only complete streams get here, an interrupted one raised above
+        if use_cache and parts:
+            answer_cache.put(message, top_n, "".join(parts))
         
 def clear_retrieved_documents(debug = False):
     with open(retrieved_files_path, "w") as file:
@@ -281,19 +353,11 @@ def run_llm(n = 5, debug = False):
         None
     """
     
-    # Establish connection
+    # Open the shared connection pool and load the embedding model up front so the first query does not pay for them
     try:
-        conn = psycopg2.connect(
-            host=host,
-            port=port,
-            dbname=dbname,
-            user=user,
-            password=password
-        )
+        get_pool()
+        warm_up()
         if(debug): print("Connection established successfully!")
-
-        # Create a cursor to perform database operations
-        cursor = conn.cursor()
         
         # Clear retrieved files log
         clear_retrieved_documents()
@@ -316,8 +380,7 @@ def run_llm(n = 5, debug = False):
             message = input("User: ")
             print()
             if(message.lower() == 'exit'):
-                cursor.close()
-                conn.close()
+                close_pool()
                 break
             
             top_n = retrieval_step(message = message, n = n, hybrid_search=True, chunk_filtering=True)
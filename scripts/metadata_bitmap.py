@@ -0,0 +1,167 @@
+import argparse
+import time
+import numpy as np
+from db_pool import connection
+from db_schema import corpus_state
+
+# Precomputed metadata filter for retrieve_n. Every company, year, fiscal quarter and document type value gets a
+# bitset over the rows of embedding_chunks (np.packbits, one bit per chunk). A filter is an OR of the bitsets of the
+# wanted values within a column and an AND across columns, a handful of vectorized operations on arrays of
+# rows / 8 bytes, which turns into the candidate rows or chunk ids both retrieval branches search in.
+#
+# The index is a snapshot of embedding_chunks, refresh() rebuilds it when the table changed.
+#
+# Usage:
+#   python metadata_bitmap.py benchmark
+#
+# retrieve_n(query, ..., metadata_index=MetadataBitmapIndex.from_database(conn)) uses it.
+
+# Filter order matches the filter arguments of retrieve_n, document_type comes last because retrieve_n has no filter for it
+FILTER_COLUMNS = ("company", "year", "fiscal_quarter", "document_type")
+
+
+class MetadataBitmapIndex:
+    """One packed bitset per metadata value over a fixed list of chunk ids.
+
+    Args:
+        ids (array-like): chunk id of every row
+        columns (dict(str, array-like)): metadata value of every row for some of FILTER_COLUMNS
+        state (dict, optional): corpus state the index was built from, see is_stale()
+    """
+
+    def __init__(self, ids, columns, state=None):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.num_rows = len(self.ids)
+        self.state = state
+        self.bitmaps = {}
+        for column, values in columns.items():
+            values = np.asarray([str(value) for value in values], dtype=object)
+            self.bitmaps[column] = {value: np.packbits(values == value) for value in np.unique(values)}
+
+    @classmethod
+    def from_database(cls, conn):
+        """Build the index from the metadata columns of embedding_chunks."""
+        with conn.cursor() as cursor:
+            state = corpus_state(cursor)
+            cursor.execute(f"SELECT id, {', '.join(FILTER_COLUMNS)} FROM embedding_chunks ORDER BY id;")
+            rows = cursor.fetchall()
+        conn.rollback()
+        if not rows:
+            return cls([], {column: [] for column in FILTER_COLUMNS}, state)
+        ids, *values = zip(*rows)
+        return cls(ids, dict(zip(FILTER_COLUMNS, values)), state)
+
+    def is_stale(self, conn):
+        """True if embedding_chunks changed since the index was built."""
+        with conn.cursor() as cursor:
+            state = corpus_state(cursor)
+        conn.rollback()
+        return state != self.state
+
+    def refresh(self, conn):
+        """Return an up to date index: self if embedding_chunks did not change, otherwise a rebuilt one."""
+        return MetadataBitmapIndex.from_database(conn) if self.is_stale(conn) else self
+
+    def values(self, column):
+        """Every value of a column with its number of chunks."""
+        return {value: int(np.unpackbits(bits, count=self.num_rows).sum()) for value, bits in self.bitmaps.get(column, {}).items()}
+
+    def bits(self, company_filter=(), year_filter=(), quarters_filter=(), document_type_filter=()):
+        """Packed bitset of the rows matching every non-empty filter, None if nothing is filtered.
+
+        Values within a filter are ORed, filters are ANDed. Unknown values match nothing.
+        """
+        result = None
+        for column, wanted in zip(FILTER_COLUMNS, (company_filter, year_filter, quarters_filter, document_type_filter)):
+            if len(wanted) == 0:
+                continue
+            column_bits = np.zeros((self.num_rows + 7) // 8, dtype=np.uint8)
+            bitmaps = self.bitmaps.get(column, {})
+            for value in wanted:
+                value_bits = bitmaps.get(str(value))
+                if value_bits is not None:
+                    np.bitwise_or(column_bits, value_bits, out=column_bits)
+            result = column_bits if result is None else np.bitwise_and(result, column_bits, out=result)
+        return result
+
+    def rows(self, *filters):
+        """Row numbers matching the filters (same arguments as bits()), None if nothing is filtered."""
+        bits = self.bits(*filters)
+        return None if bits is None else np.flatnonzero(np.unpackbits(bits, count=self.num_rows))
+
+    def chunk_ids(self, *filters):
+        """Sorted chunk ids matching the filters (same arguments as bits()), None if nothing is filtered."""
+        rows = self.rows(*filters)
+        return None if rows is None else self.ids[rows]
+
+    def count(self, *filters):
+        """Number of chunks matching the filters, every chunk if nothing is filtered."""
+        bits = self.bits(*filters)
+        return self.num_rows if bits is None else int(np.unpackbits(bits, count=self.num_rows).sum())
+
+    def nbytes(self):
+        return sum(bits.nbytes for bitmaps in self.bitmaps.values() for bits in bitmaps.values()) + self.ids.nbytes
+
+
+def benchmark(repeats=100, file_path="eval_dataset.json"):
+    """Time filter evaluation with the bitmaps against SQL, and retrieve_n with and without the bitmap index."""
+    from retrieval_benchmark import load_eval_queries, time_retrieval, print_latency_row
+    from llm import extract_query_details
+    from embedding_cache import QueryEmbeddingCache
+    from embedding_gen import embedding_model_id
+
+    with connection() as conn:
+        start = time.perf_counter()
+        index = MetadataBitmapIndex.from_database(conn)
+        build_seconds = time.perf_counter() - start
+        print(f"Built bitmaps for {index.num_rows} chunks in {build_seconds * 1000:.1f} ms, {index.nbytes() / 1024:.0f} KB")
+        for column in FILTER_COLUMNS:
+            print(f"  {column}: {len(index.bitmaps[column])} values")
+
+        queries = load_eval_queries(file_path)
+        filters = []
+        for query in queries:
+            details = extract_query_details(query)
+            filters.append(([str(c) for c in details["Companies"]], [str(y) for y in details["Years"]], [str(q) for q in details["Quarters"]]))
+
+        bitmap_us = []
+        sql_us = []
+        with conn.cursor() as cursor:
+            for company_filter, year_filter, quarters_filter in filters:
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    index.chunk_ids(company_filter, year_filter, quarters_filter)
+                bitmap_us.append((time.perf_counter() - start) / repeats * 1e6)
+                start = time.perf_counter()
+                cursor.execute("""
+                    SELECT id FROM embedding_chunks
+                    WHERE (cardinality(%s::text[]) = 0 OR company = ANY(%s::text[]))
+                        AND (cardinality(%s::text[]) = 0 OR year = ANY(%s::text[]))
+                        AND (cardinality(%s::text[]) = 0 OR fiscal_quarter = ANY(%s::text[]));
+                """, (company_filter, company_filter, year_filter, year_filter, quarters_filter, quarters_filter))
+                cursor.fetchall()
+                sql_us.append((time.perf_counter() - start) * 1e6)
+        conn.rollback()
+
+    print(f"\nMatching chunk ids for {len(filters)} eval query filters (microseconds)")
+    print(f"{'method':<24}{'mean':>10}{'p95':>10}")
+    print(f"{'bitmaps':<24}{np.mean(bitmap_us):>10.1f}{np.percentile(bitmap_us, 95):>10.1f}")
+    print(f"{'sql on embedding_chunks':<24}{np.mean(sql_us):>10.1f}{np.percentile(sql_us, 95):>10.1f}")
+
+    cache = QueryEmbeddingCache(embedding_model_id())
+    time_retrieval(queries, embedding_cache=cache)
+    print(f"\nretrieve_n latency (ms)")
+    print(f"{'mode':<34}{'mean':>10}{'p50':>10}{'p95':>10}")
+    for name, kwargs in (("full scan", {}), ("candidates k=200", {"candidate_k": 200})):
+        print_latency_row(f"{name}, column filters", time_retrieval(queries, embedding_cache=cache, **kwargs))
+        print_latency_row(f"{name}, bitmap index", time_retrieval(queries, embedding_cache=cache, metadata_index=index, **kwargs))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bitmap index over the chunk metadata")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    benchmark_parser = subparsers.add_parser("benchmark", help="filter and retrieve_n latency with and without the bitmaps")
+    benchmark_parser.add_argument("--repeats", type=int, default=100, help="bitmap evaluations per filter")
+    args = parser.parse_args()
+
+    benchmark(args.repeats)
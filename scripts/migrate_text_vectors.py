@@ -0,0 +1,91 @@
+import argparse
+import time
+from db_pool import connection
+from db_schema import migrate_text_vectors, text_vectors_generated, TEXT_VECTORS_SQL
+
+# Converts text_chunks.text_vectors into a stored generated column on databases created before it was one, and
+# compares the cost of adding one filing with the old maintenance (full table UPDATE plus GIN index rebuild)
+# against inserts into the generated column.
+#
+# Usage:
+#   python migrate_text_vectors.py migrate
+#   python migrate_text_vectors.py benchmark --rows 200000 --file-chunks 300
+
+
+def _timed(cursor, sql):
+    start = time.perf_counter()
+    cursor.execute(sql)
+    return time.perf_counter() - start
+
+
+def benchmark_add_file(conn, rows, file_chunks):
+    """Time adding file_chunks chunks to a corpus of rows chunks, both ways.
+
+    The corpus is made of copies of the real text_chunks rows, loaded into two temp tables so the real tables
+    are not touched.
+
+    Returns:
+        legacy_seconds float: insert, UPDATE of every row and DROP/CREATE of the GIN index
+        generated_seconds float: insert into the generated column with the GIN index updated in place
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT count(*) FROM text_chunks;")
+    available = cursor.fetchone()[0]
+    if available == 0:
+        raise ValueError("text_chunks is empty, populate the database first")
+    copies = -(-rows // available)
+
+    cursor.execute("""
+        CREATE TEMP TABLE legacy_chunks (id bigint, text TEXT, text_vectors tsvector);
+        CREATE TEMP TABLE generated_chunks (id bigint, text TEXT, text_vectors tsvector GENERATED ALWAYS AS ({0}) STORED);
+    """.format(TEXT_VECTORS_SQL))
+    cursor.execute("""
+        INSERT INTO legacy_chunks (id, text)
+        SELECT row_number() OVER (), text FROM text_chunks, generate_series(1, %s) LIMIT %s;
+    """, (copies, rows))
+    cursor.execute("UPDATE legacy_chunks SET text_vectors = to_tsvector('english', text);")
+    cursor.execute("INSERT INTO generated_chunks (id, text) SELECT id, text FROM legacy_chunks;")
+    cursor.execute("""
+        CREATE INDEX legacy_chunks_idx ON legacy_chunks USING gin(text_vectors);
+        CREATE INDEX generated_chunks_idx ON generated_chunks USING gin(text_vectors);
+        CREATE TEMP TABLE new_file AS SELECT text FROM text_chunks ORDER BY random() LIMIT {0};
+        ANALYZE legacy_chunks; ANALYZE generated_chunks;
+    """.format(int(file_chunks)))
+    conn.commit()
+
+    # What add_file_to_db.py used to do after loading one filing
+    legacy_seconds = _timed(cursor, f"INSERT INTO legacy_chunks (id, text) SELECT {rows} + row_number() OVER (), text FROM new_file;")
+    legacy_seconds += _timed(cursor, "UPDATE legacy_chunks SET text_vectors = to_tsvector('english', text);")
+    legacy_seconds += _timed(cursor, "DROP INDEX legacy_chunks_idx; CREATE INDEX legacy_chunks_idx ON legacy_chunks USING gin(text_vectors);")
+    conn.commit()
+
+    generated_seconds = _timed(cursor, f"INSERT INTO generated_chunks (id, text) SELECT {rows} + row_number() OVER (), text FROM new_file;")
+    conn.commit()
+
+    cursor.execute("DROP TABLE legacy_chunks, generated_chunks, new_file;")
+    conn.commit()
+    cursor.close()
+    return legacy_seconds, generated_seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate text_vectors to a generated column and time adding a file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("migrate", help="convert text_chunks.text_vectors into a generated column")
+    benchmark_parser = subparsers.add_parser("benchmark", help="time adding one filing with the old and the new maintenance")
+    benchmark_parser.add_argument("--rows", type=int, default=200000, help="corpus size, built from copies of text_chunks")
+    benchmark_parser.add_argument("--file-chunks", type=int, default=300, help="chunks in the added filing")
+    args = parser.parse_args()
+
+    with connection() as conn:
+        if args.command == "migrate":
+            with conn.cursor() as cursor:
+                if text_vectors_generated(cursor):
+                    print("text_chunks.text_vectors is already a generated column")
+            migrate_text_vectors(conn)
+        else:
+            legacy_seconds, generated_seconds = benchmark_add_file(conn, args.rows, args.file_chunks)
+            print(f"Adding {args.file_chunks} chunks to {args.rows} chunks")
+            print(f"{'UPDATE + index rebuild':<26}{legacy_seconds * 1000:>12.1f} ms")
+            print(f"{'generated column':<26}{generated_seconds * 1000:>12.1f} ms")
+            print(f"speedup {legacy_seconds / generated_seconds:.1f}x")
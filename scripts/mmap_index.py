@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import shutil
+import time
+import numpy as np
+from db_pool import connection
+from db_schema import corpus_state
+from metadata_bitmap import MetadataBitmapIndex
+
+# In-process alternative to the pgvector vector branch of retrieve_n. export_index() copies every embedding into a
+# memory-mapped float32 matrix (rows L2-normalized, so a dot product is the cosine similarity) next to parallel arrays
+# with the chunk id, company, year and fiscal quarter of every row and the chunk texts. A filtered top-k is one
+# matrix-vector product over the rows that pass the filters and an argpartition, no database round trip.
+#
+# The export is a snapshot, run export again after ingesting (status tells whether it is behind the database).
+#
+# Usage:
+#   python mmap_index.py export
+#   python mmap_index.py status
+#   python mmap_index.py benchmark --candidate-k 200 --repeats 3
+#
+# retrieve_n(query, vector_backend=MmapVectorIndex()) uses it.
+
+MMAP_INDEX_DIR = "mmap_index"
+EMBEDDING_DIM = 768
+# Metadata columns kept as integer codes into a per column vocabulary
+METADATA_COLUMNS = ("company", "year", "fiscal_quarter")
+EXPORT_BATCH_SIZE = 5000
+
+
+def export_index(conn, path=MMAP_INDEX_DIR, verbose=True):
+    """Write embedding_chunks and the chunk texts to a memory-mappable index directory.
+
+    The new index is written next to the old one and swapped in when complete, readers that already opened the old
+    files keep working on them.
+
+    Args:
+        conn (psycopg2.connection): database connection
+        path (str, optional): index directory. Defaults to MMAP_INDEX_DIR.
+        verbose (bool, optional): print progress. Defaults to True.
+
+    Returns:
+        int: number of exported rows
+    """
+    start = time.perf_counter()
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    # The count, the corpus state and the row stream have to see the same snapshot: under READ COMMITTED a filing
+    # re-ingested in between would leave fewer rows than the matrix was sized for
+    conn.rollback()
+    with conn.cursor() as cursor:
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+        state = corpus_state(cursor)
+        cursor.execute("SELECT count(*) FROM embedding_chunks JOIN text_chunks USING (id);")
+        num_rows = cursor.fetchone()[0]
+
+    embeddings = np.lib.format.open_memmap(os.path.join(tmp_path, "embeddings.npy"), mode="w+", dtype=np.float32,
+                                           shape=(num_rows, EMBEDDING_DIM))
+    ids = np.empty(num_rows, dtype=np.int64)
+    vocabularies = {column: {} for column in METADATA_COLUMNS}
+    codes = {column: np.empty(num_rows, dtype=np.int16) for column in METADATA_COLUMNS}
+    text_offsets = np.zeros(num_rows + 1, dtype=np.int64)
+
+    # Named cursor so the rows are streamed instead of loaded into memory at once
+    with conn.cursor(name="mmap_index_export") as cursor, open(os.path.join(tmp_path, "texts.bin"), "wb") as texts_file:
+        cursor.itersize = EXPORT_BATCH_SIZE
+        cursor.execute("""
+            SELECT e.id, e.embedding::real[], e.company, e.year, e.fiscal_quarter, t.text
+            FROM embedding_chunks e JOIN text_chunks t USING (id)
+            ORDER BY e.id;
+        """)
+        row_index = 0
+        for chunk_id, embedding, company, year, fiscal_quarter, text in cursor:
+            if row_index == num_rows:
+                break
+            vector = np.asarray(embedding, dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            embeddings[row_index] = vector / norm if norm > 0 else vector
+            ids[row_index] = chunk_id
+            for column, value in zip(METADATA_COLUMNS, (company, year, fiscal_quarter)):
+                vocabulary = vocabularies[column]
+                codes[column][row_index] = vocabulary.setdefault(str(value), len(vocabulary))
+            encoded = (text or "").encode("utf-8")
+            texts_file.write(encoded)
+            text_offsets[row_index + 1] = text_offsets[row_index] + len(encoded)
+            row_index += 1
+    conn.rollback()
+    num_rows = row_index
+
+    embeddings.flush()
+    del embeddings
+    np.save(os.path.join(tmp_path, "ids.npy"), ids[:num_rows])
+    np.save(os.path.join(tmp_path, "text_offsets.npy"), text_offsets[:num_rows + 1])
+    for column in METADATA_COLUMNS:
+        np.save(os.path.join(tmp_path, f"{column}.npy"), codes[column][:num_rows])
+    with open(os.path.join(tmp_path, "meta.json"), "w") as meta_file:
+        json.dump({
+            "rows": num_rows,
+            "dim": EMBEDDING_DIM,
+            "vocabularies": {column: list(vocabulary) for column, vocabulary in vocabularies.items()},
+            "corpus": state,
+            "exported_at": time.time(),
+        }, meta_file)
+
+    old_path = path + ".old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    if verbose:
+        print(f"Exported {num_rows} chunks to {path} in {time.perf_counter() - start:.1f}s")
+    return num_rows
+
+
+class MmapVectorIndex:
+    """Read-only, memory-mapped copy of embedding_chunks for in-process vector search.
+
+    Safe to share between threads. Pages of the matrix are loaded by the OS on first access and shared between
+    processes that map the same export.
+
+    Args:
+        path (str, optional): directory written by export_index(). Defaults to MMAP_INDEX_DIR.
+    """
+
+    def __init__(self, path=MMAP_INDEX_DIR):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            self.meta = json.load(meta_file)
+        # Exports written before the snapshot fix can have unused zero rows at the end of the matrix
+        self.embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")[:self.meta["rows"]]
+        self.ids = np.load(os.path.join(path, "ids.npy"))
+        self.text_offsets = np.load(os.path.join(path, "text_offsets.npy"), mmap_mode="r")
+        self.texts_blob = np.memmap(os.path.join(path, "texts.bin"), dtype=np.uint8, mode="r") \
+            if self.text_offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+        self.codes = {column: np.load(os.path.join(path, f"{column}.npy")) for column in METADATA_COLUMNS}
+        # Filters are evaluated with packed bitsets per metadata value
+        self.metadata = MetadataBitmapIndex(self.ids, {
+            column: np.asarray(self.meta["vocabularies"][column], dtype=object)[self.codes[column]]
+            for column in METADATA_COLUMNS
+        })
+
+    def __len__(self):
+        return len(self.ids)
+
+    def filter_rows(self, company_filter=(), year_filter=(), quarters_filter=()):
+        """Row numbers matching every non-empty filter, None if nothing is filtered."""
+        return self.metadata.rows(company_filter, year_filter, quarters_filter)
+
+    def rows_of(self, ids):
+        """Row numbers of the chunk ids that are part of the export."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(self.ids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return positions[self.ids[positions] == ids]
+
+    def search(self, embedding, k=None, company_filter=(), year_filter=(), quarters_filter=(), candidate_ids=None):
+        """Filtered top-k by cosine similarity.
+
+        Args:
+            embedding (array-like): query embedding, normalized here
+            k (int, optional): number of rows to return. Defaults to None (every row passing the filters).
+            company_filter, year_filter, quarters_filter (list, optional): same semantics as in retrieve_n
+            candidate_ids (np.ndarray, optional): only search these chunk ids (already filtered by a
+                MetadataBitmapIndex), the filters are ignored then. Defaults to None.
+
+        Returns:
+            ids np.ndarray: chunk ids, best first
+            scores np.ndarray: cosine similarity of every returned row
+        """
+        query = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+        if candidate_ids is not None:
+            rows = self.rows_of(candidate_ids)
+        else:
+            rows = self.filter_rows(company_filter, year_filter, quarters_filter)
+        scores = self.embeddings @ query if rows is None else self.embeddings[rows] @ query
+        if k is not None and k < len(scores):
+            if k <= 0:
+                return self.ids[:0], scores[:0].astype(np.float64)
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best], kind="stable")]
+        else:
+            best = np.argsort(-scores, kind="stable")
+        positions = best if rows is None else rows[best]
+        return self.ids[positions], scores[best].astype(np.float64)
+
+    def texts(self, ids):
+        """Text of several chunks, same contract as pgvector_db_funcs.fetch_texts().
+
+        Returns:
+            texts dict(int, str): chunk id to text, ids missing from the export are left out
+        """
+        texts = {}
+        for position in self.rows_of(ids):
+            start, end = self.text_offsets[position], self.text_offsets[position + 1]
+            texts[int(self.ids[position])] = bytes(self.texts_blob[start:end]).decode("utf-8")
+        return texts
+
+    def is_stale(self, conn):
+        """True if embedding_chunks changed since the export."""
+        with conn.cursor() as cursor:
+            state = corpus_state(cursor)
+        conn.rollback()
+        return state != self.meta["corpus"]
+
+
+def benchmark(candidate_k=200, repeats=1, path=MMAP_INDEX_DIR):
+    """Compare retrieve_n latency and results with the pgvector and the in-process vector branch on eval_dataset.json."""
+    from retrieval_benchmark import load_eval_queries, time_retrieval, print_latency_row
+    from pgvector_db_funcs import retrieve_n
+    from llm import extract_query_details
+    from embedding_cache import QueryEmbeddingCache
+    from embedding_gen import embedding_model_id
+
+    index = MmapVectorIndex(path)
+    queries = load_eval_queries()
+    # Query embeddings are cached so both backends are timed on retrieval alone
+    cache = QueryEmbeddingCache(embedding_model_id())
+    modes = [
+        ("vector only", dict(hybrid_search=False, chunk_filter=False, candidate_k=candidate_k)),
+        ("hybrid", dict(hybrid_search=True, chunk_filter=False, candidate_k=candidate_k)),
+    ]
+    time_retrieval(queries, embedding_cache=cache)
+
+    print(f"\n{len(queries) * repeats} queries against {len(index)} exported chunks, candidate_k={candidate_k} (latency in ms)")
+    print(f"{'mode':<34}{'mean':>10}{'p50':>10}{'p95':>10}")
+    for name, kwargs in modes:
+        print_latency_row(f"{name}, pgvector", time_retrieval(queries, repeats, embedding_cache=cache, **kwargs))
+        print_latency_row(f"{name}, mmap", time_retrieval(queries, repeats, embedding_cache=cache, vector_backend=index, **kwargs))
+
+    # Same chunks? Differences come from ties and from the HNSW index being approximate
+    for name, kwargs in modes:
+        overlaps = []
+        for query in queries:
+            details = extract_query_details(query)
+            args = (query, 5, details["Companies"], details["Years"], details["Quarters"])
+            expected = retrieve_n(*args, embedding_cache=cache, **kwargs) or []
+            actual = retrieve_n(*args, embedding_cache=cache, vector_backend=index, **kwargs) or []
+            if expected:
+                overlaps.append(len(set(expected) & set(actual)) / len(expected))
+        print(f"{name}: {np.mean(overlaps):.3f} mean overlap of the top 5 with the pgvector path")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory-mapped in-process vector index")
+    parser.add_argument("--path", default=MMAP_INDEX_DIR, help="index directory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("export", help="export embedding_chunks and the chunk texts")
+    subparsers.add_parser("status", help="size of the export and whether it is behind the database")
+    benchmark_parser = subparsers.add_parser("benchmark", help="retrieve_n latency with the pgvector and the mmap vector branch")
+    benchmark_parser.add_argument("--candidate-k", type=int, default=200)
+    benchmark_parser.add_argument("--repeats", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        with connection() as conn:
+            export_index(conn, args.path)
+    elif args.command == "status":
+        index = MmapVectorIndex(args.path)
+        print(f"{len(index)} chunks, {index.embeddings.nbytes / 1024 ** 2:.1f} MB of embeddings, "
+              f"{index.text_offsets[-1] / 1024 ** 2:.1f} MB of text")
+        with connection() as conn:
+            print("stale, run export again" if index.is_stale(conn) else "up to date")
+    else:
+        benchmark(args.candidate_k, args.repeats, args.path)
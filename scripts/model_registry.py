@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+# Process wide registry of the Hugging Face models and tokenizers. Nothing is loaded at import time: every model
+# and tokenizer is loaded on first use, exactly once, and shared by every module that asks for it. transformers and
+# torch are only imported at that point as well.
+
+MODEL_NAME = "yiyanghkust/finbert-tone"
+
+# Inference backends for the embedding model:
+#   torch  full precision PyTorch model (default)
+#   int8   PyTorch model with its Linear layers dynamically quantized to int8
+#   onnx   graph exported to ONNX and run with ONNX Runtime (needs the onnxruntime package)
+BACKENDS = ("torch", "int8", "onnx")
+DEFAULT_BACKEND = "torch"
+# Exported ONNX graphs are kept here and reused by later runs
+ONNX_DIR = "onnx_models"
+
+_tokenizers = {}
+_models = {}
+# Seconds spent loading every entry, keyed by ("tokenizer", name) or ("model", name, backend)
+load_seconds = {}
+# Reentrant because loading the onnx backend needs the tokenizer
+_lock = threading.RLock()
+
+
+def get_tokenizer(name=MODEL_NAME):
+    """Return the tokenizer of a model, loading it on the first call.
+
+    Args:
+        name (str, optional): Hugging Face model name. Defaults to MODEL_NAME.
+
+    Returns:
+        PreTrainedTokenizerFast: shared tokenizer instance
+    """
+    tokenizer = _tokenizers.get(name)
+    if tokenizer is None:
+        with _lock:
+            tokenizer = _tokenizers.get(name)
+            if tokenizer is None:
+                from transformers import AutoTokenizer
+                start = time.perf_counter()
+                tokenizer = AutoTokenizer.from_pretrained(name)
+                load_seconds[("tokenizer", name)] = time.perf_counter() - start
+                _tokenizers[name] = tokenizer
+    return tokenizer
+
+
+class OnnxEncoder:
+    """Runs an exported encoder with ONNX Runtime behind the same call interface as the PyTorch model.
+
+    Called with the tokenizer's PyTorch tensors and returns an object with a last_hidden_state tensor, so
+    embedding_gen does not need to know which backend it is using.
+    """
+
+    def __init__(self, onnx_path, config, threads=None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.config = config
+
+    def __call__(self, **inputs):
+        import torch
+        feed = {name: inputs[name].cpu().numpy() for name in self.input_names if name in inputs}
+        last_hidden_state = self.session.run(["last_hidden_state"], feed)[0]
+        return SimpleNamespace(last_hidden_state=torch.from_numpy(last_hidden_state))
+
+
+def _export_onnx(model, tokenizer, name):
+    """Export model to ONNX once and return the file path."""
+    import torch
+    onnx_path = os.path.join(ONNX_DIR, name.replace("/", "__") + ".onnx")
+    if os.path.exists(onnx_path):
+        return onnx_path
+    os.makedirs(ONNX_DIR, exist_ok=True)
+    sample = tokenizer("export sample", return_tensors="pt")
+    input_names = list(sample.keys())
+    dynamic_axes = {input_name: {0: "batch", 1: "sequence"} for input_name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    with torch.no_grad():
+        torch.onnx.export(model, (dict(sample),), onnx_path, input_names=input_names,
+                          output_names=["last_hidden_state"], dynamic_axes=dynamic_axes, opset_version=14)
+    return onnx_path
+
+
+def _load_model(name, backend):
+    from transformers import AutoModel
+    model = AutoModel.from_pretrained(name)
+    model.eval()
+    if backend == "int8":
+        import torch
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if backend == "onnx":
+        model.config.return_dict = True
+        return OnnxEncoder(_export_onnx(model, get_tokenizer(name), name), model.config)
+    return model
+
+
+def get_model(name=MODEL_NAME, backend=DEFAULT_BACKEND):
+    """Return a model (without classification head) in eval mode, loading it on the first call.
+
+    Args:
+        name (str, optional): Hugging Face model name. Defaults to MODEL_NAME.
+        backend (str, optional): one of BACKENDS. Defaults to DEFAULT_BACKEND.
+
+    Returns:
+        PreTrainedModel | OnnxEncoder: shared model instance
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend {backend}, use one of {', '.join(BACKENDS)}")
+    key = (name, backend)
+    model = _models.get(key)
+    if model is None:
+        with _lock:
+            model = _models.get(key)
+            if model is None:
+                start = time.perf_counter()
+                model = _load_model(name, backend)
+                load_seconds[("model", name, backend)] = time.perf_counter() - start
+                _models[key] = model
+    return model
+
+
+def warm_up(name=MODEL_NAME, model=True, backend=None):
+    """Load the tokenizer (and model) now instead of on the first request, and run one forward pass.
+
+    Servers and long running scripts call this at startup so the first query does not pay for loading.
+
+    Args:
+        name (str, optional): Hugging Face model name. Defaults to MODEL_NAME.
+        model (bool, optional): also load the model, False only loads the tokenizer. Defaults to True.
+        backend (str, optional): backend to load. Defaults to the backend embedding_gen currently uses.
+
+    Returns:
+        float: seconds spent
+    """
+    start = time.perf_counter()
+    tokenizer = get_tokenizer(name)
+    if model:
+        import torch
+        if backend is None:
+            import embedding_gen
+            backend = embedding_gen.embedding_backend
+        with torch.no_grad():
+            get_model(name, backend)(**tokenizer("warm up", return_tensors="pt"))
+    return time.perf_counter() - start
+
+
+def loaded():
+    """Names of the tokenizers and models loaded in this process."""
+    return {"tokenizers": list(_tokenizers), "models": list(_models)}
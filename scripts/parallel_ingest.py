@@ -0,0 +1,209 @@
+import argparse
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import psycopg2
+import db_pool
+from db_schema import ensure_schema
+from ingest_manifest import IngestManifest, find_markdown_files, UNCHANGED
+
+# Ingests filings with a pool of worker processes, one filing per task. Every worker loads FinBERT once, caps its
+# torch threads so the workers do not oversubscribe the cores and writes through its own database connection.
+# The parent process only plans the run with the manifest and aggregates progress, it never loads the model.
+#
+# Usage:
+#   python parallel_ingest.py --workers 8
+#   python parallel_ingest.py --scaling 1,2,4,8 --limit 16     (dry run, nothing is written)
+#
+# Table summaries go to the LLM server, point OLLAMA_HOST at stub_llm_server.py to measure the rest of ingestion.
+
+BASE_DIR = "../md_files"
+MAX_CHUNK_LENGTH = 512
+
+# Per process state of a worker, set by _init_worker()
+_worker = {}
+
+
+class FileResult:
+    """Outcome of ingesting one filing in a worker."""
+
+    def __init__(self, file_path, chunks=0, seconds=0.0, error=None, quarantined=False, content_hashes=()):
+        self.file_path = file_path
+        self.chunks = chunks
+        self.seconds = seconds
+        self.error = error
+        self.quarantined = quarantined
+        # Hashes of the chunks that were written, everything else of the file is stale
+        self.content_hashes = content_hashes
+
+
+def default_torch_threads(workers):
+    """Split the cores evenly between the workers."""
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def _init_worker(torch_threads, dry_run):
+    # Has to happen before torch creates its thread pools
+    os.environ["OMP_NUM_THREADS"] = str(torch_threads)
+    os.environ["MKL_NUM_THREADS"] = str(torch_threads)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    import torch
+    torch.set_num_threads(torch_threads)
+    import embedding_gen
+    import chunking
+    import model_registry
+    # Load the tokenizer and the model once per worker, before the first file arrives
+    model_registry.warm_up()
+    _worker["embedding_gen"] = embedding_gen
+    _worker["chunking"] = chunking
+    _worker["writer"] = None
+    if not dry_run:
+        from bulk_writer import BulkChunkWriter
+        conn = psycopg2.connect(host=db_pool.host, port=db_pool.port, dbname=db_pool.dbname,
+                                user=db_pool.user, password=db_pool.password)
+        _worker["writer"] = BulkChunkWriter(conn)
+
+
+def _ingest_file(job):
+    """Chunk, summarize, embed and write one filing. Errors are returned instead of raised."""
+    start = time.perf_counter()
+    chunking = _worker["chunking"]
+    writer = _worker["writer"]
+    try:
+        with open(job.file_path, 'r', encoding='utf-8') as file:
+            content = file.read()
+        chunks = chunking.chunk_markdown(content, MAX_CHUNK_LENGTH, verbose=False)
+        # Tables are embedded using their summary but stored as the raw table
+        texts = [chunk[1] if isinstance(chunk, tuple) else chunk for chunk in chunks]
+        stored_chunks = [chunk[0] if isinstance(chunk, tuple) else chunk for chunk in chunks]
+        embeddings = _worker["embedding_gen"].generate_embeddings(texts)
+        quarantined = False
+        content_hashes = set()
+        if writer is not None:
+            for embedding, chunk in zip(embeddings, stored_chunks):
+                writer.add(embedding, chunk, job.company_name, job.doc_year, job.doc_type, job.fiscal_quarter,
+                           source_file=job.file_path)
+            writer.flush()
+            quarantined = job.file_path in writer.quarantined_files
+            content_hashes = writer.pop_file_hashes(job.file_path)
+        return FileResult(job.file_path, len(chunks), time.perf_counter() - start, quarantined=quarantined,
+                          content_hashes=content_hashes)
+    except Exception as error:
+        if writer is not None:
+            # Chunks of the failed file must not end up in the next file's batch
+            writer.discard()
+        return FileResult(job.file_path, 0, time.perf_counter() - start,
+                          error=f"{type(error).__name__}: {error}\n{traceback.format_exc()}")
+
+
+def run_parallel(jobs, workers, torch_threads=None, dry_run=False, on_result=None, verbose=True):
+    """Ingest jobs with a pool of worker processes.
+
+    Args:
+        jobs (list(FileJob)): filings to ingest
+        workers (int): number of worker processes
+        torch_threads (int, optional): torch threads per worker. Defaults to default_torch_threads(workers).
+        dry_run (bool, optional): chunk, summarize and embed without writing. Defaults to False.
+        on_result (callable, optional): called with every FileResult in the parent as soon as it arrives
+        verbose (bool, optional): print a progress line per file. Defaults to True.
+
+    Returns:
+        results list(FileResult): one result per job
+        seconds float: wall clock time including worker startup
+    """
+    torch_threads = torch_threads or default_torch_threads(workers)
+    start = time.perf_counter()
+    results = []
+    chunks = 0
+    # spawn keeps the workers from inheriting the parent's threads and connections
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(torch_threads, dry_run)) as pool:
+        futures = {pool.submit(_ingest_file, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                # The worker process itself died, the file is reported like any other failure
+                result = FileResult(futures[future].file_path, error=f"{type(error).__name__}: {error}")
+            results.append(result)
+            chunks += result.chunks
+            if on_result is not None:
+                on_result(result)
+            if verbose:
+                elapsed = time.perf_counter() - start
+                status = "FAILED" if result.error else f"{result.chunks} chunks in {result.seconds:.1f}s"
+                print(f"[{len(results)}/{len(futures)}] {result.file_path}: {status} "
+                      f"({len(results) / elapsed:.2f} files/s, {chunks / elapsed:.1f} chunks/s)")
+                if result.error:
+                    print(result.error)
+    return results, time.perf_counter() - start
+
+
+def print_scaling(rows):
+    print(f"\n{'workers':>8}{'threads':>9}{'files':>7}{'chunks':>8}{'wall s':>9}{'files/s':>9}{'chunks/s':>10}{'speedup':>9}")
+    base = rows[0][5] if rows else 0
+    for workers, threads, files, chunks, seconds, chunks_per_second in rows:
+        print(f"{workers:>8}{threads:>9}{files:>7}{chunks:>8}{seconds:>9.1f}{files / seconds:>9.2f}"
+              f"{chunks_per_second:>10.1f}{chunks_per_second / base if base else 0:>9.2f}")
+
+
+def ingest(base_dir, workers, torch_threads=None, force=False):
+    """Ingest the new and changed filings under base_dir in parallel, recording successful files in the manifest."""
+    import chunking
+    conn = psycopg2.connect(host=db_pool.host, port=db_pool.port, dbname=db_pool.dbname,
+                            user=db_pool.user, password=db_pool.password)
+    ensure_schema(conn)
+    manifest = IngestManifest(conn, chunking.CHUNKER_VERSION)
+    entries, removed = manifest.plan(find_markdown_files(base_dir), force=force)
+    pending = {entry.job.file_path: entry for entry in entries if entry.status != UNCHANGED}
+    print(f"{len(pending)} files to ingest, {len(entries) - len(pending)} unchanged, {len(removed)} removed")
+    for file_path in removed:
+        manifest.forget(file_path)
+
+    failed = []
+
+    def record(result):
+        if result.error or result.quarantined:
+            # Keeps its old chunks until a later run succeeds
+            failed.append(result.file_path)
+        else:
+            # The new version is committed, only now the chunks of older versions go
+            manifest.remove_chunks(pending[result.file_path].job, keep_hashes=result.content_hashes)
+            manifest.record(pending[result.file_path])
+
+    results, seconds = run_parallel([entry.job for entry in pending.values()], workers, torch_threads, on_result=record)
+    chunks = sum(result.chunks for result in results)
+    print(f"\nIngested {len(results) - len(failed)} of {len(results)} files, {chunks} chunks in {seconds:.1f}s "
+          f"({len(results) / seconds if seconds else 0:.2f} files/s, {chunks / seconds if seconds else 0:.1f} chunks/s)")
+    for file_path in failed:
+        print(f"FAILED (will be retried on the next run): {file_path}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest filings with a pool of worker processes")
+    parser.add_argument("--base-dir", default=BASE_DIR)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 1) // 2))
+    parser.add_argument("--torch-threads", type=int, default=None, help="torch threads per worker (cores / workers by default)")
+    parser.add_argument("--force", action="store_true", help="re-ingest files the manifest marks as unchanged")
+    parser.add_argument("--scaling", default=None, help="comma separated worker counts, runs a dry run per count and compares throughput")
+    parser.add_argument("--limit", type=int, default=None, help="only use the first N files in the scaling run")
+    args = parser.parse_args()
+
+    if args.scaling:
+        jobs = sorted(find_markdown_files(args.base_dir), key=lambda job: job.file_path)[:args.limit]
+        rows = []
+        for workers in [int(value) for value in args.scaling.split(",")]:
+            threads = args.torch_threads or default_torch_threads(workers)
+            results, seconds = run_parallel(jobs, workers, threads, dry_run=True, verbose=False)
+            chunks = sum(result.chunks for result in results)
+            errors = sum(1 for result in results if result.error)
+            print(f"{workers} workers: {len(jobs)} files in {seconds:.1f}s, {errors} failed")
+            rows.append((workers, threads, len(jobs), chunks, seconds, chunks / seconds))
+        print("(wall clock includes loading the model in every worker)")
+        print_scaling(rows)
+    else:
+        ingest(args.base_dir, args.workers, args.torch_threads, force=args.force)
@@ -1,73 +1,288 @@
-import psycopg2
-from embedding_gen import generate_embedding
-import re
-from sklearn.preprocessing import MinMaxScaler
-import pandas as pd
+from embedding_gen import generate_embedding, embedding_model_id
+from db_pool import connection, execute_prepared
+from vector_index import apply_search_settings, DEFAULT_EF_SEARCH
+from db_schema import corpus_generation
+from retrieval_cache import retrieval_key
+from chunk_flags import is_table_of_contents, remove_doc
+from psycopg2.errors import UndefinedTable
 import re
+import numpy as np
+
+# Hot retrieval queries, run as server-side prepared statements so they are only planned once per connection.
+# An empty filter array disables that filter. The boolean parameter is chunk_filter: it drops the chunks that were
+# flagged at ingest (chunk_filtered, see chunk_flags.py). Rows that were not flagged yet (NULL) are kept.
+VECTOR_SEARCH_STATEMENT = "retrieve_vector_search"
+VECTOR_SEARCH_PARAM_TYPES = ["vector", "text[]", "text[]", "text[]", "boolean"]
+VECTOR_SEARCH_SQL = """
+    SELECT id, 1 - (embedding <=> $1) AS cosine_similarity
+    FROM embedding_chunks
+    WHERE (cardinality($2) = 0 OR company = ANY($2))
+        AND (cardinality($3) = 0 OR year = ANY($3))
+        AND (cardinality($4) = 0 OR fiscal_quarter = ANY($4))
+        AND (NOT $5 OR chunk_filtered IS NOT TRUE)
+    ORDER BY embedding <=> $1
+"""
+
+FULL_TEXT_SEARCH_STATEMENT = "retrieve_full_text_search"
+FULL_TEXT_SEARCH_PARAM_TYPES = ["text", "boolean"]
+FULL_TEXT_SEARCH_SQL = """
+    SELECT id, text,
+        ts_rank(text_vectors, plainto_tsquery('english', $1)) AS rank
+    FROM text_chunks
+    WHERE NOT $2 OR chunk_filtered IS NOT TRUE
+    ORDER BY rank DESC
+"""
+
+# Candidate mode: each branch only returns its best $6 rows, and the metadata filters apply to both branches
+VECTOR_CANDIDATES_STATEMENT = "retrieve_vector_candidates"
+VECTOR_CANDIDATES_PARAM_TYPES = ["vector", "text[]", "text[]", "text[]", "boolean", "integer"]
+VECTOR_CANDIDATES_SQL = VECTOR_SEARCH_SQL + "    LIMIT $6\n"
+
+FULL_TEXT_CANDIDATES_STATEMENT = "retrieve_full_text_candidates"
+FULL_TEXT_CANDIDATES_PARAM_TYPES = ["text", "text[]", "text[]", "text[]", "boolean", "integer"]
+FULL_TEXT_CANDIDATES_SQL = """
+    SELECT id, text,
+        ts_rank(text_vectors, query) AS rank
+    FROM text_chunks, plainto_tsquery('english', $1) AS query
+    WHERE text_vectors @@ query
+        AND (cardinality($2) = 0 OR company = ANY($2))
+        AND (cardinality($3) = 0 OR year = ANY($3))
+        AND (cardinality($4) = 0 OR fiscal_quarter = ANY($4))
+        AND (NOT $5 OR chunk_filtered IS NOT TRUE)
+    ORDER BY rank DESC
+    LIMIT $6
+"""
+
+# Metadata index mode with more matching chunks than METADATA_ID_LIST_LIMIT: the full scan of the full text branch
+# applies the column filters instead of the id list, so a metadata index always filters the full text branch
+FULL_TEXT_SEARCH_FILTERED_STATEMENT = "retrieve_full_text_search_filtered"
+FULL_TEXT_SEARCH_FILTERED_PARAM_TYPES = ["text", "text[]", "text[]", "text[]", "boolean"]
+FULL_TEXT_SEARCH_FILTERED_SQL = """
+    SELECT id, text,
+        ts_rank(text_vectors, plainto_tsquery('english', $1)) AS rank
+    FROM text_chunks
+    WHERE (cardinality($2) = 0 OR company = ANY($2))
+        AND (cardinality($3) = 0 OR year = ANY($3))
+        AND (cardinality($4) = 0 OR fiscal_quarter = ANY($4))
+        AND (NOT $5 OR chunk_filtered IS NOT TRUE)
+    ORDER BY rank DESC
+"""
+
+# Metadata index mode: the filters are resolved to chunk ids up front (see metadata_bitmap.py), so every branch,
+# full scan mode included, only looks at the matching chunks
+VECTOR_SEARCH_BY_ID_STATEMENT = "retrieve_vector_search_by_id"
+VECTOR_SEARCH_BY_ID_PARAM_TYPES = ["vector", "bigint[]", "boolean"]
+VECTOR_SEARCH_BY_ID_SQL = """
+    SELECT id, 1 - (embedding <=> $1) AS cosine_similarity
+    FROM embedding_chunks
+    WHERE id = ANY($2)
+        AND (NOT $3 OR chunk_filtered IS NOT TRUE)
+    ORDER BY embedding <=> $1
+"""
+
+VECTOR_CANDIDATES_BY_ID_STATEMENT = "retrieve_vector_candidates_by_id"
+VECTOR_CANDIDATES_BY_ID_PARAM_TYPES = ["vector", "bigint[]", "boolean", "integer"]
+VECTOR_CANDIDATES_BY_ID_SQL = VECTOR_SEARCH_BY_ID_SQL + "    LIMIT $4\n"
+
+FULL_TEXT_SEARCH_BY_ID_STATEMENT = "retrieve_full_text_search_by_id"
+FULL_TEXT_SEARCH_BY_ID_PARAM_TYPES = ["text", "bigint[]", "boolean"]
+FULL_TEXT_SEARCH_BY_ID_SQL = """
+    SELECT id, text,
+        ts_rank(text_vectors, plainto_tsquery('english', $1)) AS rank
+    FROM text_chunks
+    WHERE id = ANY($2)
+        AND (NOT $3 OR chunk_filtered IS NOT TRUE)
+    ORDER BY rank DESC
+"""
 
-# Connection parameters
-host = "localhost"         # Hostname (since you've mapped the container port)
-port = "5432"              # Port you mapped (5432)
-dbname = "vectordb"     # Name of your database
-user = "admin"           # Username you provided during setup
-password = "adminpass"   # Password you provided during setup
+FULL_TEXT_CANDIDATES_BY_ID_STATEMENT = "retrieve_full_text_candidates_by_id"
+FULL_TEXT_CANDIDATES_BY_ID_PARAM_TYPES = ["text", "bigint[]", "boolean", "integer"]
+FULL_TEXT_CANDIDATES_BY_ID_SQL = """
+    SELECT id, text,
+        ts_rank(text_vectors, query) AS rank
+    FROM text_chunks, plainto_tsquery('english', $1) AS query
+    WHERE text_vectors @@ query
+        AND id = ANY($2)
+        AND (NOT $3 OR chunk_filtered IS NOT TRUE)
+    ORDER BY rank DESC
+    LIMIT $4
+"""
 
-def is_table_of_contents(table_text, debug = False):
+# Above this many matching chunks the id list costs more to send than the column filters cost to evaluate, the SQL
+# branches then fall back to the column filters (in-process backends always use the ids)
+METADATA_ID_LIST_LIMIT = 20000
+
+# Compact mode: the vector branch first ranks the compact codes (see db_schema.COMPACT_COLUMNS), keeps the best $5 and
+# reranks only those by exact cosine distance on the full precision embedding, returning the best $7.
+# mode -> (column, distance operator, query code)
+COMPACT_MODES = {
+    "half": ("embedding_half", "<#>", "l2_normalize($1)::halfvec(768)"),
+    "binary": ("embedding_bits", "<~>", "binary_quantize($1)::bit(768)"),
+}
+COMPACT_PARAM_TYPES = ["vector", "text[]", "text[]", "text[]", "boolean", "integer", "integer"]
+COMPACT_BY_ID_PARAM_TYPES = ["vector", "bigint[]", "boolean", "integer", "integer"]
+# Rows of the first pass that get reranked when retrieve_n() is not given rerank_k
+COMPACT_RERANK_CANDIDATES = 200
+
+
+def compact_search_sql(mode, by_id=False):
+    """Prepared statement name and SQL of the compact first pass plus exact rerank.
+
+    With by_id the rows are restricted by a chunk id array ($2) instead of the three filter arrays, the parameters
+    are then COMPACT_BY_ID_PARAM_TYPES. Both take the chunk_filter flag right after the filters.
     """
-    Determine if a given markdown table represents a table of contents.
-    
-    Parameters:
-        table_text (str): Markdown representation of a table.
-    
+    column, operator, query_code = COMPACT_MODES[mode]
+    if by_id:
+        where = "id = ANY($2) AND (NOT $3 OR chunk_filtered IS NOT TRUE)"
+        rerank_param, limit_param = "$4", "$5"
+    else:
+        where = """(cardinality($2) = 0 OR company = ANY($2))
+            AND (cardinality($3) = 0 OR year = ANY($3))
+            AND (cardinality($4) = 0 OR fiscal_quarter = ANY($4))
+            AND (NOT $5 OR chunk_filtered IS NOT TRUE)"""
+        rerank_param, limit_param = "$6", "$7"
+    return f"retrieve_compact_{mode}{'_by_id' if by_id else ''}", f"""
+    WITH candidates AS (
+        SELECT id, embedding
+        FROM embedding_chunks
+        WHERE {where}
+        ORDER BY {column} {operator} {query_code}
+        LIMIT {rerank_param}
+    )
+    SELECT id, 1 - (embedding <=> $1) AS cosine_similarity
+    FROM candidates
+    ORDER BY embedding <=> $1
+    LIMIT {limit_param}
+"""
+
+# Number of candidates chunk filtering looks at before the top n are returned. Only rows from the in-process backends
+# are filtered that way, SQL branches drop flagged chunks in the query itself
+CHUNK_FILTER_CANDIDATES = 100
+# Weights of the two branches for weighted fusion
+VECTOR_WEIGHT = 0.80
+FULL_TEXT_WEIGHT = 0.20
+# Rank offset for reciprocal rank fusion, 60 is the value from the original RRF paper
+RRF_K = 60
+
+# Words removed from the query before full text search, these are already covered by the metadata filters
+QUERY_STOPWORDS = [
+    'apple', 
+    'tesla', 
+    'nvidia', 
+    'microsoft', 
+    'meta', 
+    'google', 
+    'berkshire', 
+    'hathaway', 
+    'amazon', 
+    'q1', 
+    'q2', 
+    'q3', 
+    'q4', 
+    '2025', 
+    '2024', 
+    '2023', 
+    '2022', 
+    '2021', 
+    '10q', 
+    '10k', 
+    '10q-10k', 
+    '10q/10k'
+]
+
+def filter_query(query):
+    """Lowercase the query and drop QUERY_STOPWORDS so it can be used for full text search."""
+    query_words = re.findall(r'\w+', query.lower())
+    filtered_words = [word for word in query_words if word not in QUERY_STOPWORDS]
+    return ' '.join(filtered_words)
+
+def _min_max(values):
+    """Scale values to [0, 1]. A constant array maps to 0 like sklearn's MinMaxScaler."""
+    if len(values) == 0:
+        return values
+    value_range = values.max() - values.min()
+    if value_range == 0:
+        return np.zeros_like(values)
+    return (values - values.min()) / value_range
+
+def _ranks(scores):
+    """1 based rank of every score, highest score first."""
+    ranks = np.empty(len(scores), dtype=np.float64)
+    ranks[np.argsort(-scores, kind="stable")] = np.arange(1, len(scores) + 1)
+    return ranks
+
+def fuse_scores(vector_ids, vector_scores, text_ids, text_scores, top, hybrid_search=True, fusion="weighted"):
+    """Combine both search branches and select the best rows with NumPy.
+
+    Args:
+        vector_ids (np.ndarray): chunk ids returned by the vector branch
+        vector_scores (np.ndarray): cosine similarity of every vector row
+        text_ids (np.ndarray): chunk ids returned by the full text branch
+        text_scores (np.ndarray): ts_rank of every full text row
+        top (int): number of rows to keep
+        hybrid_search (bool, optional): rank by the combined score, otherwise by cosine similarity. Defaults to True.
+        fusion (str, optional): "weighted" (min-max normalized weighted sum) or "rrf" (reciprocal rank fusion). Defaults to "weighted".
+
     Returns:
-        bool: True if it is a table of contents, False otherwise.
+        ids np.ndarray: ids of the kept rows, best first
+        scores np.ndarray: combined score of the kept rows
+        cosine np.ndarray: (normalized) cosine similarity of the kept rows
+        text_rows np.ndarray: index of every kept row in the full text branch, -1 if it only came from the vector branch
     """
-    # Normalize whitespace
-    table_text = re.sub(r'\s+', ' ', table_text.strip())
-    
-    # Check for Markdown table formatting or list-based structure
-    is_markdown_table = bool(re.search(r'\|.*?\|.*?\|', table_text))  # At least three columns
-    is_list_structure = bool(re.search(r'-\s+\*\*Item \d+[A-Z]?\.\*\*', table_text))  # Detect list-based items
-    
-    # Check for key columns in the header
-    has_item_column = bool(re.search(r'\b(Item|Section)\b', table_text, re.IGNORECASE))    
-    
-    # Check for typical TOC keywords in the body
-    toc_keywords = [
-        r'Financial Statements', 
-        r'\bManagement’s Discussion\b', 
-        r'Risk Factor', 
-        r'\bControls and Procedures\b',
-        r'\bLegal Proceedings\b',
-        r'\bExhibits\b',
-        r'\bQuantitative and Qualitative Disclosures\b',
-        r'\bPart\s+[IVX]+',
-        r'\bSignatures\b',
-    ]
-    has_toc_keywords = any(re.search(keyword, table_text, re.IGNORECASE) for keyword in toc_keywords)
+    num_vector = len(vector_ids)
+    ids, inverse = np.unique(np.concatenate([vector_ids, text_ids]).astype(np.int64), return_inverse=True)
+    vector_pos, text_pos = inverse[:num_vector], inverse[num_vector:]
 
-    # Determine if the table is a TOC
-    return (is_markdown_table or is_list_structure) and has_item_column and has_toc_keywords 
+    # Missing scores are -1 before normalization, so they count as the minimum of their branch
+    cosine = np.full(len(ids), -1.0)
+    cosine[vector_pos] = vector_scores
+    full_text = np.full(len(ids), -1.0)
+    full_text[text_pos] = text_scores
+    text_rows = np.full(len(ids), -1, dtype=np.int64)
+    text_rows[text_pos] = np.arange(len(text_ids))
 
+    if fusion == "rrf":
+        scores = np.zeros(len(ids))
+        scores[vector_pos] += 1 / (RRF_K + _ranks(np.asarray(vector_scores, dtype=np.float64)))
+        scores[text_pos] += 1 / (RRF_K + _ranks(np.asarray(text_scores, dtype=np.float64)))
+    else:
+        cosine = _min_max(cosine)
+        full_text = _min_max(full_text)
+        scores = VECTOR_WEIGHT * cosine + FULL_TEXT_WEIGHT * full_text
 
+    # Partial selection of the top rows, only those get sorted
+    sort_key = scores if hybrid_search else cosine
+    top = min(top, len(ids))
+    if top == 0:
+        return ids[:0], scores[:0], cosine[:0], text_rows[:0]
+    best = np.argpartition(-sort_key, top - 1)[:top]
+    best = best[np.argsort(-sort_key[best], kind="stable")]
+    return ids[best], scores[best], cosine[best], text_rows[best]
 
-def remove_doc(document_text, verbose = False):
-    """Function to use various heuristics and regex establish whether to filter out chunks.
+class RetrievedChunk(tuple):
+    """(text,) row returned by retrieve_n() that also carries the chunk id.
 
-    Args:
-        document_text (str): chunk to filter. Defaults to "".
-        verbose (bool, optional): Flag to print debugging and other print statements to command line. Defaults to False.
+    Behaves (and prints) exactly like the plain (text,) tuples callers index with [0], the id is an extra attribute
+    used e.g. by the answer cache to key on the retrieved chunks.
+    """
+
+    def __new__(cls, text, chunk_id=None):
+        chunk = super().__new__(cls, (text,))
+        chunk.id = chunk_id
+        return chunk
+
+def fetch_texts(cursor, ids):
+    """Fetch the text of several chunks with a single query.
 
     Returns:
-        filter bool: True if doc should be removed, false if otherwise
+        texts dict(int, str): chunk id to text
     """
+    if len(ids) == 0:
+        return {}
+    cursor.execute("SELECT id, text FROM text_chunks WHERE id = ANY(%s);", ([int(chunk_id) for chunk_id in ids],))
+    return dict(cursor.fetchall())
     
-    is_TOC = is_table_of_contents(document_text)
-    
-    return is_TOC
-    
-    
-def retrieve_n(query = "", n = 5, company_filter = [], year_filter = [], quarters_filter = [], hybrid_search = True, chunk_filter = True, verbose = False):
+def retrieve_n(query = "", n = 5, company_filter = [], year_filter = [], quarters_filter = [], hybrid_search = True, chunk_filter = True, verbose = False, candidate_k = None, fusion = "weighted", ef_search = None, probes = None, embedding_cache = None, compact_mode = None, rerank_k = None, vector_backend = None, lexical_backend = None, metadata_index = None, embedder = None, result_cache = None):
     """Function to retrieve the top n related chunks from the pgvector database using cosine similarity
 
     Args:
@@ -76,169 +291,219 @@ def retrieve_n(query = "", n = 5, company_filter = [], year_filter = [], quarter
         company_filter (list, optional): list of strings where each string is a company identified from the query. Defaults to [].
         year_filter (list, optional): list of ints where each int is a year identified from the query. Defaults to [].
         quarters_filter (list, optional): list of strings where each string is a quarter identified from the query. Defaults to [].
+        chunk_filter (bool, optional): Drop chunks flagged at ingest (chunk_filtered, e.g. tables of contents) inside the
+            search queries. Rows of the in-process backends are checked with remove_doc() instead. Defaults to True.
         verbose (bool, optional): Flag to print debugging and other print statements to command line. Defaults to False.
+        candidate_k (int, optional): If set, each search branch only returns its top candidate_k chunks (with the metadata
+            filters applied to full text search too) instead of scoring every row. Defaults to None (score every row).
+        fusion (str, optional): How candidate mode combines the two branches, "weighted" or "rrf". Defaults to "weighted".
+        ef_search (int, optional): hnsw.ef_search for the vector branch. In candidate mode it is raised to at least candidate_k
+            because an HNSW scan never returns more than ef_search rows. pgvector caps it at 1000 (vector_index.MAX_EF_SEARCH),
+            so an HNSW index returns at most 1000 candidates per branch. Defaults to None (server setting).
+        probes (int, optional): ivfflat.probes for the vector branch. Defaults to None (server setting).
+        embedding_cache (QueryEmbeddingCache, optional): cache consulted before embedding the query. Defaults to None.
+        compact_mode (str, optional): "half" or "binary" runs the vector branch on the compact columns and reranks the best
+            rerank_k rows by exact cosine similarity, only those rows take part in fusion. Needs
+            db_schema.ensure_compact_columns(). Defaults to None (full precision vectors only).
+        rerank_k (int, optional): rows of the compact first pass that get reranked, at least candidate_k.
+            Defaults to COMPACT_RERANK_CANDIDATES.
+        vector_backend (MmapVectorIndex, optional): answer the vector branch in process instead of with pgvector. Full text
+            search then only runs for hybrid search, so pure vector search never touches the database. Defaults to None.
+        lexical_backend (BM25Index, optional): rank the full text branch with an in-process BM25 index instead of ts_rank.
+            Together with vector_backend no query needs the database. Defaults to None.
+        metadata_index (MetadataBitmapIndex, optional): resolve the filters to chunk ids with precomputed bitmaps. Both
+            branches then only search the matching chunks (full text search in full scan mode included), and a filter
+            without matches returns [] without any search. Defaults to None (filter on the columns in SQL).
+        embedder (callable, optional): text -> (1, hidden_size) embedding used instead of generate_embedding(), e.g. an
+            EmbeddingBatcher that batches the queries of concurrent callers. Defaults to None.
+        result_cache (RetrievalCache, optional): reuse the result of an identical earlier call while the corpus generation
+            did not change. Not used together with vector_backend, lexical_backend or metadata_index, their snapshots
+            have their own staleness checks. Skipped with verbose too, so the printed ids, scores and texts always come
+            from a real search. Defaults to None.
 
     Returns:
-        ret list(str): top n chunks in list format
+        ret list(RetrievedChunk): top n chunks as (text,) tuples with the chunk id in .id
     """
-    # Establish connection
+    args = (query, n, company_filter, year_filter, quarters_filter, hybrid_search, chunk_filter, verbose,
+            candidate_k, fusion, ef_search, probes, embedding_cache, compact_mode, rerank_k, vector_backend, lexical_backend,
+            metadata_index, embedder)
     try:
-        conn = psycopg2.connect(
-            host=host,
-            port=port,
-            dbname=dbname,
-            user=user,
-            password=password
-        )
-
-        # Create a cursor to perform database operations
-        cursor = conn.cursor()
-
-        # Check whether the query is empty
-        if(len(query) == 0):
-            print("Empty query during retrieval")
-            raise 
-        
-        # STEP 1: Vector search
-        embedding = generate_embedding(text=query)
-        embedding_string = '[' + ','.join(map(str, embedding[0])) + ']'
-        database_query = f"SELECT id, 1 - (embedding <=> '{embedding_string}') AS cosine_similarity FROM embedding_chunks "
-        add_and = False
-        if (company_filter):
-            company_filter_string = ', '.join(f"'{company}'" for company in company_filter)
-            # year_filter_string = ', '.join(f"'{str(year)}'" for year in year_filter)
-            database_query += f"WHERE company in ({company_filter_string}) "
-            add_and = True
-        
-        if (year_filter):
-            if add_and: database_query += "AND "
-            else: database_query += "WHERE "
-            year_filter_string = ', '.join(f"'{str(year)}'" for year in year_filter)
-            database_query += f"year in ({year_filter_string}) "
-            add_and = True
-            
-        if (quarters_filter):
-            if add_and: database_query += "AND "
-            else: database_query += "WHERE "
-            quarters_filter_string = ', '.join(f"'{quarter}'" for quarter in quarters_filter)
-            database_query += f"fiscal_quarter in ({quarters_filter_string}) "
-            add_and = True
-
-        database_query += f"ORDER BY embedding <=> '{embedding_string}';"
-
-        # if verbose: print(database_query)
-        # Query data from the table
-        cursor.execute(database_query)
-        vector_rows = cursor.fetchall()
-        
-        # convert to dataframe
-        semantic_df = pd.DataFrame(vector_rows, columns=['id', 'cosine_similarity'])
-        
-        # STEP 2: Full Text Search
-        # Define list of stop words to remove from query 
-        stopwords = [
-            'apple', 
-            'tesla', 
-            'nvidia', 
-            'microsoft', 
-            'meta', 
-            'google', 
-            'berkshire', 
-            'hathaway', 
-            'amazon', 
-            'q1', 
-            'q2', 
-            'q3', 
-            'q4', 
-            '2025', 
-            '2024', 
-            '2023', 
-            '2022', 
-            '2021', 
-            '10q', 
-            '10k', 
-            '10q-10k', 
-            '10q/10k'
-        ]
-        
-        # Filter out stop words
-        query_words = re.findall(r'\w+', query.lower())
-        filtered_words = [word for word in query_words if word not in stopwords]
-        filtered_query = ' '.join(filtered_words)
-        
-        # Use plainto_tsquery with the filtered query
-        cursor.execute("""
-                        SELECT id, text,
-                            ts_rank(text_vectors, plainto_tsquery('english', %s)) AS rank
-                        FROM text_chunks
-                        ORDER BY rank DESC;
-                    """, (filtered_query,))
-        full_text_rows = cursor.fetchall()
+        if vector_backend is not None and (lexical_backend is not None or not hybrid_search):
+            # Everything is answered in process
+            return _retrieve_n(None, *args)
+        # Borrow a connection from the process wide pool
+        with connection() as conn:
+            if (result_cache is not None and not verbose and vector_backend is None and lexical_backend is None
+                    and metadata_index is None):
+                return _cached_retrieve_n(conn, result_cache, args)
+            return _retrieve_n(conn, *args)
+
+    except Exception as error:
+        print(f"Error connecting to the database: {error}")
+
+def _cached_retrieve_n(conn, result_cache, args):
+    """retrieve_n() through a RetrievalCache, keyed on the current corpus generation."""
+    query, n, company_filter, year_filter, quarters_filter, hybrid_search, chunk_filter = args[:7]
+    candidate_k, fusion, ef_search, probes, _, compact_mode, rerank_k = args[8:15]
+    try:
+        with conn.cursor() as cursor:
+            generation = corpus_generation(cursor)
+    except UndefinedTable:
+        # Database from before the generation counter, ensure_schema() adds it. Nothing can be cached safely until then
+        conn.rollback()
+        return _retrieve_n(conn, *args)
+    key = retrieval_key(generation, query, n, company_filter, year_filter, quarters_filter,
+                        (embedding_model_id(), hybrid_search, chunk_filter, candidate_k, fusion, ef_search, probes,
+                         compact_mode, rerank_k))
+    ret = result_cache.get(key)
+    if ret is None:
+        ret = _retrieve_n(conn, *args)
+        result_cache.put(key, ret)
+    return ret
+
+def _retrieve_n(conn, query, n, company_filter, year_filter, quarters_filter, hybrid_search, chunk_filter, verbose,
+                candidate_k, fusion, ef_search, probes, embedding_cache, compact_mode=None, rerank_k=None, vector_backend=None,
+                lexical_backend=None, metadata_index=None, embedder=None):
+    """Body of retrieve_n() running on a connection borrowed from the pool (None when no query needs the database)."""
+    # Create a cursor to perform database operations
+    cursor = conn.cursor() if conn is not None else None
+
+    # Check whether the query is empty
+    if(len(query) == 0):
+        print("Empty query during retrieval")
+        raise 
     
-        # Convert results to DataFrames
-        text_df = pd.DataFrame(full_text_rows, columns=['id', 'text', 'full_text_score'])
-        
-        # Merge results on 'id'
-        scoring_df = pd.merge(semantic_df, text_df, on='id', how='outer').fillna(-1)
-
-        # Normalize scores
-        scaler = MinMaxScaler()
-        scoring_df[['cosine_similarity', 'full_text_score']] = scaler.fit_transform(
-            scoring_df[['cosine_similarity', 'full_text_score']]
-        )
-        
-        # compute combined score
-        scoring_df['missing_cosine'] = scoring_df['cosine_similarity'] == -1
-        scoring_df['missing_text'] = scoring_df['full_text_score'] == -1
-        scoring_df['score'] = scoring_df.apply(
-            lambda row: row['cosine_similarity'] if row['missing_text'] else
-                        row['full_text_score'] if row['missing_cosine'] else
-                        0.80 * row['cosine_similarity'] + 0.2 * row['full_text_score'],
-            axis=1
-        )
-        if hybrid_search:
-            # Sort by combined score
-            scoring_df = scoring_df.sort_values('score', ascending=False)
+    # STEP 1: Vector search
+    embed = embedder if embedder is not None else lambda text: generate_embedding(text=text)
+    if embedding_cache is not None:
+        embedding = embedding_cache.get_or_compute(query, embed)
+    else:
+        embedding = embed(query)
+    embedding_string = '[' + ','.join(map(str, embedding[0])) + ']'
+    filters = (
+        [str(company) for company in company_filter],
+        [str(year) for year in year_filter],
+        [str(quarter) for quarter in quarters_filter],
+    )
+    # Chunk ids matching the filters, None when nothing is filtered (or there is no metadata index)
+    candidate_ids = metadata_index.chunk_ids(*filters) if metadata_index is not None else None
+    if candidate_ids is not None and len(candidate_ids) == 0:
+        if cursor is not None:
+            cursor.close()
+        return []
+    sql_ids = candidate_ids.tolist() if candidate_ids is not None and len(candidate_ids) <= METADATA_ID_LIST_LIMIT else None
+    if compact_mode is not None:
+        if vector_backend is not None:
+            raise ValueError("compact_mode only applies to the pgvector vector branch, not to vector_backend")
+        if compact_mode not in COMPACT_MODES:
+            raise ValueError(f"Unknown compact mode {compact_mode}, use one of {', '.join(COMPACT_MODES)}")
+        rerank_k = max(rerank_k or COMPACT_RERANK_CANDIDATES, candidate_k or 0)
+    if vector_backend is not None:
+        vector_ids, vector_scores = vector_backend.search(embedding[0], candidate_k, *filters, candidate_ids=candidate_ids)
+    else:
+        vector_ids, vector_scores = _vector_branch(cursor, embedding_string, filters, candidate_k, ef_search, probes,
+                                                   compact_mode, rerank_k, sql_ids, chunk_filter)
+    
+    # STEP 2: Full Text Search
+    # Filter out stop words
+    filtered_query = filter_query(query)
+    
+    # Use plainto_tsquery with the filtered query
+    run_full_text = hybrid_search or (candidate_k is None and vector_backend is None)
+    if lexical_backend is not None and run_full_text:
+        # Full scan mode only filters the full text branch through the metadata index (candidate_ids), same as the SQL
+        # statements. Texts are fetched below
+        lexical_filters = filters if candidate_k is not None else ([], [], [])
+        lexical_ids, lexical_scores = lexical_backend.search(filtered_query, candidate_k, *lexical_filters,
+                                                             candidate_ids=candidate_ids)
+        full_text_rows = list(zip(lexical_ids, [None] * len(lexical_ids), lexical_scores))
+    elif candidate_k is None and run_full_text:
+        if sql_ids is not None:
+            execute_prepared(cursor, FULL_TEXT_SEARCH_BY_ID_STATEMENT, FULL_TEXT_SEARCH_BY_ID_PARAM_TYPES, FULL_TEXT_SEARCH_BY_ID_SQL,
+                             (filtered_query, sql_ids, chunk_filter))
+        elif candidate_ids is not None:
+            # Too many matching chunks for an id list, filter on the columns so the result does not depend on the count
+            execute_prepared(cursor, FULL_TEXT_SEARCH_FILTERED_STATEMENT, FULL_TEXT_SEARCH_FILTERED_PARAM_TYPES,
+                             FULL_TEXT_SEARCH_FILTERED_SQL, (filtered_query, *filters, chunk_filter))
+        else:
+            execute_prepared(cursor, FULL_TEXT_SEARCH_STATEMENT, FULL_TEXT_SEARCH_PARAM_TYPES, FULL_TEXT_SEARCH_SQL,
+                             (filtered_query, chunk_filter))
+        full_text_rows = cursor.fetchall()
+    elif hybrid_search:
+        if sql_ids is not None:
+            execute_prepared(cursor, FULL_TEXT_CANDIDATES_BY_ID_STATEMENT, FULL_TEXT_CANDIDATES_BY_ID_PARAM_TYPES,
+                             FULL_TEXT_CANDIDATES_BY_ID_SQL, (filtered_query, sql_ids, chunk_filter, candidate_k))
         else:
-            # Sort by combined score
-            scoring_df = scoring_df.sort_values('cosine_similarity', ascending=False)
-        # Print or use the results
-        # print(scoring_df.head(10))
-        scoring_df = scoring_df.head(100)
+            execute_prepared(cursor, FULL_TEXT_CANDIDATES_STATEMENT, FULL_TEXT_CANDIDATES_PARAM_TYPES, FULL_TEXT_CANDIDATES_SQL,
+                             (filtered_query, *filters, chunk_filter, candidate_k))
+        full_text_rows = cursor.fetchall()
+    else:
+        # Pure vector search does not need the full text branch in candidate mode (or with an in-process vector backend)
+        full_text_rows = []
+    text_rows = np.array(full_text_rows, dtype=[('id', np.int64), ('text', object), ('full_text_score', np.float64)])
+
+    # STEP 3: Fuse both branches and keep the candidates chunk filtering looks at. The SQL branches already dropped
+    # the flagged chunks, only rows of the in-process backends still go through remove_doc()
+    filter_in_process = chunk_filter and (vector_backend is not None or lexical_backend is not None)
+    ids, scores, cosine, text_row_idx = fuse_scores(
+        vector_ids, vector_scores, text_rows['id'], text_rows['full_text_score'],
+        CHUNK_FILTER_CANDIDATES if filter_in_process else n, hybrid_search=hybrid_search,
+        fusion=fusion if candidate_k is not None else "weighted"
+    )
+
+    # Texts come from the full text rows, anything that only matched the vector branch is fetched in one query
+    texts = [text_rows['text'][row] if row >= 0 else None for row in text_row_idx]
+    missing_ids = [chunk_id for chunk_id, text in zip(ids, texts) if text is None]
+    missing = vector_backend.texts(missing_ids) if vector_backend is not None else fetch_texts(cursor, missing_ids)
+    texts = [missing.get(int(chunk_id)) if text is None else text for chunk_id, text in zip(ids, texts)]
+
+    ret = []
+    for chunk_id, score, cosine_similarity, text in zip(ids, scores, cosine, texts):
         # Chunk Filter:
-        if chunk_filter:
-            for index, row in scoring_df.iterrows():
-                result = remove_doc(row['text'], verbose = verbose)
-                if result:
-                    scoring_df.drop(index, inplace=True)
-                    
-
-        ret = []
-        # Print Hybrid search results
-        for index, row in scoring_df.head(n).iterrows():
-            cursor.execute(f"SELECT text FROM text_chunks where id = {row['id']};")
-            text = cursor.fetchone()
-            if verbose:
-                print(f"ID: {row['id']}, Combined Score: {row['score']} Semantic Score: {row['cosine_similarity']}")
-                print(f"Text: {text}\n")
-                print("\n"*3)
-            ret.append(text)
-        # for row in vector_rows:
-        #     # Query data from the table
-        #     cursor.execute(f"SELECT text FROM text_chunks where id = {row[0]};")
-        #     text = cursor.fetchone()
-        #     if verbose:
-        #         print(row)
-        #         print(text, end="\n\n\n\n\n")
-        #     ret.append(text)
-            
+        if filter_in_process and remove_doc(text, verbose = verbose):
+            continue
+        if verbose:
+            print(f"ID: {chunk_id}, Combined Score: {score} Semantic Score: {cosine_similarity}")
+            print(f"Text: {(text,)}\n")
+            print("\n"*3)
+        ret.append(RetrievedChunk(text, int(chunk_id)))
+        if len(ret) == n:
+            break
         
-        # Close the cursor and connection
+    
+    # Close the cursor, the connection goes back to the pool
+    if cursor is not None:
         cursor.close()
-        conn.close()
-        return ret
+    return ret
 
-    except Exception as error:
-        print(f"Error connecting to the database: {error}")
-        
+def _vector_branch(cursor, embedding_string, filters, candidate_k, ef_search, probes, compact_mode, rerank_k, sql_ids=None,
+                   chunk_filter=False):
+    """Vector branch of retrieve_n() on pgvector, returns the ids and cosine similarities of the matching rows."""
+    # ANN search knobs only last for this transaction. The index is only used with a LIMIT, i.e. in candidate mode
+    if candidate_k is not None or compact_mode is not None:
+        ef_search = max(ef_search or DEFAULT_EF_SEARCH, candidate_k or 0, rerank_k or 0)
+    apply_search_settings(cursor, ef_search=ef_search, probes=probes)
+    if compact_mode is not None:
+        statement, sql = compact_search_sql(compact_mode, by_id=sql_ids is not None)
+        if sql_ids is not None:
+            execute_prepared(cursor, statement, COMPACT_BY_ID_PARAM_TYPES, sql, (embedding_string, sql_ids, chunk_filter, rerank_k,
+                                                                                  candidate_k or rerank_k))
+        else:
+            execute_prepared(cursor, statement, COMPACT_PARAM_TYPES, sql, (embedding_string, *filters, chunk_filter, rerank_k,
+                                                                              candidate_k or rerank_k))
+    elif sql_ids is not None:
+        if candidate_k is None:
+            execute_prepared(cursor, VECTOR_SEARCH_BY_ID_STATEMENT, VECTOR_SEARCH_BY_ID_PARAM_TYPES, VECTOR_SEARCH_BY_ID_SQL,
+                             (embedding_string, sql_ids, chunk_filter))
+        else:
+            execute_prepared(cursor, VECTOR_CANDIDATES_BY_ID_STATEMENT, VECTOR_CANDIDATES_BY_ID_PARAM_TYPES, VECTOR_CANDIDATES_BY_ID_SQL,
+                             (embedding_string, sql_ids, chunk_filter, candidate_k))
+    elif candidate_k is None:
+        execute_prepared(cursor, VECTOR_SEARCH_STATEMENT, VECTOR_SEARCH_PARAM_TYPES, VECTOR_SEARCH_SQL, (embedding_string, *filters, chunk_filter))
+    else:
+        execute_prepared(cursor, VECTOR_CANDIDATES_STATEMENT, VECTOR_CANDIDATES_PARAM_TYPES, VECTOR_CANDIDATES_SQL,
+                         (embedding_string, *filters, chunk_filter, candidate_k))
+    vector_rows = np.array(cursor.fetchall(), dtype=[('id', np.int64), ('cosine_similarity', np.float64)])
+    return vector_rows['id'], vector_rows['cosine_similarity']
+    
 # retrieve_n(verbose=True)
\ No newline at end of file
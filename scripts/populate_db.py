@@ -1,47 +1,13 @@
-from embedding_gen import generate_embedding
-from chunking import chunk_markdown, write_debug_log
+import chunking
+from chunking import write_debug_log
+from ingest_pipeline import IngestionPipeline, print_stage_stats
 import psycopg2
-import os
-import glob
-import tiktoken
-from transformers import AutoTokenizer, AutoModel
-import torch
+from bulk_writer import BulkChunkWriter
+from db_schema import ensure_schema
+from ingest_manifest import IngestManifest, find_markdown_files, NEW, CHANGED, UNCHANGED
 import traceback
 
 
-# Load the tokenizer and the base model (without classification head)
-tokenizer = AutoTokenizer.from_pretrained("yiyanghkust/finbert-tone")
-model = AutoModel.from_pretrained("yiyanghkust/finbert-tone")
-
-def save_embedding_to_db(embedding, chunk, company_name, doc_year, doc_type, fiscal_quarter):
-    try:
-        # Convert the numpy array to a list
-        embedding_list = embedding.tolist()[0]  # Flatten the array
-        # Create the SQL insert statement
-        insert_query = """
-        INSERT INTO embedding_chunks (embedding, company, year, document_type, fiscal_quarter)
-        VALUES (%s, %s, %s, %s, %s)
-        RETURNING id;
-        """
-
-        cursor.execute(insert_query, (embedding_list, company_name, str(doc_year), doc_type, fiscal_quarter))
-        embedding_id = cursor.fetchone()[0]  # Fetch the returned id
-        conn.commit()
-        
-        # Now insert the text into markdown_text with the same id
-        insert_text_query = """
-        INSERT INTO text_chunks (id, text, company, year, document_type, fiscal_quarter)
-        VALUES (%s, %s, %s, %s, %s, %s);
-        """
-
-        # Execute the query using the retrieved embedding_id
-        cursor.execute(insert_text_query, (embedding_id, chunk, company_name, str(doc_year), doc_type, fiscal_quarter))
-        conn.commit()
-    except Exception as error:
-        print(f"ERROR committing to the database: {error}")
-        print(f"chunk text: {chunk}")
-        write_debug_log(f"ERROR committing to the database: {error}")
-        write_debug_log(f"chunk text: {chunk}")
 # # Function to split text into chunks based on token size
 # def split_into_chunks(text, max_tokens=200):
 #     """Splits the input text into chunks of a specified token size."""
@@ -52,46 +18,54 @@ def save_embedding_to_db(embedding, chunk, company_name, doc_year, doc_type, fis
 #     for i in range(0, len(tokens), max_tokens):
 #         yield tokenizer.decode(tokens[i:i + max_tokens])
 
-def process_markdown_file(file_path, company_name, doc_year, doc_type, fiscal_quarter):
-    """Function to process each markdown file."""
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
-        # print("Chunk #: ", end="")
-        write_debug_log(f"Chunking {file}")
-        chunks = chunk_markdown(content,512, verbose=False)
-        for i, chunk in enumerate(chunks):
-            if isinstance(chunk, tuple):
-                table, summary = chunk
-                embedding = generate_embedding(text=summary)
-                # print(f"{i}, ", end="")
-                # Store or process the embedding here
-                save_embedding_to_db(embedding, table, company_name, doc_year, doc_type, fiscal_quarter)
-            elif isinstance(chunk, str):
-                embedding = generate_embedding(text=chunk)
-                # print(f"{i}, ", end="")
-                # Store or process the embedding here
-                save_embedding_to_db(embedding, chunk, company_name, doc_year, doc_type, fiscal_quarter)
-        print(end="\n\n")
+def save_chunk_item(item):
+    """Write stage of the ingestion pipeline."""
+    job = item.job
+    writer.add(item.embedding, item.chunk, job.company_name, job.doc_year, job.doc_type, job.fiscal_quarter,
+               source_file=job.file_path)
 
 def read_markdown_files(base_dir):
-    """Recursively reads markdown files in all subdirectories."""
-    for subdir, dirs, files in os.walk(base_dir):
-        for file in glob.glob(os.path.join(subdir, "*.md")):
-            file_parts = file.split('/')
-            company = file_parts[2]
-            year = file_parts[3]
-            name_info = file_parts[5].split('-')
-            doc_type = name_info[0]
-            fiscal_quarter = name_info[1]
-            print(f"Reading {file}")
-            # print(f"company: {company} year: {year} file type: {doc_type}")
-            process_markdown_file(file, company, year, doc_type, fiscal_quarter)
+    """
+    Chunks, summarizes, embeds and stores the new and changed markdown files under base_dir with overlapping
+    pipeline stages. Files that are already in the ingestion manifest with the same contents are skipped.
+    """
+    manifest = IngestManifest(conn, chunking.CHUNKER_VERSION)
+    entries, removed = manifest.plan(find_markdown_files(base_dir), force=force_reingest)
+    pending = [entry for entry in entries if entry.status != UNCHANGED]
+    print(f"{sum(entry.status == NEW for entry in entries)} new, {sum(entry.status == CHANGED for entry in entries)} changed, "
+          f"{sum(entry.status == UNCHANGED for entry in entries)} unchanged, {len(removed)} removed files")
+
+    for file_path in removed:
+        print(f"Removed {manifest.forget(file_path)} chunks of deleted file {file_path}")
+
+    pipeline = IngestionPipeline(save_chunk_item, workers=pipeline_workers, queue_size=pipeline_queue_size)
+    stats = pipeline.run(entry.job for entry in pending)
+    writer.flush()
+
+    # Files that lost chunks are retried on the next run and keep their old chunks until then
+    failed = pipeline.failed_files() | writer.quarantined_files
+    for entry in pending:
+        if entry.job.file_path in failed:
+            print(f"Not recording {entry.job.file_path} in the manifest, some of its chunks failed")
+            continue
+        # The new version is committed, drop the chunks of older versions (and chunks loaded before the manifest existed)
+        stale = manifest.remove_chunks(entry.job, keep_hashes=writer.pop_file_hashes(entry.job.file_path))
+        if stale:
+            print(f"Removed {stale} stale chunks of {entry.job.file_path}")
+        manifest.record(entry)
+    return stats
            
 # Define the path to the folder with markdown files
 base_dir = "../md_files"
 
 # set globals
 debug = False
+# Re-ingest every file even if the manifest says it is unchanged
+force_reingest = False
+
+# Worker threads per ingestion stage and max number of items queued in front of each stage
+pipeline_workers = {"chunk": 1, "summarize": 2, "embed": 1, "write": 1}
+pipeline_queue_size = 64
 
 # Connection parameters for pgvector
 host = "localhost"         # Hostname (since you've mapped the container port)
@@ -113,78 +87,21 @@ try:
 
     # Create a cursor to perform database operations
     cursor = conn.cursor()
+    # Chunks are buffered and loaded into both tables with COPY
+    writer = BulkChunkWriter(conn)
     
-    # Ensure the `pg_trgm` extension is enabled (for indexing)
-    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
-    conn.commit()
-    
-    # Create embedding chunks table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS embedding_chunks (id bigserial PRIMARY KEY, embedding vector(768), company TEXT, year VARCHAR(4), document_type VARCHAR(255), fiscal_quarter VARCHAR(2));
-
-    """)
-    conn.commit()  # Commit the transaction
+    # Create the chunk tables, the ingestion manifest and their indexes, migrating older databases (content hashes,
+    # generated text_vectors column) on the first run
+    ensure_schema(conn)
     
-    # Create text_chunks table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS text_chunks (id bigint PRIMARY KEY, text TEXT, company TEXT, year VARCHAR(4), document_type VARCHAR(255), fiscal_quarter VARCHAR(2), text_vectors tsvector);
+    # Read and process new and changed markdown files, chunks that are already stored are skipped by their content hash
+    pipeline_stats = read_markdown_files(base_dir)
 
-    """)
-    conn.commit()  # Commit the transaction
-    
-    # Read and process markdown files
-    read_markdown_files(base_dir)
-    
-    # Delete any duplicate chunks
-    cursor.execute("""DELETE FROM text_chunks
-                        WHERE id IN (
-                            SELECT id
-                            FROM (
-                                SELECT 
-                                    id,
-                                    ROW_NUMBER() OVER (
-                                        PARTITION BY text, company, year, document_type, fiscal_quarter 
-                                        ORDER BY id
-                                    ) AS row_num
-                                FROM text_chunks
-                            ) AS subquery
-                            WHERE row_num > 1
-                        );
-                    DELETE FROM embedding_chunks
-                        WHERE id NOT IN (SELECT id FROM text_chunks);
-                    DELETE FROM embedding_chunks
-                        WHERE id IN (
-                            SELECT id
-                            FROM (
-                                SELECT 
-                                    id,
-                                    ROW_NUMBER() OVER (
-                                        PARTITION BY embedding, company, year, document_type, fiscal_quarter 
-                                        ORDER BY id
-                                    ) AS row_num
-                                FROM embedding_chunks
-                            ) AS subquery
-                            WHERE row_num > 1
-                        );
-                    DELETE FROM text_chunks
-                        WHERE id NOT IN (SELECT id FROM embedding_chunks);
-                        """)
-    conn.commit()
-
-    cursor.execute("""
-        UPDATE text_chunks
-        SET text_vectors = to_tsvector('english', text);
-    """)
-    conn.commit()
-    
-    cursor.execute("""
-        CREATE INDEX IF NOT EXISTS text_vectors_idx
-        ON text_chunks
-        USING gin(text_vectors);
-    """)
-    conn.commit()
-    
     print("\nFinished populating database")
+    print_stage_stats(pipeline_stats)
+    print(writer.summary())
+    if chunking.summary_cache is not None:
+        print(chunking.summary_cache.summary())
     
 
 except Exception as error:
@@ -0,0 +1,123 @@
+import argparse
+import json
+import time
+import numpy as np
+import psycopg2
+from bulk_writer import BulkChunkWriter
+from db_schema import ensure_schema
+import db_pool
+from pgvector_db_funcs import retrieve_n
+from llm import extract_query_details
+
+# Latency benchmark for retrieve_n on a large synthetic corpus. The corpus lives in its own schema so the real
+# tables are never touched, retrieval is pointed at it through the search_path of the connection pool.
+#
+# Usage:
+#   python retrieval_benchmark.py --rows 200000            (builds the corpus on the first run)
+#   python retrieval_benchmark.py --rows 200000 --rebuild  (drops and rebuilds it)
+
+BENCH_SCHEMA = "retrieval_bench"
+SYNTHETIC_COMPANIES = ['Tesla', 'Apple', 'Nvidia', 'Microsoft', 'Meta', 'Amazon', 'Google', 'Berkshire Hathaway']
+SYNTHETIC_YEARS = ['2021', '2022', '2023', '2024']
+SYNTHETIC_QUARTERS = ['Q1', 'Q2', 'Q3', 'Q4']
+# Words the synthetic chunks are drawn from, with a Zipf-like frequency so full text ranking has something to do
+SYNTHETIC_VOCABULARY = """revenue net income operating expenses gross margin cash flow dividends share repurchase
+    legal proceedings litigation risk factors liquidity capital resources debt interest rate foreign currency
+    inventory supply chain research development segment automotive services products cloud advertising
+    insurance goodwill impairment tax provision deferred revenue lease obligations earnings per share diluted
+    basic assets liabilities equity acquisition restructuring compensation stock based guidance outlook
+    quarter fiscal year ended compared increase decrease primarily due""".split()
+
+
+def connect(**kwargs):
+    return psycopg2.connect(host=db_pool.host, port=db_pool.port, dbname=db_pool.dbname,
+                            user=db_pool.user, password=db_pool.password, **kwargs)
+
+
+def synthetic_text(rng, num_words=120):
+    weights = 1 / np.arange(1, len(SYNTHETIC_VOCABULARY) + 1)
+    words = rng.choice(SYNTHETIC_VOCABULARY, size=num_words, p=weights / weights.sum())
+    return " ".join(words) + "."
+
+
+def build_synthetic_corpus(num_rows, schema=BENCH_SCHEMA, dim=768, seed=0, rebuild=False):
+    """Create embedding_chunks and text_chunks with num_rows random rows inside schema.
+
+    Args:
+        num_rows (int): number of chunks to generate
+        schema (str, optional): schema to create the tables in. Defaults to BENCH_SCHEMA.
+        dim (int, optional): embedding dimensions. Defaults to 768.
+        seed (int, optional): random seed. Defaults to 0.
+        rebuild (bool, optional): drop an existing corpus first. Defaults to False.
+    """
+    conn = connect(options=f"-c search_path={schema},public")
+    cursor = conn.cursor()
+    if rebuild:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE;")
+    cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {schema};")
+    conn.commit()
+    ensure_schema(conn, verbose=False)
+    cursor.execute("SELECT count(*) FROM embedding_chunks;")
+    existing = cursor.fetchone()[0]
+    if existing >= num_rows:
+        print(f"Reusing synthetic corpus with {existing} rows in schema {schema}")
+        conn.close()
+        return
+
+    print(f"Generating {num_rows - existing} synthetic chunks in schema {schema}")
+    rng = np.random.default_rng(seed + existing)
+    writer = BulkChunkWriter(conn, batch_size=5000)
+    for _ in range(num_rows - existing):
+        writer.add(rng.standard_normal(dim).astype(np.float32), synthetic_text(rng), rng.choice(SYNTHETIC_COMPANIES),
+                   rng.choice(SYNTHETIC_YEARS), "10Q", rng.choice(SYNTHETIC_QUARTERS))
+    writer.flush()
+    print(writer.summary())
+
+    cursor.execute("ANALYZE embedding_chunks; ANALYZE text_chunks;")
+    conn.commit()
+    conn.close()
+
+
+def load_eval_queries(file_path="eval_dataset.json"):
+    with open(file_path, 'r') as json_file:
+        return [entry["query"] for entry in json.load(json_file)]
+
+
+def time_retrieval(queries, repeats=1, **retrieve_kwargs):
+    """Run retrieve_n for every query and return the latencies in milliseconds."""
+    latencies = []
+    for _ in range(repeats):
+        for query in queries:
+            details = extract_query_details(query)
+            start = time.perf_counter()
+            retrieve_n(query, 5, details["Companies"], details["Years"], details["Quarters"], **retrieve_kwargs)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies)
+
+
+def print_latency_row(name, latencies):
+    print(f"{name:<34}{np.mean(latencies):>10.1f}{np.percentile(latencies, 50):>10.1f}{np.percentile(latencies, 95):>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare retrieve_n latency of the full scan and candidate modes")
+    parser.add_argument("--rows", type=int, default=200000, help="size of the synthetic corpus")
+    parser.add_argument("--rebuild", action="store_true", help="drop and rebuild the synthetic corpus")
+    parser.add_argument("--candidate-k", type=int, default=200, help="candidates per branch in candidate mode")
+    parser.add_argument("--repeats", type=int, default=1, help="how often every eval query is run")
+    args = parser.parse_args()
+
+    build_synthetic_corpus(args.rows, rebuild=args.rebuild)
+    db_pool.init_pool(options=f"-c search_path={BENCH_SCHEMA},public")
+    queries = load_eval_queries()
+
+    # Warm up the embedding model and the prepared statements
+    time_retrieval(queries[:2])
+    time_retrieval(queries[:2], candidate_k=args.candidate_k)
+
+    print(f"\n{len(queries) * args.repeats} queries against {args.rows} synthetic chunks (latency in ms)")
+    print(f"{'mode':<34}{'mean':>10}{'p50':>10}{'p95':>10}")
+    print_latency_row("full scan (current)", time_retrieval(queries, args.repeats))
+    print_latency_row(f"candidates k={args.candidate_k}, weighted", time_retrieval(queries, args.repeats, candidate_k=args.candidate_k))
+    print_latency_row(f"candidates k={args.candidate_k}, rrf", time_retrieval(queries, args.repeats, candidate_k=args.candidate_k, fusion="rrf"))
+    db_pool.close_pool()
@@ -0,0 +1,93 @@
+import threading
+from collections import OrderedDict
+from embedding_cache import normalize_query
+
+# In-memory cache of retrieve_n() results. retrieve_n is deterministic for a query and its settings as long as the
+# chunk tables do not change, so the key is the normalized query, the filters, n and every search setting, plus the
+# corpus generation: a single row counter that ingestion bumps in the same transaction as every insert or delete
+# (db_schema.bump_corpus_generation()). A lookup reads the current generation, so a new filing misses the cache on
+# the very next query while reruns of the same questions in between skip embedding, both searches and fusion.
+#
+# The embedding model and backend are part of the key too, see embedding_gen.embedding_model_id().
+#
+# retrieve_n(query, ..., result_cache=RetrievalCache()) uses it, llm.retrieval_step() passes llm.retrieval_cache.
+
+# Default number of cached results
+RETRIEVAL_CACHE_SIZE = 2048
+
+
+def _filter_key(values):
+    return tuple(sorted(str(value) for value in values or []))
+
+
+def retrieval_key(generation, query, n, company_filter, year_filter, quarters_filter, settings):
+    """Cache key of a retrieve_n() call, settings is a tuple of every other argument that changes the result."""
+    return (generation, normalize_query(query), n, _filter_key(company_filter), _filter_key(year_filter),
+            _filter_key(quarters_filter), settings)
+
+
+class RetrievalCache:
+    """LRU cache of retrieval results that belong to one corpus generation.
+
+    Entries of older generations are never returned and age out of the LRU, clear() drops them right away.
+
+    Args:
+        max_items (int, optional): most cached results. Defaults to RETRIEVAL_CACHE_SIZE.
+    """
+
+    def __init__(self, max_items=RETRIEVAL_CACHE_SIZE):
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return a copy of the cached result for key or None."""
+        with self._lock:
+            self._note_generation(key[0])
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            # Callers may modify the list they get back
+            return list(result)
+
+    def put(self, key, result):
+        with self._lock:
+            self._note_generation(key[0])
+            if key[0] != self.generation:
+                # Computed against a generation that is already gone
+                return
+            self._entries[key] = tuple(result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _note_generation(self, generation):
+        # A newer generation makes every entry unreachable, drop them instead of waiting for the LRU
+        if self.generation is None or generation > self.generation:
+            if self.generation is not None:
+                self.evictions += len(self._entries)
+                self._entries.clear()
+            self.generation = generation
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "items": len(self._entries),
+            "generation": self.generation,
+        }
@@ -0,0 +1,304 @@
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from funcs import write_debug_log
+from llm import build_conversation, answer_model
+from embedding_batcher import EmbeddingBatcher
+
+# Asynchronous HTTP service for the RAG pipeline, an alternative to the input() loop of llm.run_llm().
+#
+#   GET  /health    {"status": "ok", ...counters}
+#   POST /retrieve  {"query": "...", "n": 5, "hybrid_search": true, "chunk_filter": true} -> {"chunks": [...], "seconds": ...}
+#   POST /answer    same body, answers with server-sent events:
+#                   event: context  {"chunks": [...]}        once retrieval finished
+#                   event: token    {"content": "..."}       for every piece of the answer as the model produces it
+#                   event: done     {"tokens": .., "seconds": ..}
+#                   event: error    {"error": "..."}         if retrieval or generation failed after the stream started
+#
+# The event loop never blocks: retrieval (FinBERT and Postgres) runs on a thread pool and generation streams from
+# Ollama through ollama.AsyncClient, so many requests are in flight at once. Query embeddings of concurrent requests
+# go through an EmbeddingBatcher, so FinBERT runs batched forward passes instead of one per request.
+#
+# Usage:
+#   python serve.py --port 8080
+#   curl -N -X POST localhost:8080/answer -d '{"query": "What was Apple revenue in Q3 2024?"}'
+#   python serve_load_test.py      (load test against stub_llm_server.py)
+
+HOST = "127.0.0.1"
+PORT = 8080
+# Threads running retrieval, each one borrows a connection from db_pool while it runs
+RETRIEVAL_WORKERS = 8
+# Generations streamed from Ollama at the same time, the others wait for a slot
+MAX_CONCURRENT_GENERATIONS = 16
+MAX_BODY_BYTES = 1024 * 1024
+# Seconds a client gets to send its request
+REQUEST_TIMEOUT = 30.0
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+               500: "Internal Server Error"}
+
+
+def make_retriever(embedder=None):
+    """Retrieval step of the CLI pipeline as a retriever for RAGServer, runs on a worker thread.
+
+    Args:
+        embedder (callable, optional): query embedder passed to retrieve_n, e.g. an EmbeddingBatcher. Defaults to None.
+    """
+    from llm import retrieval_step
+    options = {"embedder": embedder} if embedder is not None else None
+
+    def retrieve(query, n, hybrid_search, chunk_filter):
+        return retrieval_step(message=query, n=n, hybrid_search=hybrid_search, chunk_filtering=chunk_filter,
+                              retrieval_options=options)
+    return retrieve
+
+
+class RequestError(Exception):
+    """Invalid request, answered with status and message."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_query(body):
+    """Validate the JSON body of /retrieve and /answer."""
+    try:
+        params = json.loads(body or b"{}")
+    except json.JSONDecodeError:
+        raise RequestError(400, "body is not valid JSON")
+    if not isinstance(params, dict) or not isinstance(params.get("query"), str) or not params["query"].strip():
+        raise RequestError(400, "body needs a non-empty \"query\" string")
+    n = params.get("n", 5)
+    # bool is an int subclass, "n": true is not a count
+    if type(n) is not int or not 1 <= n <= 50:
+        raise RequestError(400, "\"n\" has to be an integer between 1 and 50")
+    flags = []
+    for name in ("hybrid_search", "chunk_filter"):
+        value = params.get(name, True)
+        # bool() would turn "false" into True
+        if not isinstance(value, bool):
+            raise RequestError(400, f"\"{name}\" has to be true or false")
+        flags.append(value)
+    return (params["query"], n, *flags)
+
+
+async def read_request(reader):
+    """Read one HTTP/1.1 request, returns (method, path, headers, body) or None if the client sent nothing."""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    try:
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise RequestError(400, "malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0) or 0)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise RequestError(400, "invalid Content-Length")
+    if length > MAX_BODY_BYTES:
+        raise RequestError(413, "request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target.split("?", 1)[0], headers, body
+
+
+def response_head(status, content_type, length=None):
+    lines = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}", f"Content-Type: {content_type}", "Connection: close"]
+    if length is not None:
+        lines.append(f"Content-Length: {length}")
+    else:
+        lines.append("Cache-Control: no-cache")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+class RAGServer:
+    """asyncio HTTP server for retrieval and streamed answers.
+
+    Args:
+        retriever (callable, optional): retriever(query, n, hybrid_search, chunk_filter) -> list of (text,) tuples,
+            called on a worker thread. Defaults to the CLI retrieval step with batched query embeddings.
+        llm_client (ollama.AsyncClient, optional): client used for generation. Defaults to a new AsyncClient.
+        model (str, optional): model that answers. Defaults to llm.answer_model.
+        retrieval_workers (int, optional): threads running retrieval. Defaults to RETRIEVAL_WORKERS.
+        max_generations (int, optional): answers streamed at the same time. Defaults to MAX_CONCURRENT_GENERATIONS.
+    """
+
+    def __init__(self, retriever=None, llm_client=None, model=None, retrieval_workers=RETRIEVAL_WORKERS,
+                 max_generations=MAX_CONCURRENT_GENERATIONS):
+        # Only the default retriever embeds through the batcher, an injected retriever brings its own embedding
+        self.embedding_batcher = EmbeddingBatcher() if retriever is None else None
+        self.retriever = retriever or make_retriever(self.embedding_batcher)
+        self.llm_client = llm_client
+        self.model = model or answer_model
+        self.executor = ThreadPoolExecutor(max_workers=retrieval_workers, thread_name_prefix="retrieval")
+        self.max_generations = max_generations
+        self.generation_slots = None
+        self.server = None
+        self.requests = 0
+        self.active = 0
+        self.errors = 0
+
+    async def start(self, host=HOST, port=PORT):
+        """Start listening, returns the asyncio server (port 0 picks a free port)."""
+        if self.llm_client is None:
+            import ollama
+            self.llm_client = ollama.AsyncClient()
+        # Created here so it belongs to the running loop
+        self.generation_slots = asyncio.Semaphore(self.max_generations)
+        self.server = await asyncio.start_server(self.handle, host, port, limit=MAX_BODY_BYTES)
+        return self.server
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.executor.shutdown(wait=False)
+        if self.embedding_batcher is not None:
+            self.embedding_batcher.close()
+
+    async def retrieve(self, query, n, hybrid_search, chunk_filter):
+        """Run the retriever on the thread pool so the event loop keeps serving other requests."""
+        loop = asyncio.get_running_loop()
+        chunks = await loop.run_in_executor(self.executor, self.retriever, query, n, hybrid_search, chunk_filter)
+        if chunks is None:
+            # retrieve_n() prints the error and returns None
+            raise RuntimeError("retrieval failed")
+        return chunks
+
+    async def handle(self, reader, writer):
+        self.requests += 1
+        self.active += 1
+        try:
+            try:
+                request = await asyncio.wait_for(read_request(reader), timeout=REQUEST_TIMEOUT)
+                if request is None:
+                    return
+                method, path, headers, body = request
+                if path == "/health":
+                    health = {"status": "ok", "requests": self.requests, "active": self.active, "errors": self.errors}
+                    if self.embedding_batcher is not None:
+                        health["embedding_batches"] = self.embedding_batcher.stats()
+                    await self.send_json(writer, 200, health)
+                elif path not in ("/retrieve", "/answer"):
+                    raise RequestError(404, f"unknown path {path}")
+                elif method != "POST":
+                    raise RequestError(405, f"{path} only accepts POST")
+                elif path == "/retrieve":
+                    await self.handle_retrieve(writer, parse_query(body))
+                else:
+                    await self.handle_answer(writer, parse_query(body))
+            except RequestError as error:
+                await self.send_json(writer, error.status, {"error": str(error)})
+            except asyncio.TimeoutError:
+                await self.send_json(writer, 400, {"error": "request timed out"})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # Client went away, nothing left to answer
+            pass
+        except Exception as error:
+            self.errors += 1
+            write_debug_log(f"serve: unexpected {type(error).__name__}: {error}")
+        finally:
+            self.active -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def send_json(self, writer, status, body):
+        data = json.dumps(body).encode("utf-8")
+        writer.write(response_head(status, "application/json", len(data)) + data)
+        await writer.drain()
+
+    async def handle_retrieve(self, writer, params):
+        start = time.perf_counter()
+        try:
+            chunks = await self.retrieve(*params)
+        except Exception as error:
+            self.errors += 1
+            write_debug_log(f"serve: retrieval failed for {params[0]!r}: {type(error).__name__}: {error}")
+            await self.send_json(writer, 500, {"error": "retrieval failed"})
+            return
+        await self.send_json(writer, 200, {"chunks": [chunk[0] for chunk in chunks], "seconds": time.perf_counter() - start})
+
+    async def handle_answer(self, writer, params):
+        query = params[0]
+        start = time.perf_counter()
+        # Headers go out right away so the client sees progress before retrieval finishes
+        writer.write(response_head(200, "text/event-stream"))
+        await writer.drain()
+        tokens = 0
+        try:
+            chunks = await self.retrieve(*params)
+            writer.write(sse_event("context", {"chunks": [chunk[0] for chunk in chunks]}))
+            await writer.drain()
+            async with self.generation_slots:
+                stream = await self.llm_client.chat(model=self.model, messages=build_conversation(query, chunks), stream=True)
+                async for part in stream:
+                    content = part["message"]["content"]
+                    if content:
+                        tokens += 1
+                        writer.write(sse_event("token", {"content": content}))
+                        # Backpressure: a slow client slows down its own stream only
+                        await writer.drain()
+            writer.write(sse_event("done", {"tokens": tokens, "seconds": time.perf_counter() - start}))
+            await writer.drain()
+        except ConnectionError:
+            raise
+        except Exception as error:
+            self.errors += 1
+            write_debug_log(f"serve: answer failed for {query!r}: {type(error).__name__}: {error}")
+            writer.write(sse_event("error", {"error": f"{type(error).__name__}: {error}"}))
+            await writer.drain()
+
+
+async def serve_forever(host=HOST, port=PORT, retrieval_workers=RETRIEVAL_WORKERS, max_generations=MAX_CONCURRENT_GENERATIONS):
+    from db_pool import get_pool, close_pool
+    from model_registry import warm_up
+
+    rag_server = RAGServer(retrieval_workers=retrieval_workers, max_generations=max_generations)
+    loop = asyncio.get_running_loop()
+    # Open the pool and load the embedding model before the first request, like run_llm()
+    await loop.run_in_executor(rag_server.executor, get_pool)
+    await loop.run_in_executor(rag_server.executor, warm_up)
+    server = await rag_server.start(host, port)
+    print(f"Serving on http://{host}:{rag_server.port} (retrieval workers: {retrieval_workers}, generations: {max_generations})")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await rag_server.close()
+        close_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP service for retrieval and streamed answers")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--retrieval-workers", type=int, default=RETRIEVAL_WORKERS)
+    parser.add_argument("--max-generations", type=int, default=MAX_CONCURRENT_GENERATIONS)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve_forever(args.host, args.port, args.retrieval_workers, args.max_generations))
+    except KeyboardInterrupt:
+        pass
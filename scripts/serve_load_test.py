@@ -0,0 +1,137 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+import numpy as np
+from stub_llm_server import start_stub_server, stub_reply
+
+# Load test of serve.py against the stub LLM server. Retrieval is replaced by a function that blocks its worker
+# thread for a fixed time (like FinBERT plus Postgres would), generation streams from the stub word by word.
+# Checks that every stream carries the answer to its own query, and that /health stays fast under load, i.e. the
+# event loop is never blocked.
+#
+# Usage:
+#   python serve_load_test.py
+#   python serve_load_test.py --concurrency 1,8,32 --requests 64 --latency 0.3 --token-delay 0.01
+
+CHUNKS = [("Total net sales were $85,777 million for the quarter.",), ("Services net sales were $24,213 million.",)]
+
+
+def fake_retriever(retrieval_latency):
+    def retrieve(query, n, hybrid_search, chunk_filter):
+        time.sleep(retrieval_latency)
+        return CHUNKS[:n]
+    return retrieve
+
+
+async def post(port, path, body):
+    """Send a POST and return the raw response body, split into SSE events for /answer."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    data = json.dumps(body).encode("utf-8")
+    writer.write(f"POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(data)}\r\n\r\n".encode("latin-1") + data)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    while (await reader.readline()) not in (b"\r\n", b""):
+        pass
+    return status, reader, writer
+
+
+async def answer(port, query):
+    """Stream one answer, returns (time to first token, total seconds, answer text)."""
+    start = time.perf_counter()
+    status, reader, writer = await post(port, "/answer", {"query": query, "n": 2})
+    assert status == 200, f"/answer returned {status}"
+    first_token = None
+    content = []
+    event = None
+    async for line in reader:
+        line = line.decode("utf-8").rstrip("\n")
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: "):
+            data = json.loads(line[len("data: "):])
+            if event == "token":
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                content.append(data["content"])
+            elif event == "error":
+                raise AssertionError(f"stream failed: {data['error']}")
+            elif event == "done":
+                break
+    writer.close()
+    return first_token, time.perf_counter() - start, "".join(content)
+
+
+async def health_probe(port, stop, latencies):
+    while not stop.is_set():
+        start = time.perf_counter()
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /health HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        await writer.drain()
+        await reader.read()
+        writer.close()
+        latencies.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(0.05)
+
+
+async def run(concurrency_levels, num_requests, retrieval_latency):
+    from serve import RAGServer
+    from llm import build_conversation
+
+    rag_server = RAGServer(retriever=fake_retriever(retrieval_latency), retrieval_workers=max(concurrency_levels))
+    await rag_server.start(port=0)
+    port = rag_server.port
+
+    status, reader, writer = await post(port, "/retrieve", {"query": "Apple revenue", "n": 2})
+    body = json.loads(await reader.read())
+    writer.close()
+    assert status == 200 and body["chunks"] == [chunk[0] for chunk in CHUNKS], "unexpected /retrieve response"
+
+    print(f"{'concurrency':>12}{'requests':>10}{'req/s':>8}{'ttft p50':>10}{'ttft p95':>10}{'total p50':>11}"
+          f"{'total p95':>11}{'health max ms':>15}")
+    for concurrency in concurrency_levels:
+        semaphore = asyncio.Semaphore(concurrency)
+        queries = [f"What was the revenue in request {i}?" for i in range(num_requests)]
+
+        async def limited(query):
+            async with semaphore:
+                return await answer(port, query)
+
+        stop = asyncio.Event()
+        health_latencies = []
+        probe = asyncio.create_task(health_probe(port, stop, health_latencies))
+        start = time.perf_counter()
+        results = await asyncio.gather(*(limited(query) for query in queries))
+        seconds = time.perf_counter() - start
+        stop.set()
+        await probe
+
+        for query, (_, _, content) in zip(queries, results):
+            expected = stub_reply(build_conversation(query, CHUNKS))
+            assert content == expected, f"stream of {query!r} carried a different answer"
+        first_tokens = np.array([result[0] for result in results]) * 1000
+        totals = np.array([result[1] for result in results]) * 1000
+        print(f"{concurrency:>12}{num_requests:>10}{num_requests / seconds:>8.1f}"
+              f"{np.percentile(first_tokens, 50):>10.0f}{np.percentile(first_tokens, 95):>10.0f}"
+              f"{np.percentile(totals, 50):>11.0f}{np.percentile(totals, 95):>11.0f}"
+              f"{max(health_latencies, default=0):>15.1f}")
+    await rag_server.close()
+    print("(latencies in ms, every stream carried the answer to its own query)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test serve.py against the stub LLM server")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma separated numbers of concurrent clients")
+    parser.add_argument("--requests", type=int, default=64, help="requests per concurrency level")
+    parser.add_argument("--retrieval-latency", type=float, default=0.05, help="seconds the fake retriever blocks")
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds the stub waits before answering")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="seconds between streamed words")
+    args = parser.parse_args()
+
+    # The stub has to be running before ollama is imported, the ollama module reads OLLAMA_HOST at import
+    stub = start_stub_server(latency=args.latency, token_delay=args.token_delay)
+    os.environ["OLLAMA_HOST"] = f"http://127.0.0.1:{stub.server_port}"
+    asyncio.run(run([int(value) for value in args.concurrency.split(",")], args.requests, args.retrieval_latency))
+    stub.shutdown()
@@ -0,0 +1,46 @@
+import argparse
+import json
+import subprocess
+import sys
+
+# Measures what importing each module costs now that models are loaded lazily, and what the first use costs.
+# Every module is imported in a fresh interpreter. "import" is the lazy import, "+ warm_up" adds
+# model_registry.warm_up(), which is what importing used to cost when the tokenizer and model loaded at import time.
+#
+# Usage:
+#   python startup_benchmark.py --modules embedding_gen,chunking,pgvector_db_funcs,llm
+
+CHILD_SCRIPT = """
+import json, resource, sys, time
+
+def peak_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+start = time.perf_counter()
+__import__({module!r})
+result = {{"import_seconds": time.perf_counter() - start, "import_mb": peak_mb()}}
+import model_registry
+result["warm_up_seconds"] = model_registry.warm_up()
+result["warm_up_mb"] = peak_mb()
+print(json.dumps(result))
+"""
+
+
+def measure(module):
+    output = subprocess.run([sys.executable, "-c", CHILD_SCRIPT.format(module=module)],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time and peak memory of the scripts' modules")
+    parser.add_argument("--modules", default="embedding_gen,chunking,pgvector_db_funcs,llm")
+    args = parser.parse_args()
+
+    print(f"{'module':<20}{'import s':>10}{'import MB':>11}{'+ warm_up s':>13}{'+ warm_up MB':>14}")
+    for module in args.modules.split(","):
+        result = measure(module)
+        total = result["import_seconds"] + result["warm_up_seconds"]
+        print(f"{module:<20}{result['import_seconds']:>10.2f}{result['import_mb']:>11.0f}{total:>13.2f}{result['warm_up_mb']:>14.0f}")
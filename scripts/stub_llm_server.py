@@ -0,0 +1,124 @@
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Minimal stand-in for the Ollama HTTP API (/api/chat and /api/tags) that answers after a fixed latency. Used to
+# test and benchmark the LLM calls without a GPU. Point the ollama client at it with OLLAMA_HOST.
+#
+# Usage:
+#   python stub_llm_server.py --port 11435 --latency 0.5
+#   OLLAMA_HOST=http://127.0.0.1:11435 python summarize_async_test.py
+
+
+def stub_reply(messages):
+    """Deterministic reply for a conversation, so callers can check which request an answer belongs to."""
+    digest = hashlib.sha1(messages[-1]["content"].encode("utf-8")).hexdigest()[:12] if messages else "empty"
+    return f"Stub summary {digest}."
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    # latency, fail_rate and token_delay are read from the server, see start_stub_server()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send_json(200, {"models": []})
+        elif self.path == "/":
+            self._send_json(200, {"status": "Ollama is running"})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/api/chat":
+            self._send_json(404, {"error": "not found"})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        server = self.server
+        time.sleep(server.latency)
+        with server.lock:
+            server.requests += 1
+            fail = server.rng.random() < server.fail_rate
+        if fail:
+            self._send_json(500, {"error": "stub failure"})
+            return
+
+        reply = stub_reply(request.get("messages", []))
+        model = request.get("model", "stub")
+        created_at = datetime.now(timezone.utc).isoformat()
+        # Ollama streams by default and only answers with one object when stream is false
+        if not request.get("stream", True):
+            self._send_json(200, {
+                "model": model, "created_at": created_at,
+                "message": {"role": "assistant", "content": reply},
+                "done": True, "done_reason": "stop",
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        for i, word in enumerate(reply.split(" ")):
+            time.sleep(server.token_delay)
+            content = word if i == 0 else " " + word
+            line = {"model": model, "created_at": created_at, "message": {"role": "assistant", "content": content}, "done": False}
+            self.wfile.write((json.dumps(line) + "\n").encode("utf-8"))
+            self.wfile.flush()
+        line = {"model": model, "created_at": created_at, "message": {"role": "assistant", "content": ""}, "done": True, "done_reason": "stop"}
+        self.wfile.write((json.dumps(line) + "\n").encode("utf-8"))
+        self.close_connection = True
+
+
+def start_stub_server(port=0, latency=0.5, fail_rate=0.0, token_delay=0.0, seed=0):
+    """Start the stub server on a background thread.
+
+    Args:
+        port (int, optional): port to listen on, 0 picks a free one. Defaults to 0.
+        latency (float, optional): seconds every request waits before answering. Defaults to 0.5.
+        fail_rate (float, optional): share of requests answered with HTTP 500. Defaults to 0.0.
+        token_delay (float, optional): seconds between streamed words. Defaults to 0.0.
+        seed (int, optional): random seed for the failures. Defaults to 0.
+
+    Returns:
+        ThreadingHTTPServer: running server, its url is f"http://127.0.0.1:{server.server_port}"
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubLLMHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.fail_rate = fail_rate
+    server.token_delay = token_delay
+    server.requests = 0
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub Ollama server with simulated latency")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds before every answer")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of requests that fail with HTTP 500")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="seconds between streamed words")
+    args = parser.parse_args()
+
+    server = start_stub_server(args.port, args.latency, args.fail_rate, args.token_delay)
+    print(f"Stub LLM server listening on http://127.0.0.1:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
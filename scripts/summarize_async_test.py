@@ -0,0 +1,77 @@
+import asyncio
+import os
+import time
+from stub_llm_server import start_stub_server, stub_reply
+
+# Checks the concurrent table summarization of chunk_markdown() against the stub LLM server and shows the wall
+# clock gain over summarizing one table at a time. The stub has to be running before ollama is imported because
+# the ollama module reads OLLAMA_HOST once at import.
+
+NUM_TABLES = 16
+LATENCY = 0.5
+
+server = start_stub_server(latency=LATENCY)
+os.environ["OLLAMA_HOST"] = f"http://127.0.0.1:{server.server_port}"
+
+import chunking
+from chunking import chunk_markdown, build_summary_prompt, PendingTable
+
+# Every run has to reach the stub
+chunking.summary_cache = None
+
+
+def synthetic_filing(num_tables):
+    lines = []
+    for i in range(num_tables):
+        lines.append(f"## Note {i + 1}")
+        lines.append(f"The following table shows the segment results for note {i + 1}. Revenue increased compared to the prior year.")
+        lines.append("| Segment | 2023 | 2022 |")
+        lines.append("| --- | --- | --- |")
+        lines.append(f"| Automotive | {100 + i} | {90 + i} |")
+        lines.append(f"| Energy | {10 + i} | {9 + i} |")
+        lines.append("")
+        lines.append(f"Operating expenses for note {i + 1} were primarily driven by higher headcount.")
+    return "\n".join(lines)
+
+
+def check_order(chunks, pending):
+    """Every table keeps its position and carries the summary of its own prompt."""
+    tables = [chunk for chunk in chunks if isinstance(chunk, tuple)]
+    assert len(tables) == len(pending), f"expected {len(pending)} tables, got {len(tables)}"
+    for (table, summary), expected in zip(tables, pending):
+        assert table == expected.table, "table order changed"
+        prompt = build_summary_prompt(expected.table, expected.context)
+        assert summary == stub_reply([{"content": prompt}]), "summary belongs to a different table"
+
+
+md_text = synthetic_filing(NUM_TABLES)
+pending = [chunk for chunk in chunking.iter_markdown_chunks(md_text, 512, summarize_tables=False) if isinstance(chunk, PendingTable)]
+reference = [chunk if not isinstance(chunk, PendingTable) else chunk.table
+             for chunk in chunking.iter_markdown_chunks(md_text, 512, summarize_tables=False)]
+
+results = {}
+for concurrency in (1, 4, 16):
+    start = time.perf_counter()
+    chunks = chunk_markdown(md_text, 512, summary_concurrency=concurrency)
+    results[concurrency] = time.perf_counter() - start
+    check_order(chunks, pending)
+    assert [chunk[0] if isinstance(chunk, tuple) else chunk for chunk in chunks] == reference, "chunk order changed"
+
+print(f"{NUM_TABLES} tables, {LATENCY}s simulated latency per summary")
+for concurrency, seconds in results.items():
+    print(f"concurrency {concurrency:>3}: {seconds:6.2f}s ({results[1] / seconds:.1f}x)")
+
+# Failed and slow requests are retried
+server.fail_rate = 0.3
+chunks = chunk_markdown(md_text, 512, summary_concurrency=8)
+check_order(chunks, pending)
+print("retries after HTTP 500: ok")
+
+server.fail_rate = 0.0
+server.latency = 2.0
+try:
+    chunking.summarize_pending_tables(list(pending[:2]), concurrency=2, timeout=0.2, retries=1)
+    raise AssertionError("expected a timeout")
+except asyncio.TimeoutError:
+    print("timeout after retries: ok")
+server.shutdown()
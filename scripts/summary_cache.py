@@ -0,0 +1,155 @@
+import argparse
+import hashlib
+import sqlite3
+import threading
+import time
+
+# Persistent cache of LLM table summaries. Entries are keyed by a hash of the full prompt (which contains the
+# table and its preceding context), the model and the prompt version, so changing any of them misses the cache.
+#
+# Usage:
+#   python summary_cache.py stats
+#   python summary_cache.py invalidate --model llama3.2:1b
+#   python summary_cache.py invalidate --prompt-version 1
+#   python summary_cache.py clear
+
+SUMMARY_CACHE_FILE = "table_summary_cache.sqlite"
+
+
+def summary_key(prompt, model, prompt_version):
+    """sha256 of everything that determines the summary of a table."""
+    return hashlib.sha256(f"{model}\0{prompt_version}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+class TableSummaryCache:
+    """SQLite backed cache for table summaries.
+
+    Safe to share between the summarize workers of the ingestion pipeline.
+
+    Args:
+        path (str, optional): SQLite file. Defaults to SUMMARY_CACHE_FILE.
+    """
+
+    def __init__(self, path=SUMMARY_CACHE_FILE):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # parallel_ingest.py workers share the file, wait for each other's writes instead of failing
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS table_summaries (
+                key TEXT PRIMARY KEY, model TEXT, prompt_version TEXT, summary TEXT, created REAL, last_used REAL
+            );
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS table_summaries_model_idx ON table_summaries (model, prompt_version);")
+        self._db.commit()
+
+    def get(self, prompt, model, prompt_version):
+        """Return the cached summary for prompt or None."""
+        key = summary_key(prompt, model, prompt_version)
+        with self._lock:
+            row = self._db.execute("SELECT summary FROM table_summaries WHERE key = ?;", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE table_summaries SET last_used = ? WHERE key = ?;", (time.time(), key))
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, prompt, model, prompt_version, summary):
+        """Store the summary the model produced for prompt."""
+        key = summary_key(prompt, model, prompt_version)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO table_summaries VALUES (?, ?, ?, ?, ?, ?);",
+                (key, model, str(prompt_version), summary, now, now)
+            )
+            self._db.commit()
+
+    def get_or_compute(self, prompt, model, prompt_version, compute):
+        """Return the cached summary of prompt, calling compute() and caching its result on a miss."""
+        summary = self.get(prompt, model, prompt_version)
+        if summary is None:
+            summary = compute()
+            self.put(prompt, model, prompt_version, summary)
+        return summary
+
+    def invalidate(self, model=None, prompt_version=None):
+        """Delete the entries of a model and/or prompt version, returns the number of deleted summaries.
+
+        Args:
+            model (str, optional): only delete summaries generated by this model
+            prompt_version (str, optional): only delete summaries generated with this prompt version
+
+        Returns:
+            int: number of deleted entries
+        """
+        if model is None and prompt_version is None:
+            raise ValueError("Pass a model and/or a prompt version, use clear() to delete everything")
+        conditions = []
+        params = []
+        if model is not None:
+            conditions.append("model = ?")
+            params.append(model)
+        if prompt_version is not None:
+            conditions.append("prompt_version = ?")
+            params.append(str(prompt_version))
+        with self._lock:
+            cursor = self._db.execute(f"DELETE FROM table_summaries WHERE {' AND '.join(conditions)};", params)
+            self._db.commit()
+            return cursor.rowcount
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._db.execute("DELETE FROM table_summaries;")
+            self._db.commit()
+
+    def entries(self):
+        """Return (model, prompt_version, count) for every model and prompt version in the cache."""
+        with self._lock:
+            return self._db.execute("""
+                SELECT model, prompt_version, count(*) FROM table_summaries
+                GROUP BY model, prompt_version ORDER BY model, prompt_version;
+            """).fetchall()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"table summary cache: {stats['hits']} hits, {stats['misses']} misses "
+                f"({stats['hit_rate']:.1%} hit rate)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or invalidate the table summary cache")
+    parser.add_argument("--path", default=SUMMARY_CACHE_FILE, help="SQLite cache file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="number of cached summaries per model and prompt version")
+    invalidate_parser = subparsers.add_parser("invalidate", help="delete the summaries of a model and/or prompt version")
+    invalidate_parser.add_argument("--model", default=None)
+    invalidate_parser.add_argument("--prompt-version", default=None)
+    subparsers.add_parser("clear", help="delete every cached summary")
+    args = parser.parse_args()
+
+    cache = TableSummaryCache(args.path)
+    if args.command == "stats":
+        rows = cache.entries()
+        print(f"{'model':<24}{'prompt version':>16}{'summaries':>12}")
+        for model, prompt_version, count in rows:
+            print(f"{model:<24}{prompt_version:>16}{count:>12}")
+        print(f"{sum(row[2] for row in rows)} summaries in {args.path}")
+    elif args.command == "invalidate":
+        print(f"Deleted {cache.invalidate(model=args.model, prompt_version=args.prompt_version)} summaries")
+    else:
+        cache.clear()
+        print(f"Cleared {args.path}")
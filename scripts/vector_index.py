@@ -0,0 +1,277 @@
+import argparse
+import json
+import time
+import numpy as np
+from db_pool import connection
+
+# Manage the approximate nearest neighbour index on embedding_chunks.embedding and compare it with exact search.
+#
+# Usage:
+#   python vector_index.py build --method hnsw --m 16 --ef-construction 64
+#   python vector_index.py build --method hnsw --column embedding_half      (compact columns, see compact_vectors.py)
+#   python vector_index.py build --method ivfflat --lists 100
+#   python vector_index.py rebuild --method hnsw --m 24 --ef-construction 128
+#   python vector_index.py drop
+#   python vector_index.py status
+#   python vector_index.py report --k 10 --ef-search 20,40,80,160 --probes 1,5,10,20
+
+INDEX_NAME = "embedding_chunks_embedding_idx"
+TABLE_NAME = "embedding_chunks"
+COLUMN_NAME = "embedding"
+# retrieve_n compares embeddings with <=>, so the index has to use the cosine operator class
+OPERATOR_CLASS = "vector_cosine_ops"
+# Operator class of every indexable column. embedding_half holds normalized embeddings, so inner product
+# (<#>) ranks like cosine there, and binary codes are compared by hamming distance (<~>).
+COLUMN_OPERATOR_CLASSES = {
+    "embedding": OPERATOR_CLASS,
+    "embedding_half": "halfvec_ip_ops",
+    "embedding_bits": "bit_hamming_ops",
+}
+
+
+def index_name(column=COLUMN_NAME):
+    """Name of the ANN index on a column, INDEX_NAME for the full precision embedding."""
+    if column not in COLUMN_OPERATOR_CLASSES:
+        raise ValueError(f"Unknown vector column {column}, use one of {', '.join(COLUMN_OPERATOR_CLASSES)}")
+    return f"{TABLE_NAME}_{column}_idx"
+
+# pgvector rejects larger hnsw.ef_search values
+MAX_EF_SEARCH = 1000
+
+# pgvector defaults
+DEFAULT_HNSW_M = 16
+DEFAULT_HNSW_EF_CONSTRUCTION = 64
+DEFAULT_EF_SEARCH = 40
+DEFAULT_PROBES = 1
+
+
+def default_ivfflat_lists(num_rows):
+    """pgvector recommends rows / 1000 lists up to 1M rows and sqrt(rows) above that."""
+    if num_rows > 1000000:
+        return int(np.sqrt(num_rows))
+    return max(1, num_rows // 1000)
+
+
+def build_index(conn, method="hnsw", m=DEFAULT_HNSW_M, ef_construction=DEFAULT_HNSW_EF_CONSTRUCTION, lists=None,
+                concurrently=False, maintenance_work_mem=None, column=COLUMN_NAME):
+    """Create the ANN index on embedding_chunks.embedding (or one of the compact columns) if it does not exist yet.
+
+    Args:
+        conn (psycopg2.connection): database connection, switched to autocommit for the duration of the build
+        method (str, optional): "hnsw" or "ivfflat". Defaults to "hnsw".
+        m (int, optional): HNSW max connections per layer. Defaults to DEFAULT_HNSW_M.
+        ef_construction (int, optional): HNSW candidate list size while building. Defaults to DEFAULT_HNSW_EF_CONSTRUCTION.
+        lists (int, optional): IVFFlat number of lists. Defaults to default_ivfflat_lists() of the current row count.
+        concurrently (bool, optional): build without blocking writes. Defaults to False.
+        maintenance_work_mem (str, optional): e.g. "2GB", HNSW builds are much faster when the graph fits in memory.
+        column (str, optional): column to index, one of COLUMN_OPERATOR_CLASSES. Defaults to COLUMN_NAME.
+    """
+    name = index_name(column)
+    if method not in ("hnsw", "ivfflat"):
+        raise ValueError(f"Unknown index method {method}, use hnsw or ivfflat")
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    conn.rollback()
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        if method == "hnsw":
+            options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+        else:
+            if lists is None:
+                cursor.execute(f"SELECT count(*) FROM {TABLE_NAME};")
+                lists = default_ivfflat_lists(cursor.fetchone()[0])
+            options = f"lists = {int(lists)}"
+        if maintenance_work_mem:
+            cursor.execute("SET maintenance_work_mem = %s;", (maintenance_work_mem,))
+        start = time.perf_counter()
+        cursor.execute(f"""
+            CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {name}
+            ON {TABLE_NAME}
+            USING {method} ({column} {COLUMN_OPERATOR_CLASSES[column]})
+            WITH ({options});
+        """)
+        print(f"Built {method} index {name} ({options}) in {time.perf_counter() - start:.1f}s")
+    finally:
+        conn.autocommit = autocommit
+        cursor.close()
+
+
+def drop_index(conn, concurrently=False, column=COLUMN_NAME):
+    """Drop the ANN index of a column, retrieval falls back to exact sequential scans."""
+    name = index_name(column)
+    conn.rollback()
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"DROP INDEX {'CONCURRENTLY ' if concurrently else ''}IF EXISTS {name};")
+        print(f"Dropped index {name}")
+    finally:
+        conn.autocommit = autocommit
+        cursor.close()
+
+
+def index_status(conn):
+    """Return (name, definition, size) for every index on embedding_chunks."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT indexname, indexdef, pg_size_pretty(pg_relation_size((quote_ident(schemaname) || '.' || quote_ident(indexname))::regclass))
+        FROM pg_indexes
+        WHERE tablename = %s AND schemaname = current_schema();
+    """, (TABLE_NAME,))
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+
+def index_method(conn, column=COLUMN_NAME):
+    """Return "hnsw", "ivfflat" or None depending on the ANN index currently on a vector column."""
+    for name, definition, size in index_status(conn):
+        if name == index_name(column):
+            for method in ("hnsw", "ivfflat"):
+                if f"USING {method}" in definition:
+                    return method
+    return None
+
+
+def apply_search_settings(cursor, ef_search=None, probes=None):
+    """Set the per-query ANN search knobs for the current transaction.
+
+    Args:
+        cursor (cursor): cursor whose transaction the settings apply to
+        ef_search (int, optional): HNSW candidate list size, higher is slower but more accurate. Clamped to MAX_EF_SEARCH.
+            An HNSW scan returns at most ef_search rows, so a LIMIT above MAX_EF_SEARCH gets at most MAX_EF_SEARCH rows
+            from the index.
+        probes (int, optional): IVFFlat number of lists to visit, higher is slower but more accurate.
+    """
+    if ef_search is not None:
+        cursor.execute(f"SET LOCAL hnsw.ef_search = {min(int(ef_search), MAX_EF_SEARCH)};")
+    if probes is not None:
+        cursor.execute(f"SET LOCAL ivfflat.probes = {int(probes)};")
+
+
+def _search(cursor, embedding_string, filters, k):
+    cursor.execute(f"""
+        SELECT id FROM {TABLE_NAME}
+        WHERE (cardinality(%s::text[]) = 0 OR company = ANY(%s::text[]))
+            AND (cardinality(%s::text[]) = 0 OR year = ANY(%s::text[]))
+            AND (cardinality(%s::text[]) = 0 OR fiscal_quarter = ANY(%s::text[]))
+        ORDER BY {COLUMN_NAME} <=> %s::vector
+        LIMIT %s;
+    """, (filters[0], filters[0], filters[1], filters[1], filters[2], filters[2], embedding_string, k))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def timed_search(conn, embedding_string, filters, k, exact=False, ef_search=None, probes=None):
+    """Run one top-k query and return (ids, milliseconds). exact=True disables index scans."""
+    cursor = conn.cursor()
+    try:
+        if exact:
+            cursor.execute("SET LOCAL enable_indexscan = off;")
+        apply_search_settings(cursor, ef_search=ef_search, probes=probes)
+        start = time.perf_counter()
+        ids = _search(cursor, embedding_string, filters, k)
+        return ids, (time.perf_counter() - start) * 1000
+    finally:
+        cursor.close()
+        conn.rollback()
+
+
+def recall_report(k=10, ef_search_values=(20, 40, 80, 160), probes_values=(1, 5, 10, 20), file_path="eval_dataset.json", use_filters=True):
+    """Compare exact search and ANN search on the eval dataset queries.
+
+    Prints mean / p95 latency and recall@k (share of the exact top k that the ANN search also returned) for every
+    ef_search (HNSW) or probes (IVFFlat) value.
+    """
+    from embedding_gen import generate_embedding
+    from llm import extract_query_details
+
+    with open(file_path, 'r') as json_file:
+        queries = [entry["query"] for entry in json.load(json_file)]
+
+    with connection() as conn:
+        method = index_method(conn)
+        if method is None:
+            print(f"No ANN index {INDEX_NAME} found, build one first")
+            return
+
+        prepared = []
+        for query in queries:
+            embedding = generate_embedding(text=query)
+            embedding_string = '[' + ','.join(map(str, embedding[0])) + ']'
+            details = extract_query_details(query) if use_filters else {"Companies": [], "Years": [], "Quarters": []}
+            filters = ([str(c) for c in details["Companies"]], [str(y) for y in details["Years"]], [str(q) for q in details["Quarters"]])
+            exact_ids, exact_ms = timed_search(conn, embedding_string, filters, k, exact=True)
+            prepared.append((embedding_string, filters, exact_ids, exact_ms))
+
+        exact_latencies = np.array([entry[3] for entry in prepared])
+        print(f"\n{len(queries)} eval queries, k={k}, index method {method}")
+        print(f"{'search':<20}{'mean ms':>10}{'p95 ms':>10}{'recall@k':>10}")
+        print(f"{'exact':<20}{exact_latencies.mean():>10.2f}{np.percentile(exact_latencies, 95):>10.2f}{1.0:>10.3f}")
+
+        settings = ef_search_values if method == "hnsw" else probes_values
+        for value in settings:
+            latencies = []
+            recalls = []
+            for embedding_string, filters, exact_ids, _ in prepared:
+                if method == "hnsw":
+                    ids, ms = timed_search(conn, embedding_string, filters, k, ef_search=value)
+                else:
+                    ids, ms = timed_search(conn, embedding_string, filters, k, probes=value)
+                latencies.append(ms)
+                if exact_ids:
+                    recalls.append(len(set(ids) & set(exact_ids)) / len(exact_ids))
+            name = f"ef_search={value}" if method == "hnsw" else f"probes={value}"
+            print(f"{name:<20}{np.mean(latencies):>10.2f}{np.percentile(latencies, 95):>10.2f}{np.mean(recalls):>10.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the ANN index on embedding_chunks.embedding")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for command in ("build", "rebuild"):
+        sub = subparsers.add_parser(command, help=f"{command} the ANN index")
+        sub.add_argument("--method", choices=["hnsw", "ivfflat"], default="hnsw")
+        sub.add_argument("--m", type=int, default=DEFAULT_HNSW_M, help="HNSW max connections per layer")
+        sub.add_argument("--ef-construction", type=int, default=DEFAULT_HNSW_EF_CONSTRUCTION, help="HNSW build candidate list size")
+        sub.add_argument("--lists", type=int, default=None, help="IVFFlat number of lists (defaults to rows / 1000)")
+        sub.add_argument("--concurrently", action="store_true", help="do not block writes while building")
+        sub.add_argument("--maintenance-work-mem", default=None, help="e.g. 2GB")
+        sub.add_argument("--column", choices=list(COLUMN_OPERATOR_CLASSES), default=COLUMN_NAME)
+
+    drop_parser = subparsers.add_parser("drop", help="drop the ANN index")
+    drop_parser.add_argument("--concurrently", action="store_true")
+    drop_parser.add_argument("--column", choices=list(COLUMN_OPERATOR_CLASSES), default=COLUMN_NAME)
+
+    subparsers.add_parser("status", help="list the indexes on embedding_chunks")
+
+    report_parser = subparsers.add_parser("report", help="recall vs latency of exact and ANN search on eval_dataset.json")
+    report_parser.add_argument("--k", type=int, default=10)
+    report_parser.add_argument("--ef-search", default="20,40,80,160", help="comma separated HNSW ef_search values")
+    report_parser.add_argument("--probes", default="1,5,10,20", help="comma separated IVFFlat probes values")
+    report_parser.add_argument("--no-filters", action="store_true", help="ignore the company/year/quarter filters of the queries")
+
+    args = parser.parse_args()
+
+    if args.command == "report":
+        recall_report(
+            k=args.k,
+            ef_search_values=[int(value) for value in args.ef_search.split(",")],
+            probes_values=[int(value) for value in args.probes.split(",")],
+            use_filters=not args.no_filters,
+        )
+    else:
+        with connection() as conn:
+            if args.command == "status":
+                for name, definition, size in index_status(conn):
+                    print(f"{name} ({size}): {definition}")
+            elif args.command == "drop":
+                drop_index(conn, concurrently=args.concurrently, column=args.column)
+            else:
+                if args.command == "rebuild":
+                    drop_index(conn, concurrently=args.concurrently, column=args.column)
+                build_index(conn, method=args.method, m=args.m, ef_construction=args.ef_construction, lists=args.lists,
+                            concurrently=args.concurrently, maintenance_work_mem=args.maintenance_work_mem,
+                            column=args.column)